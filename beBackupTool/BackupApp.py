@@ -27,7 +27,7 @@
 #  MA 02110-1301, USA.
 #  
 
-import sys, os
+import sys, os, json, time, signal, threading
 import logging, logging.handlers
 
 if "beBackupTool" not in dir():
@@ -40,62 +40,696 @@ if "beBackupTool" not in dir():
 
 from beBackupTool import config # Works in __main__ (if path and import done above) and otherwise
 #from . import config # Doesn't work in __main__
-from modules import backup
-from modules import sendEmail
+# The modules are loaded on first use, so a command loads only those it
+# needs, see modules/lazy.py
+from modules import lazy
+backup = lazy.lazy_import("modules.backup")
+checkpoint = lazy.lazy_import("modules.checkpoint")
+checksums = lazy.lazy_import("modules.checksums")
+compress = lazy.lazy_import("modules.compress")
+manifest = lazy.lazy_import("modules.manifest")
+metrics = lazy.lazy_import("modules.metrics")
+outbox = lazy.lazy_import("modules.outbox")
+plan = lazy.lazy_import("modules.plan")
+progress = lazy.lazy_import("modules.progress")
+repository = lazy.lazy_import("modules.repository")
+retention = lazy.lazy_import("modules.retention")
+s3 = lazy.lazy_import("modules.s3")
+seekable = lazy.lazy_import("modules.seekable")
+sinks = lazy.lazy_import("modules.sinks")
+tee = lazy.lazy_import("modules.tee")
+throttle = lazy.lazy_import("modules.throttle")
+volumes = lazy.lazy_import("modules.volumes")
+watch = lazy.lazy_import("modules.watch")
+sendEmail = lazy.lazy_import("modules.sendEmail")
 
 
-def main_run():
+def get_app_logger():
     """
-    Run the app
+    Returns root logger, logging to "log/app.log", with 5 count rotation
+    on 500K file size
     """
-    # Set up logging, to "log/app.log", with 5 count rotation on 500K file size
     appLogger = logging.getLogger()
     appLogger.setLevel(logging.DEBUG)
+    if any(isinstance(h, logging.handlers.RotatingFileHandler) for h in appLogger.handlers):
+        return appLogger
     handler = logging.handlers.RotatingFileHandler(os.path.join(os.path.dirname(os.path.abspath(__file__)), "log/app.log"), maxBytes=500000, backupCount=5)
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y/%m/%d %I:%M:%S %p")
     handler.setFormatter(formatter)
     appLogger.addHandler(handler)
-    # Read config - backup objects
-    backupObjects = backup.read_backup_files_config(config.BACKUP_FILES)
+    return appLogger
+
+
+def main_run(outputMode=None, changedPaths=None, skipUnchanged=False):
+    """
+    Run the app
+    
+    The metrics of the run are logged and exported whether it succeeds
+    or not, see config.METRICS
+    
+    The *outputMode* may be "quiet", "progress" or "verbose", by default
+    the METRICS Output-Mode
+    
+    The *changedPaths* and *skipUnchanged* parameters are passed on from
+    the daemon, see run_backup()
+    """
+    appLogger = get_app_logger()
+    configMetrics = getattr(config, "METRICS", {})
+    if outputMode is None:
+        outputMode = configMetrics.get("Output-Mode", "verbose")
+    runMetrics = metrics.RunMetrics()
+    try:
+        return metrics.run_profiled(lambda: run_backup(appLogger, runMetrics, outputMode, changedPaths, skipUnchanged),
+                                    configMetrics.get("Profile", ""),
+                                    configMetrics.get("Profile-File", ""), appLogger)
+    finally:
+        if runMetrics.status != "success":
+            runMetrics.status = "error"
+        metricsError = metrics.export_metrics(runMetrics, appLogger, configMetrics)
+        if metricsError:
+            print(metricsError)
+            appLogger.error(metricsError)
+
+
+def run_backup(appLogger, runMetrics, outputMode="verbose", changedPaths=None, skipUnchanged=False):
+    """
+    Run the backup, timing its phases in *runMetrics*, and printing in 
+    *outputMode*, see progress.ProgressReporter
+    
+    If *changedPaths* is the set of paths changed since the last run, as
+    tracked by the daemon, incremental and differential runs archive the
+    changes among them without scanning the backup folders, and are 
+    skipped if there are none and *skipUnchanged* is True
+    """
     # Read config - tar file
     tarDir = config.TAR_FILE["Directory"]
     tarNameStem = config.TAR_FILE["Name-Stem"]
     tarUseTimestamp = config.TAR_FILE["Use-Timestamp"]
     tarStampFormat = config.TAR_FILE["Stamp-Format"]
-    tarDeleteDelay = config.TAR_FILE.get("Delete-Delay", 0)
+    tarBackupMode = config.TAR_FILE.get("Backup-Mode", "full")
+    tarFullEvery = config.TAR_FILE.get("Full-Every", 0)
+    tarCompressWorkers = compress.get_worker_count(config.TAR_FILE.get("Compress-Workers", 1))
+    tarCodec = config.TAR_FILE.get("Codec", "gzip")
+    tarLevel = config.TAR_FILE.get("Level", None)
+    tarCompressPolicy = None
+    if config.TAR_FILE.get("Store-Incompressible", False):
+        tarCompressPolicy = compress.CompressPolicy()
+    tarVolumeSize = int(config.TAR_FILE.get("Volume-Size-MB", 0) * 1000000)
+    tarSeekable = config.TAR_FILE.get("Seekable", False)
+    tarChecksums = config.TAR_FILE.get("Checksums", False)
+    tarRequireVerified = config.TAR_FILE.get("Require-Verified", False)
+    tarSinglePass = config.TAR_FILE.get("Single-Pass", False)
+    tarCheckpointSize = int(config.TAR_FILE.get("Checkpoint-MB", 0) * 1000000)
+    outboxDir = config.EMAIL_PREFS.get("Outbox-Directory", "")
+    # Read config - storage sinks, one of which may take the archive as it is written
+    storageSinks = sinks.get_sinks(getattr(config, "STORAGE", {}), tarDir, tarNameStem)
+    streamSink = ([s for s in storageSinks if s.stream] + [None])[0]
+    # Read config - backup objects, filtered to changed files for
+    # incremental and differential runs
+    tarScanWorkers = config.TAR_FILE.get("Scan-Workers", 1)
+    tarParallelObjects = config.TAR_FILE.get("Parallel-Objects", False)
+    scanStats = backup.ScanStats()
+    reporter = progress.ProgressReporter(outputMode, scanStats=scanStats)
+    # Read config - throttling, with the priorities set before any thread
+    # or process is started, so they inherit them
+    configThrottle = getattr(config, "THROTTLE", {})
+    priorityError = throttle.apply_priority(configThrottle.get("Nice", 0), configThrottle.get("IO-Class", ""),
+                                            configThrottle.get("IO-Level", 4))
+    if priorityError:
+        reporter.error(priorityError)
+        appLogger.warning(priorityError)
+    tarThrottle = throttle.get_throttle(configThrottle,
+                        [bo["Backup-Folder"] for bo in backup.get_valid_backup_objects(config.BACKUP_FILES)])
+    if config.TAR_FILE.get("Backend", "tar") == "repository":
+        return run_snapshot(appLogger, runMetrics, reporter, scanStats, tarThrottle)
+    backupObjects = backup.iter_backup_objects(config.BACKUP_FILES, tarScanWorkers, scanStats)
+    backupType = "full"
+    baseEntries = None
+    baseArchive = None
+    newEntries = None
+    if tarBackupMode != "full":
+        lastManifestPath, fullManifestPath = manifest.get_manifest_paths(tarDir, tarNameStem)
+        lastManifest = manifest.load_manifest(lastManifestPath)
+        fullManifest = manifest.load_manifest(fullManifestPath)
+        backupType = manifest.choose_backup_type(tarBackupMode, tarFullEvery, lastManifest, fullManifest)
+        baseManifest = {"incremental": lastManifest, "differential": fullManifest}.get(backupType)
+        baseEntries = baseManifest["entries"] if baseManifest else {}
+        baseArchive = baseManifest["archive"] if baseManifest else None
+        newEntries = {}
+        if changedPaths is not None and backupType != "full" and lastManifest is not None:
+            if skipUnchanged and not changedPaths:
+                reporter.message("No changes since the last run, backup skipped")
+                appLogger.info("No changes since the last run, backup skipped")
+                runMetrics.set("Backup-Type", "skipped")
+                runMetrics.status = "success"
+                return 0
+            # Changes tracked by the daemon, instead of a scan
+            backupObjects = watch.iter_changed_objects(config.BACKUP_FILES, changedPaths, lastManifest["entries"],
+                                                        baseEntries, newEntries, scanStats)
+            tarParallelObjects = False
+            runMetrics.set("Watched-Changes", len(changedPaths))
+        backupObjects = manifest.filter_changed_files(backupObjects, baseEntries, newEntries)
+        deletedPaths = []
+        def deleted_members():
+            # Called once the scan is complete
+            deletedPaths.extend(manifest.find_deleted_paths(baseEntries, newEntries))
+            return [(manifest.DELETED_MEMBER_NAME, json.dumps(deletedPaths, indent=1).encode("utf-8"))]
+        reporter.message("Backup type: %s" % backupType)
+        appLogger.info("Backup type: %s" % backupType)
+    runMetrics.set("Backup-Type", backupType)
+    # Scan in the background while archiving
+    backupObjects = backup.prefetch_backup_objects(backupObjects)
     # Delete old files
-    deletedTars = backup.delete_old_tarfiles(tarDir, tarNameStem, tarDeleteDelay)
-    print(deletedTars)
+    with runMetrics.phase("Retention"):
+        deletedTars = retention.prune_archives(tarDir, tarNameStem, config.TAR_FILE, compress.get_all_extensions())
     if deletedTars.startswith("ERROR"):
+        reporter.error(deletedTars)
         appLogger.error(deletedTars)
         sys.exit()
     else:
+        reporter.message(deletedTars)
         appLogger.info(deletedTars)
-    # Create tar archive
-    tarFilePath = backup.create_tar_filepath(tarDir, tarNameStem, tarUseTimestamp, tarStampFormat)
-    tarPath, tarError = backup.write_tar_file(backupObjects, tarFilePath)
+    # Create tar archive, recorded in the catalog as in progress until
+    # complete, so it is pruned if the run fails
+    tarFilePath = backup.create_tar_filepath(tarDir, tarNameStem, tarUseTimestamp, tarStampFormat,
+                                                            compress.get_extension(tarCodec))
+    baseTimestamp = None
+    if backupType != "full":
+        baseTimestamp = retention.get_name_timestamp(os.path.basename(fullManifest["archive"]))
+    if streamSink is None:
+        catalog = retention.load_catalog(tarDir, tarNameStem, compress.get_all_extensions())
+        retention.record_started(catalog, tarFilePath, backupType, baseTimestamp)
+        retention.save_catalog(tarDir, tarNameStem, catalog)
+    # The scan runs while archiving, so its time is part of the Archive phase
+    tarStats = {}
+    tarOutFile = streamSink.open_stream(tarFilePath) if streamSink is not None else None
+    # Sinks, and email if not queued, given the archive as it is written
+    # too, unless it is split into volumes, which are sent from the files
+    teeSinks = []
+    emailStream = None
+    emailStats = {}
+    if tarSinglePass and streamSink is None and tarVolumeSize == 0:
+        teeSinks = list(storageSinks)
+        if not outboxDir:
+            emailStream = sendEmail.EmailStreamWriter(tarFilePath, config.EMAIL_PREFS, emailStats)
+    tarExtraOutputs = [s.open_stream(tarFilePath) for s in teeSinks] + ([emailStream] if emailStream else [])
+    with runMetrics.phase("Archive"), reporter:
+        if tarParallelObjects:
+            # Each backup object archived in its own process, scanning there too
+            tarPath, tarError = backup.write_tar_file_parallel(config.BACKUP_FILES, tarFilePath,
+                                        extraMembers=deleted_members if backupType != "full" else None,
+                                        processes=tarCompressWorkers, codec=tarCodec, level=tarLevel,
+                                        volumeSize=tarVolumeSize, scanWorkers=tarScanWorkers,
+                                        baseEntries=baseEntries, newEntries=newEntries,
+                                        scanStats=scanStats, tarStats=tarStats, reporter=reporter,
+                                        compressPolicy=tarCompressPolicy, seekableArchive=tarSeekable,
+                                        checksumArchive=tarChecksums, outFile=tarOutFile,
+                                        extraOutputs=tarExtraOutputs, throttle=tarThrottle)
+        elif tarCheckpointSize > 0:
+            # Resumed from the segments of an interrupted run with the same settings
+            tarPath, tarError = backup.write_tar_file_checkpointed(backupObjects, tarFilePath,
+                                        checkpoint.get_checkpoint_dir(tarDir, tarNameStem), tarCheckpointSize,
+                                        runKey={"Backup-Type": backupType, "Base-Archive": baseArchive,
+                                                "Backup-Files": config.BACKUP_FILES},
+                                        extraMembers=deleted_members if backupType != "full" else None,
+                                        compressWorkers=tarCompressWorkers, codec=tarCodec, level=tarLevel,
+                                        volumeSize=tarVolumeSize, tarStats=tarStats, reporter=reporter,
+                                        compressPolicy=tarCompressPolicy, seekableArchive=tarSeekable,
+                                        checksumArchive=tarChecksums, outFile=tarOutFile,
+                                        extraOutputs=tarExtraOutputs, throttle=tarThrottle)
+        else:
+            tarPath, tarError = backup.write_tar_file(backupObjects, tarFilePath,
+                                        extraMembers=deleted_members if backupType != "full" else None,
+                                        compressWorkers=tarCompressWorkers, codec=tarCodec, level=tarLevel,
+                                        volumeSize=tarVolumeSize, tarStats=tarStats, reporter=reporter,
+                                        compressPolicy=tarCompressPolicy, seekableArchive=tarSeekable,
+                                        checksumArchive=tarChecksums, outFile=tarOutFile,
+                                        extraOutputs=tarExtraOutputs, throttle=tarThrottle)
+    runMetrics.update(get_scan_metrics(scanStats))
+    runMetrics.update({
+                "Tar-Members"           :   tarStats.get("members", 0),
+                "Tar-Uncompressed-Bytes":   tarStats.get("uncompressedBytes", 0),
+                "Tar-Compressed-Bytes"  :   tarStats.get("compressedBytes", 0),
+                "Stored-Files"          :   tarCompressPolicy.storedFiles if tarCompressPolicy else 0,
+                "Stored-Bytes"          :   tarCompressPolicy.storedBytes if tarCompressPolicy else 0,
+                "Throttle-Seconds"      :   round(tarThrottle.sleptSeconds, 3) if tarThrottle else 0,
+            })
     if tarError.startswith("ERROR"):
-        print(tarError)
+        reporter.error(tarError)
         appLogger.error(tarError)
         sys.exit()
     else:
-        print("Archive '%s' created successfully" % tarPath)
+        reporter.message("Archive '%s' created successfully" % tarPath)
         appLogger.info("Archive '%s' created successfully" % tarPath)
-    # Email backup
-    refusedDict, emailError = sendEmail.create_and_send_email_message(tarPath, config.EMAIL_PREFS)
+    # Save manifest only once the archive is complete
+    if tarBackupMode != "full":
+        runManifest = manifest.create_manifest(backupType, tarPath, newEntries, deletedPaths, fullManifest)
+        manifest.save_manifest(lastManifestPath, runManifest)
+        if backupType == "full":
+            manifest.save_manifest(fullManifestPath, runManifest)
+    # Streamed archive has no local file to verify, catalog or email
+    if streamSink is not None:
+        with runMetrics.phase("Upload"):
+            uploadCount, uploadError = streamSink.upload_sidecars(tarPath)
+        if uploadError:
+            reporter.error(uploadError)
+            appLogger.error(uploadError)
+            sys.exit()
+        reporter.message("Archive streamed to '%s'" % streamSink.get_url(tarPath))
+        appLogger.info("Archive streamed to '%s'" % streamSink.get_url(tarPath))
+        reporter.message("Backup done.")
+        appLogger.info("Backup done.")
+        runMetrics.status = "success"
+        return 0
+    # Verify archive, for the next run to prune old ones
+    verifyError = ""
+    if tarRequireVerified:
+        with runMetrics.phase("Verify"):
+            verifyError = checksums.verify_archive(tarPath)
+    # Add archive to the retention catalog
+    with runMetrics.phase("Retention"):
+        catalog = retention.load_catalog(tarDir, tarNameStem, compress.get_all_extensions())
+        retention.record_archive(catalog, tarPath, backupType, baseTimestamp, sha256=tarStats.get("sha256"))
+        if tarRequireVerified:
+            retention.mark_verified(catalog, os.path.basename(tarPath), not verifyError)
+        retention.save_catalog(tarDir, tarNameStem, catalog)
+    if verifyError:
+        reporter.error(verifyError)
+        appLogger.error(verifyError)
+        sys.exit()
+    elif tarRequireVerified:
+        reporter.message("Archive '%s' verified" % tarPath)
+        appLogger.info("Archive '%s' verified" % tarPath)
+    # Outputs that failed while the archive was written are sent from the file
+    teeErrors = tarStats.get("outputErrors", [])
+    teeNames = ["%s upload" % s.name for s in teeSinks] + (["Email"] if emailStream else [])
+    for teeName, teeError in zip(teeNames, teeErrors):
+        if teeError:
+            reporter.error("%s while writing failed, sending from file: %s" % (teeName, teeError))
+            appLogger.warning("%s while writing failed, sending from file: %s" % (teeName, teeError))
+    runMetrics.set("Tee-Errors", len([x for x in teeErrors if x]))
+    # Upload to storage sinks, leaving failed uploads for the next run to resume
+    uploadErrors = []
+    with runMetrics.phase("Upload"):
+        for storageSink in storageSinks:
+            if storageSink in teeSinks and not teeErrors[teeSinks.index(storageSink)]:
+                # The archive itself was uploaded as it was written
+                uploadCount, uploadError = storageSink.upload_sidecars(tarPath)
+                uploadCount += 1
+            else:
+                uploadCount, uploadError = storageSink.upload_archive(tarPath)
+            if uploadError:
+                uploadErrors.append(uploadError)
+                reporter.error("%s upload failed: %s" % (storageSink.name, uploadError))
+                appLogger.error("%s upload failed: %s" % (storageSink.name, uploadError))
+            else:
+                reporter.message("Archive uploaded to '%s'" % storageSink.get_url(tarPath))
+                appLogger.info("Archive uploaded to '%s' in %d files" % (storageSink.get_url(tarPath), uploadCount))
+    runMetrics.set("Upload-Errors", len(uploadErrors))
+    # Email backup, queued to be sent in the background if there is an outbox
+    if outboxDir:
+        with runMetrics.phase("Email"):
+            queuedJob = outbox.Outbox(outboxDir).enqueue(tarPath, sendEmail.get_recipients(config.EMAIL_PREFS),
+                                                            tarStats.get("sha256"))
+            outbox.spawn_deliverer([sys.executable, os.path.abspath(__file__), "--deliver"])
+        runMetrics.set("Email-Queued", 1 if queuedJob else 0)
+        reporter.message("Email queued in '%s'" % outboxDir)
+        appLogger.info("Email queued in '%s' as '%s'" % (outboxDir, queuedJob))
+        if uploadErrors:
+            sys.exit()
+        reporter.message("Backup done.")
+        appLogger.info("Backup done.")
+        runMetrics.status = "success"
+        return 0
+    if emailStream is not None and not teeErrors[-1]:
+        # Emailed as it was written
+        refusedDict, emailError = emailStream.refusedDict, ""
+    else:
+        emailStats = {}
+        with runMetrics.phase("Email"):
+            refusedDict, emailError = sendEmail.create_and_send_email_message(tarPath, config.EMAIL_PREFS,
+                                                                                emailStats=emailStats)
+    runMetrics.update({"Email-Messages": emailStats["messages"], "Email-Bytes": emailStats["bytes"]})
     if emailError.startswith("ERROR"):
-        print(emailError) # We leave deletion of tar file for another run
+        reporter.error(emailError) # We leave deletion of tar file for another run
         appLogger.error(emailError)
         sys.exit()
     else:
         if len(refusedDict) > 0:
-            print("Refused email recipients:")
-            print(refusedDict)
+            reporter.error("Refused email recipients:")
+            reporter.error(repr(refusedDict))
             appLogger.warn("Refused email recipients: " + repr(refusedDict))
-        print("Email sent.")
+        reporter.message("Email sent.")
         appLogger.info("Email sent.")
-    print("Backup done.")
+    if uploadErrors:
+        sys.exit()
+    reporter.message("Backup done.")
+    appLogger.info("Backup done.")
+    runMetrics.status = "success"
+    return 0
+
+
+def run_snapshot(appLogger, runMetrics, reporter, scanStats, tarThrottle=None):
+    """
+    Run the backup into the deduplicating repository, as a snapshot, 
+    printing with *reporter*, counting the scan in *scanStats*, and 
+    reading at the pace of *tarThrottle*, see run_backup()
+    """
+    tarDir = config.TAR_FILE["Directory"]
+    tarNameStem = config.TAR_FILE["Name-Stem"]
+    tarLevel = config.TAR_FILE.get("Level", None)
+    tarCompressPolicy = None
+    if config.TAR_FILE.get("Store-Incompressible", False):
+        tarCompressPolicy = compress.CompressPolicy()
+    if not os.path.exists(tarDir):
+        reporter.error("ERROR: Directory for tar files does not exist")
+        appLogger.error("ERROR: Directory for tar files does not exist")
+        sys.exit()
+    try:
+        repo = repository.Repository(repository.get_repository_path(tarDir, tarNameStem),
+                                        config.TAR_FILE.get("Chunk-Size-KB", 1024) * 1024,
+                                        tarLevel if tarLevel is not None else 6)
+    except Exception:
+        repoError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        reporter.error(repoError)
+        appLogger.error(repoError)
+        sys.exit()
+    runMetrics.set("Backup-Type", "snapshot")
+    # Delete old snapshots, their chunks collected once the new one is saved
+    with runMetrics.phase("Retention"):
+        deletedSnapshots = repository.prune_snapshots(repo, config.TAR_FILE)
+    if deletedSnapshots.startswith("ERROR"):
+        reporter.error(deletedSnapshots)
+        appLogger.error(deletedSnapshots)
+        sys.exit()
+    else:
+        reporter.message(deletedSnapshots)
+        appLogger.info(deletedSnapshots)
+    # Store the files, scanned in the background
+    snapshotName = os.path.basename(backup.create_tar_filepath(tarDir, tarNameStem, config.TAR_FILE["Use-Timestamp"],
+                                                                config.TAR_FILE["Stamp-Format"], ""))
+    backupObjects = backup.prefetch_backup_objects(backup.iter_backup_objects(config.BACKUP_FILES,
+                                                    config.TAR_FILE.get("Scan-Workers", 1), scanStats))
+    snapshotStats = {}
+    with runMetrics.phase("Archive"), reporter:
+        snapshotName, snapshotError = repository.write_snapshot(repo, backupObjects, snapshotName, reporter,
+                                        tarCompressPolicy, tarThrottle,
+                                        compress.get_worker_count(config.TAR_FILE.get("Compress-Workers", 1)),
+                                        snapshotStats)
+    runMetrics.update(get_scan_metrics(scanStats))
+    runMetrics.update({
+                "Snapshot-Files"        :   snapshotStats.get("files", 0),
+                "Snapshot-Reused-Files" :   snapshotStats.get("reusedFiles", 0),
+                "Snapshot-File-Bytes"   :   snapshotStats.get("fileBytes", 0),
+                "Snapshot-Chunks"       :   snapshotStats.get("chunks", 0),
+                "Snapshot-New-Chunks"   :   snapshotStats.get("newChunks", 0),
+                "Snapshot-Stored-Bytes" :   snapshotStats.get("storedBytes", 0),
+                "Throttle-Seconds"      :   round(tarThrottle.sleptSeconds, 3) if tarThrottle else 0,
+            })
+    if snapshotError.startswith("ERROR"):
+        reporter.error(snapshotError)
+        appLogger.error(snapshotError)
+        sys.exit()
+    reporter.message("Snapshot '%s' saved in '%s', %.1f MB of new data" % (snapshotName, repo.repoDir,
+                                                                        snapshotStats["storedBytes"] / 1000000))
+    appLogger.info("Snapshot '%s' saved in '%s', %.1f MB of new data" % (snapshotName, repo.repoDir,
+                                                                        snapshotStats["storedBytes"] / 1000000))
+    with runMetrics.phase("Retention"):
+        collected = repository.collect_garbage(repo)
+    if collected.startswith("ERROR"):
+        reporter.error(collected)
+        appLogger.error(collected)
+        sys.exit()
+    reporter.message(collected)
+    appLogger.info(collected)
+    reporter.message("Backup done.")
     appLogger.info("Backup done.")
+    runMetrics.status = "success"
+    return 0
+
+
+def get_scan_metrics(scanStats):
+    """
+    Returns dict of the run metrics of the counts of *scanStats*
+    """
+    scanCounts = scanStats.as_dict()
+    return {
+                "Scan-Seconds"          :   round(scanCounts["seconds"], 6),
+                "Scan-Folders"          :   scanCounts["folders"],
+                "Scan-Files"            :   scanCounts["files"],
+                "Scan-Bytes"            :   scanCounts["bytes"],
+                "Scan-Errors"           :   scanCounts["errors"],
+                "Excluded-Folders"      :   scanCounts["excludedFolders"],
+                "Excluded-Files"        :   scanCounts["excludedFiles"],
+                "Excluded-Bytes"        :   scanCounts["excludedBytes"],
+            }
+
+
+def main_bench_codecs(sampleMB=64):
+    """
+    Compare compression codecs on a sample of the configured backup 
+    files, reporting compression ratio and throughput of each
+    """
+    print("Reading sample of up to %d MB of backup files..." % sampleMB)
+    sampleData = backup.read_sample_tar(backup.iter_backup_objects(config.BACKUP_FILES), sampleMB * 1000000)
+    print("Sample size: %.1f MB" % (len(sampleData) / 1000000))
+    codecLevels = []
+    for codecName in sorted(compress.CODECS):
+        levels = compress.CODECS[codecName]["Levels"]
+        for level in sorted(set([levels[0], compress.CODECS[codecName]["Level"], levels[-1]])):
+            if codecName == "gzip" and level == 0:
+                continue
+            codecLevels.append((codecName, level))
+    workers = compress.get_worker_count(config.TAR_FILE.get("Compress-Workers", 1))
+    print("%-6s %5s %8s %10s" % ("Codec", "Level", "Ratio", "MB/s"))
+    for result in compress.bench_codecs(sampleData, codecLevels, workers):
+        print("%-6s %5d %8.2f %10.1f" % (result["Codec"], result["Level"], result["Ratio"], result["MBps"]))
+    return 0
+
+
+def main_restore(restorePath, archivePath=None, destDir=None, snapshotName=None):
+    """
+    Restore file or folder *restorePath*, as an archive member name or 
+    an absolute path in a backup folder, from *archivePath*, or else the
+    newest archive in the catalog that holds it, to *destDir*, by 
+    default the current folder
+    
+    Only seekable archives, with a member index, can be restored from.
+    From incremental or differential archives, the files of a folder 
+    that did not change since the base archive are not restored
+    
+    With the repository backend, it is restored from the snapshot
+    *snapshotName*, or else the newest snapshot that holds it
+    """
+    destDir = destDir or os.getcwd()
+    # Member names are relative to the folder containing the backup folder
+    memberNames = [restorePath.strip("/")]
+    for bo in config.BACKUP_FILES:
+        bkpDirContainer = os.path.dirname(backup.strip_trailing_slash(bo["Backup-Folder"]))
+        if restorePath.startswith(os.path.join(bkpDirContainer, "")):
+            memberNames.insert(0, os.path.relpath(restorePath, bkpDirContainer))
+    if config.TAR_FILE.get("Backend", "tar") == "repository":
+        return restore_snapshot(memberNames, destDir, snapshotName)
+    if archivePath:
+        archivePaths = [archivePath]
+    else:
+        tarDir = config.TAR_FILE["Directory"]
+        catalog = retention.load_catalog(tarDir, config.TAR_FILE["Name-Stem"], compress.get_all_extensions())
+        archives = sorted([a for a in catalog["Archives"] if not a.get("In-Progress")],
+                            key=lambda a: a["Timestamp"] or 0, reverse=True)
+        archivePaths = [os.path.join(tarDir, a["Name"]) for a in archives]
+    for tarPath in archivePaths:
+        memberIndex = seekable.load_member_index(tarPath)
+        if memberIndex is None:
+            continue
+        for memberName in memberNames:
+            if seekable.find_members(memberIndex, memberName):
+                restoredNames, restoreError = seekable.restore_members(tarPath, memberName, destDir)
+                if restoreError:
+                    print(restoreError)
+                    return 1
+                print("Restored %d files from '%s' to '%s'" % (len(restoredNames), tarPath, destDir))
+                return 0
+    print("ERROR: '%s' not found in any seekable archive" % restorePath)
+    return 1
+
+
+def restore_snapshot(memberNames, destDir, snapshotName=None):
+    """
+    Restore the first of *memberNames* found in snapshot *snapshotName*,
+    or else the newest snapshot holding one, to *destDir*
+    """
+    repo = repository.Repository(repository.get_repository_path(config.TAR_FILE["Directory"],
+                                                                config.TAR_FILE["Name-Stem"]))
+    snapshotNames = [snapshotName] if snapshotName else list(reversed(repo.list_snapshots()))
+    for snapshotName in snapshotNames:
+        snapshot = repo.load_snapshot(snapshotName)
+        for memberName in memberNames:
+            if repository.find_snapshot_files(snapshot, memberName):
+                restoredNames, restoreError = repository.restore_snapshot(repo, snapshot, memberName, destDir)
+                if restoreError:
+                    print(restoreError)
+                    return 1
+                print("Restored %d files from snapshot '%s' to '%s'" % (len(restoredNames), snapshotName, destDir))
+                return 0
+    print("ERROR: '%s' not found in any snapshot" % memberNames[-1])
+    return 1
+
+
+def main_snapshots():
+    """
+    List the snapshots in the repository, oldest first, with the number
+    of files and the new data each stored
+    """
+    repo = repository.Repository(repository.get_repository_path(config.TAR_FILE["Directory"],
+                                                                config.TAR_FILE["Name-Stem"]))
+    for snapshotName in repo.list_snapshots():
+        snapshot = repo.load_snapshot(snapshotName)
+        print("%s  %s  %8d files  %10.1f MB new" % (snapshotName,
+                                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["timestamp"])),
+                                len(snapshot["files"]), snapshot["stats"]["storedBytes"] / 1000000))
+    return 0
+
+
+def main_plan():
+    """
+    Print what a run would archive, excluded by each rule, its estimated
+    compressed size and runtime, without archiving anything
+
+    Incremental and differential runs count only the files changed since
+    their base archive. Runs to the repository backend are planned as
+    full ones, as the chunks already stored are not looked up
+    """
+    tarDir = config.TAR_FILE["Directory"]
+    tarNameStem = config.TAR_FILE["Name-Stem"]
+    tarBackupMode = config.TAR_FILE.get("Backup-Mode", "full")
+    tarCompressPolicy = None
+    if config.TAR_FILE.get("Store-Incompressible", False):
+        tarCompressPolicy = compress.CompressPolicy()
+    backupType = "full"
+    baseEntries = None
+    if config.TAR_FILE.get("Backend", "tar") == "repository":
+        backupType = "snapshot"
+    elif tarBackupMode != "full":
+        lastManifestPath, fullManifestPath = manifest.get_manifest_paths(tarDir, tarNameStem)
+        lastManifest = manifest.load_manifest(lastManifestPath)
+        fullManifest = manifest.load_manifest(fullManifestPath)
+        backupType = manifest.choose_backup_type(tarBackupMode, config.TAR_FILE.get("Full-Every", 0),
+                                                    lastManifest, fullManifest)
+        baseManifest = {"incremental": lastManifest, "differential": fullManifest}.get(backupType)
+        baseEntries = baseManifest["entries"] if baseManifest else None
+    loggedRuns = metrics.read_logged_metrics(os.path.join(os.path.dirname(os.path.abspath(__file__)), "log/app.log"))
+    runPlan = plan.make_plan(config.BACKUP_FILES, config.TAR_FILE.get("Codec", "gzip"), config.TAR_FILE.get("Level", None),
+                                tarCompressPolicy, baseEntries, loggedRuns)
+    print("\n".join(plan.format_plan(runPlan, backupType)))
+    return 0
+
+
+def main_deliver():
+    """
+    Deliver the emails queued in the outbox, retrying failed ones while
+    they fall due, unless another deliverer is running
+    """
+    appLogger = get_app_logger()
+    outboxDir = config.EMAIL_PREFS.get("Outbox-Directory", "")
+    if not outboxDir:
+        print("ERROR: No Outbox-Directory set in EMAIL_PREFS")
+        return 1
+    report = outbox.deliver_outbox(outboxDir, config.EMAIL_PREFS, maxAttempts=config.EMAIL_PREFS.get("Max-Attempts", 10))
+    print(report)
+    if report.startswith("ERROR"):
+        appLogger.error(report)
+        return 1
+    appLogger.info(report)
+    return 0
+
+
+def main_verify(archivePaths=None):
+    """
+    Verify the archives of *archivePaths*, or else all archives in the 
+    catalog, against their checksums, several at once, recording the 
+    results in the catalog
+    """
+    tarDir = config.TAR_FILE["Directory"]
+    tarNameStem = config.TAR_FILE["Name-Stem"]
+    catalog = retention.load_catalog(tarDir, tarNameStem, compress.get_all_extensions())
+    if not archivePaths:
+        archivePaths = [os.path.join(tarDir, a["Name"]) for a in catalog["Archives"] if not a.get("In-Progress")]
+    workers = compress.get_worker_count(config.TAR_FILE.get("Compress-Workers", 1))
+    verifyErrors = checksums.verify_archives(archivePaths, workers)
+    for tarPath, verifyError in zip(archivePaths, verifyErrors):
+        print(verifyError or "Archive '%s' OK" % tarPath)
+        if os.path.dirname(os.path.abspath(tarPath)) == os.path.abspath(tarDir):
+            retention.mark_verified(catalog, os.path.basename(tarPath), not verifyError)
+    retention.save_catalog(tarDir, tarNameStem, catalog)
+    print("Verified %d of %d archives" % (verifyErrors.count(""), len(archivePaths)))
+    return 1 if any(verifyErrors) else 0
+
+
+def main_rebuild_catalog():
+    """
+    Rebuild the retention catalog from a listing of the tar file folder,
+    adding the archives it does not record, as from before it was kept,
+    and dropping those no longer there
+    """
+    tarDir = config.TAR_FILE["Directory"]
+    tarNameStem = config.TAR_FILE["Name-Stem"]
+    if not os.path.exists(tarDir):
+        print("ERROR: Directory for tar files does not exist")
+        return 1
+    catalog = retention.load_catalog(tarDir, tarNameStem, compress.get_all_extensions())
+    catalog = retention.rebuild_catalog(tarDir, tarNameStem, compress.get_all_extensions(), catalog)
+    retention.save_catalog(tarDir, tarNameStem, catalog)
+    print("Catalog rebuilt with %d archives" % len(catalog["Archives"]))
+    return 0
+
+
+def main_daemon(outputMode=None):
+    """
+    Run backups on the schedule of config.DAEMON until stopped by 
+    SIGTERM or SIGINT, tracking the changes to the backup folders in 
+    between with inotify, so incremental and differential runs archive
+    them without scanning the folders again
+    
+    Runs scan the folders as usual when the changes are not all known, 
+    as on the first run, after events were lost and after a failed run
+    """
+    appLogger = get_app_logger()
+    configDaemon = getattr(config, "DAEMON", {})
+    tracker = None
+    if configDaemon.get("Watch", True) and config.TAR_FILE.get("Backup-Mode", "full") != "full":
+        tracker = watch.ChangeTracker(config.BACKUP_FILES, configDaemon.get("Max-Changes", watch.MAX_CHANGES))
+        watchError = tracker.start()
+        if watchError:
+            print("%s, scanning the folders on each run" % watchError)
+            appLogger.warning("%s, scanning the folders on each run" % watchError)
+        else:
+            appLogger.info("Watching %d folders for changes" % len(tracker.watchPaths))
+    stopEvent = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+    appLogger.info("Daemon started")
+    try:
+        while True:
+            nextRun = watch.get_next_run_time(time.time(), configDaemon.get("Interval-Minutes", 60),
+                                                configDaemon.get("Run-At", []))
+            if stopEvent.wait(max(nextRun - time.time(), 0)):
+                break
+            changedPaths, rescanNeeded = tracker.take_changes() if tracker is not None else (None, True)
+            try:
+                main_run(outputMode, None if rescanNeeded else changedPaths,
+                            configDaemon.get("Skip-Unchanged", True))
+            except (Exception, SystemExit) as e:
+                # Failed, so the changes taken may not be archived
+                if not isinstance(e, SystemExit):
+                    appLogger.exception("Run failed")
+                if tracker is not None:
+                    tracker.request_rescan()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tracker is not None:
+            tracker.stop()
+        appLogger.info("Daemon stopped")
     return 0
 
 
@@ -107,7 +741,25 @@ def main_test(mode="not-email"):
     """
     print("Main test in BackupApp")
     config.main_test()
+    lazy.main_test()
+    compress.main_test()
+    volumes.main_test()
+    tee.main_test()
+    throttle.main_test()
+    checksums.main_test()
+    checkpoint.main_test()
     backup.main_test()
+    retention.main_test()
+    repository.main_test()
+    manifest.main_test()
+    metrics.main_test()
+    plan.main_test()
+    progress.main_test()
+    seekable.main_test()
+    outbox.main_test()
+    s3.main_test()
+    sinks.main_test()
+    watch.main_test()
     if mode == "all":
         sendEmail.main_test()
     print("Main test in BackupApp passed OK")
@@ -122,14 +774,63 @@ if __name__ == "__main__":
     Commandline arguments:
 
         --help      Print this help message
+        --quiet     Print errors only
+        --progress  Print a progress line a few times a second
+        --verbose   Print every file added to the archive
         --test      Test the package, excluding sending email
         --testall   Test including the email sending
+        --bench-codecs
+                    Compare compression codecs on a sample of the 
+                    backup files, to choose the TAR_FILE Codec
+        --restore PATH [--archive FILE] [--to DIR]
+                    Restore file or folder PATH from the newest 
+                    seekable archive holding it, or from FILE, to DIR,
+                    by default the current folder
+        --restore PATH [--snapshot NAME] [--to DIR]
+                    With the repository backend, restore PATH from the
+                    newest snapshot holding it, or from snapshot NAME
+        --snapshots List the snapshots in the repository
+        --plan      Print the files and bytes a run would archive, and
+                    exclude by each rule, and its estimated size and 
+                    runtime, reading only a sample of the files
+        --deliver   Send the emails queued in the EMAIL_PREFS outbox,
+                    retrying failed ones as they fall due
+        --verify [FILE ...]
+                    Verify FILEs, or else all archives in the catalog,
+                    against their checksums
+        --rebuild-catalog
+                    Rebuild the retention catalog from the archives in
+                    the TAR_FILE Directory, adding those from before it
+        --daemon    Run backups on the DAEMON schedule until stopped,
+                    tracking changes to the backup folders in between
 """
         print(argsHelp)
     elif "--test" in sys.argv:
         main_test(mode="not-email")
     elif "--testall" in sys.argv:
         main_test(mode="all")
+    elif "--bench-codecs" in sys.argv:
+        main_bench_codecs()
+    elif "--restore" in sys.argv[:-1]:
+        def get_arg_value(argName):
+            if argName in sys.argv[:-1]:
+                return sys.argv[sys.argv.index(argName) + 1]
+            return None
+        sys.exit(main_restore(get_arg_value("--restore"), get_arg_value("--archive"), get_arg_value("--to"),
+                                get_arg_value("--snapshot")))
+    elif "--snapshots" in sys.argv:
+        sys.exit(main_snapshots())
+    elif "--plan" in sys.argv:
+        sys.exit(main_plan())
+    elif "--deliver" in sys.argv:
+        sys.exit(main_deliver())
+    elif "--verify" in sys.argv:
+        sys.exit(main_verify(sys.argv[sys.argv.index("--verify") + 1:]))
+    elif "--rebuild-catalog" in sys.argv:
+        sys.exit(main_rebuild_catalog())
     else:
-        main_run()
+        outputModes = [x[2:] for x in sys.argv if x[2:] in progress.OUTPUT_MODES and x.startswith("--")]
+        if "--daemon" in sys.argv:
+            sys.exit(main_daemon(outputModes[-1] if outputModes else None))
+        main_run(outputModes[-1] if outputModes else None)
 
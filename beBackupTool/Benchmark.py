@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+########################################################################
+#                                                                      #
+#                     BE Backup Tool - Benchmarks                      #
+#                                                                      #
+########################################################################
+
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+
+"""
+Reproducible benchmarks of the backup phases on synthetic trees
+
+Each tree profile is generated from a fixed random seed, so runs on the
+same host are comparable. The scan, archive, retention and email phases
+are timed, the email being sent to an in-process SMTP sink, and the
+results written as JSON
+"""
+
+import sys, os, time, json, random, shutil, tempfile, platform
+
+if "beBackupTool" not in dir():
+    # See BackupApp.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import beBackupTool
+
+from beBackupTool import config
+from modules import backup
+from modules import compress
+from modules import progress
+from modules import retention
+from modules import sendEmail
+from modules import smtpSink
+
+BENCHMARK_VERSION = 1
+
+RANDOM_SEED = 20190807
+
+PROFILES = ("tiny-files", "huge-files", "deep-nesting", "incompressible", "heavy-exclusions")
+
+WORDS = [w.encode("ascii") for w in """lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+    tempor incididunt ut labore et dolore magna aliqua def return import class self none true false""".split()]
+
+
+def make_text(rng, size):
+    """
+    Returns *size* bytes of compressible pseudo-text from *rng*
+    """
+    chunks = []
+    length = 0
+    while length < size:
+        line = b" ".join(rng.choice(WORDS) for i in range(12)) + b"\n"
+        chunks.append(line)
+        length += len(line)
+    return b"".join(chunks)[:size]
+
+
+def make_random(rng, size):
+    """
+    Returns *size* bytes of incompressible data from *rng*
+    """
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def write_file(filePath, data):
+    with open(filePath, "wb") as fp:
+        fp.write(data)
+
+
+def generate_tree(rootDir, profile, scale=1):
+    """
+    Generates the synthetic tree of *profile* in *rootDir*, with the
+    file count or sizes multiplied by *scale*
+
+    Returns backup object dict for the tree, with its exclusions
+    """
+    rng = random.Random("%s-%d" % (profile, RANDOM_SEED))
+    os.makedirs(rootDir)
+    bo = {
+            "Backup-Folder"         :   rootDir,
+            "Exclude-Folders"       :   [],
+            "Exclude-Files"         :   [],
+            "Exclude-Extensions"    :   [],
+            "Exclude-Patterns"      :   [],
+        }
+    if profile in ("tiny-files", "heavy-exclusions"):
+        # Many tiny files in a shallow, wide tree
+        fileCount = 5000 * scale
+        for n in range(fileCount):
+            dirPath = os.path.join(rootDir, "d%03d" % (n % 100), "e%02d" % (n % 7))
+            os.makedirs(dirPath, exist_ok=True)
+            ext = (".py", ".txt", ".pyc", ".log", ".json")[n % 5]
+            write_file(os.path.join(dirPath, "f%06d%s" % (n, ext)), make_text(rng, rng.randint(0, 4096)))
+        if profile == "heavy-exclusions":
+            # Hundreds of exclusions, of which some match
+            for n in range(300):
+                bo["Exclude-Folders"].append(os.path.join(rootDir, "d%03d" % (n * 3), "e%02d" % (n % 7)))
+                bo["Exclude-Files"].append(os.path.join(rootDir, "d%03d" % (n % 100), "e%02d" % (n % 7), "f%06d.py" % (n * 17)))
+                bo["Exclude-Patterns"].append("*.tmp%d" % n)
+            bo["Exclude-Extensions"] = ["pyc", "log"] + ["x%c%c" % (chr(97 + n // 26), chr(97 + n % 26)) for n in range(200)]
+            bo["Exclude-Patterns"] += ["re:.*/d09[0-9]/", "cache"]
+    elif profile == "huge-files":
+        # Few huge, compressible files
+        for n in range(4):
+            write_file(os.path.join(rootDir, "huge%d.log" % n), make_text(rng, 16 * 1000000 * scale))
+    elif profile == "deep-nesting":
+        # Long chains of nested folders with a few files each
+        for chain in range(20 * scale):
+            dirPath = rootDir
+            for depth in range(60):
+                dirPath = os.path.join(dirPath, "n%02d" % depth)
+                os.makedirs(dirPath, exist_ok=True)
+                write_file(os.path.join(dirPath, "c%03d.txt" % chain), make_text(rng, 200))
+    elif profile == "incompressible":
+        # Random data, as in media and already compressed files
+        for n in range(40 * scale):
+            write_file(os.path.join(rootDir, "r%03d.bin" % n), make_random(rng, 500000))
+    else:
+        raise ValueError("Unknown benchmark profile '%s'" % profile)
+    return bo
+
+
+def time_phase(phaseFunc):
+    """
+    Returns tuple of the return value of *phaseFunc* and seconds taken
+    """
+    startTime = time.perf_counter()
+    result = phaseFunc()
+    return result, time.perf_counter() - startTime
+
+
+def phase_result(seconds, fileCount=None, byteCount=None, **extra):
+    """
+    Returns dict of phase timing and throughput
+    """
+    result = {"Seconds": round(seconds, 6)}
+    if fileCount is not None:
+        result["Files"] = fileCount
+        result["Files-Per-Second"] = round(fileCount / max(seconds, 1e-9), 1)
+    if byteCount is not None:
+        result["Bytes"] = byteCount
+        result["MBps"] = round(byteCount / max(seconds, 1e-9) / 1000000, 3)
+    result.update(extra)
+    return result
+
+
+def bench_profile(workDir, profile, scale, tarPrefs):
+    """
+    Generates the tree of *profile* and times each backup phase on it,
+    returning dict of the results
+    """
+    treeDir = os.path.join(workDir, profile)
+    outDir = os.path.join(workDir, profile + "-out")
+    os.mkdir(outDir)
+    bo = generate_tree(treeDir, profile, scale)
+    results = {}
+    # Scan
+    backupObjects, seconds = time_phase(lambda: backup.read_backup_files_config([bo]))
+    filePaths = backupObjects[0]
+    scannedBytes = sum(os.lstat(x).st_size for x in filePaths)
+    results["Scan"] = phase_result(seconds, len(filePaths), scannedBytes)
+    # Archive
+    codec = tarPrefs.get("Codec", "gzip")
+    tarPath = os.path.join(outDir, "bench_%d%s" % (int(time.time()), compress.get_extension(codec)))
+    (tarPath, tarError), seconds = time_phase(lambda: backup.write_tar_file(
+                                backupObjects, tarPath,
+                                compressWorkers=compress.get_worker_count(tarPrefs.get("Compress-Workers", 1)),
+                                codec=codec, level=tarPrefs.get("Level", None),
+                                reporter=progress.ProgressReporter("quiet")))
+    if tarError:
+        raise RuntimeError(tarError)
+    tarSize = os.path.getsize(tarPath)
+    results["Archive"] = phase_result(seconds, len(filePaths), scannedBytes,
+                                        **{"Archive-Bytes": tarSize, "Ratio": round(scannedBytes / max(tarSize, 1), 3)})
+    # Email, to the in-process SMTP sink
+    with smtpSink.SMTPSink() as sink:
+        emailPrefs = dict(config.EMAIL_PREFS, **{"SMTP-Host": sink.host, "SMTP-Port": sink.port})
+        (refusedDict, emailError), seconds = time_phase(lambda: sendEmail.create_and_send_email_message(tarPath, emailPrefs))
+    if emailError:
+        raise RuntimeError(emailError)
+    results["Email"] = phase_result(seconds, byteCount=sink.bytesReceived, Messages=sink.messageCount)
+    # Retention, pruning a catalog of many old archives
+    archiveCount = 2000
+    oldStamp = int(time.time()) - 30 * 24 * 60 * 60
+    for n in range(archiveCount):
+        open(os.path.join(outDir, "bench_%d%s" % (oldStamp + n, compress.get_extension(codec))), "w").close()
+    retention.save_catalog(outDir, "bench", retention.rebuild_catalog(outDir, "bench", compress.get_all_extensions()))
+    policy = {"Delete-Delay": 7, "Keep-Daily": 7, "Keep-Weekly": 4, "Keep-Monthly": 6}
+    report, seconds = time_phase(lambda: retention.prune_archives(outDir, "bench", policy, compress.get_all_extensions()))
+    if report.startswith("ERROR"):
+        raise RuntimeError(report)
+    results["Retention"] = phase_result(seconds, archiveCount + 1)
+    shutil.rmtree(treeDir)
+    shutil.rmtree(outDir)
+    return results
+
+
+def run_benchmarks(profiles=PROFILES, scale=1, repeat=1, tarPrefs=None):
+    """
+    Runs the benchmark of each of *profiles*, *repeat* times, in a
+    temporary directory, returning dict of results for JSON output
+    """
+    tarPrefs = config.TAR_FILE if tarPrefs is None else tarPrefs
+    report = {
+                "Benchmark-Version"     :   BENCHMARK_VERSION,
+                "Time"                  :   int(time.time()),
+                "Python"                :   platform.python_version(),
+                "Platform"              :   platform.platform(),
+                "CPUs"                  :   os.cpu_count(),
+                "Scale"                 :   scale,
+                "Codec"                 :   tarPrefs.get("Codec", "gzip"),
+                "Level"                 :   compress.get_level(tarPrefs.get("Codec", "gzip"), tarPrefs.get("Level", None)),
+                "Compress-Workers"      :   compress.get_worker_count(tarPrefs.get("Compress-Workers", 1)),
+                "Profiles"              :   {},
+            }
+    for profile in profiles:
+        runs = []
+        for n in range(repeat):
+            workDir = tempfile.mkdtemp(prefix="beBackupTool_bench_")
+            try:
+                runs.append(bench_profile(workDir, profile, scale, tarPrefs))
+            finally:
+                shutil.rmtree(workDir, ignore_errors=True)
+        # Keep the fastest run of each phase, the least disturbed by noise
+        report["Profiles"][profile] = dict((phase, min((r[phase] for r in runs), key=lambda x: x["Seconds"]))
+                                            for phase in runs[0])
+        print("%-18s %s" % (profile, "  ".join("%s %.3fs" % (phase, result["Seconds"])
+                                                for phase, result in report["Profiles"][profile].items())),
+                file=sys.stderr)
+    return report
+
+
+def get_arg_value(argName, default):
+    """
+    Returns value following *argName* on the commandline, or *default*
+    """
+    if argName in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(argName) + 1]
+    return default
+
+
+def main_test():
+    """
+    Test the benchmark on a small scale
+    """
+    print("Main test in Benchmark")
+    report = run_benchmarks(profiles=PROFILES, scale=1, repeat=1,
+                            tarPrefs={"Codec": "gzip", "Level": 1, "Compress-Workers": 1})
+    json.dumps(report)
+    assert sorted(report["Profiles"]) == sorted(PROFILES)
+    for profile in PROFILES:
+        assert sorted(report["Profiles"][profile]) == ["Archive", "Email", "Retention", "Scan"]
+    # Exclusions are applied, and the trees are reproducible
+    assert report["Profiles"]["heavy-exclusions"]["Scan"]["Files"] < report["Profiles"]["tiny-files"]["Scan"]["Files"]
+    assert report["Profiles"]["incompressible"]["Archive"]["Ratio"] < 1.01
+    workDir = tempfile.mkdtemp(prefix="beBackupTool_bench_")
+    try:
+        generate_tree(os.path.join(workDir, "a"), "tiny-files")
+        generate_tree(os.path.join(workDir, "b"), "tiny-files")
+        for dp, ds, fs in os.walk(os.path.join(workDir, "a")):
+            for f in fs:
+                with open(os.path.join(dp, f), "rb") as fa, open(os.path.join(dp.replace(os.path.join(workDir, "a"), os.path.join(workDir, "b"), 1), f), "rb") as fb:
+                    assert fa.read() == fb.read()
+    finally:
+        shutil.rmtree(workDir)
+    print("Main test in Benchmark passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    if "--help" in sys.argv:
+        argsHelp = """
+======== Benchmark in beBackupTool ========
+
+    Commandline arguments:
+
+        --help              Print this help message
+        --test              Test the benchmark on a small scale
+        --profiles LIST     Comma-separated profiles to run, of:
+                            %s
+        --scale N           Multiply tree sizes by N, default 1
+        --repeat N          Run each profile N times and keep the
+                            fastest time of each phase, default 3
+        --output FILE       Write the JSON results to FILE instead
+                            of printing them
+
+    The TAR_FILE Codec, Level and Compress-Workers of config.py are used.
+""" % ", ".join(PROFILES)
+        print(argsHelp)
+    elif "--test" in sys.argv:
+        main_test()
+    else:
+        profiles = get_arg_value("--profiles", ",".join(PROFILES)).split(",")
+        report = run_benchmarks(profiles, int(get_arg_value("--scale", 1)), int(get_arg_value("--repeat", 3)))
+        outputPath = get_arg_value("--output", None)
+        if outputPath:
+            with open(outputPath, "w", encoding="utf-8") as fp:
+                json.dump(report, fp, indent=4)
+        else:
+            print(json.dumps(report, indent=4))
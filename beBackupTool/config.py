@@ -18,7 +18,14 @@ import sys, os
 #  object dict, but the empty lists (and their keys) must be present.
 #  
 #  Folders may or may not have a trailing slash. Extensions may or may 
-#  not start with a dot.
+#  not start with a dot. An excluded folder is skipped with everything
+#  inside it.
+#  
+#  The optional "Exclude-Patterns" list holds fnmatch globs, like 
+#  "*.tmp" or "node_modules", that exclude any file or folder whose name
+#  matches, or whose full path matches if the glob contains a slash. A 
+#  pattern prefixed with "re:" is instead a regex matched from the start
+#  of the full path.
 #  
 #  Any required exclusions must be set for each backup object, even if 
 #  they repeat. For example, if files with the ".pyc" extension should 
@@ -37,6 +44,9 @@ BACKUP_FILES = [
                                     
         "Exclude-Extensions"    :   [
                                     ],
+                                    
+        "Exclude-Patterns"      :   [
+                                    ],
     },
 ]
 
@@ -46,7 +56,7 @@ BACKUP_FILES = [
 #  Name Stem must not be empty. 1 to 40 [A-Za-z0-9_] chars are valid.
 #  
 #  If Timestamp is used, a timestamp will be appended to the name,
-#  before the ".tgz" file extension, separated by an underscore.
+#  before the file extension, separated by an underscore.
 #  
 #  The only timestamp format currently available is "seconds", as 
 #  provided by the time.time() function (and truncated to int).
@@ -58,6 +68,102 @@ BACKUP_FILES = [
 #  If set to 0, all existing archives will be deleted on every run of
 #  this script, possibly losing data. Set the value to 1 or greater.
 #  
+#  Keep Daily, Keep Weekly and Keep Monthly, if greater than 0, keep the
+#  newest archive of each of that many of the most recent days, weeks 
+#  and months, even once older than Delete Delay. Max Total MB, if 
+#  greater than 0, deletes the oldest archives while their total size 
+#  is over it. Archives needed to restore kept incremental or 
+#  differential archives are never deleted. The archives produced are
+#  recorded in a "<Name-Stem>.catalog.json" file in the Directory, from
+#  the start of their run, so those of failed runs are deleted too. Run
+#  "BackupApp.py --rebuild-catalog" once to add archives from before it.
+#  
+#  Backup Mode may be "full", "incremental" or "differential". The last
+#  two save a manifest of all backed up files in the Directory, and 
+#  archive only files that are new or changed since the last run, or 
+#  since the last full run for "differential". Deleted files are listed
+#  in the ".beBackupTool/deleted.json" member of each such archive. 
+#  
+#  Full Every sets the number of days after which a full backup is taken
+#  again. If set to 0, only the first run is a full backup. Make sure 
+#  Delete Delay keeps the last full archive for as long as it is needed.
+#  
+#  Codec sets the compression of the archive, and with it the file 
+#  extension: "gzip" (".tgz"), "bz2" (".tbz2"), "xz" (".txz") or "none"
+#  (".tar"). Level sets the compression level, 1-9 for gzip and bz2 and
+#  0-9 for xz, or None for the codec's default. Run BackupApp.py with 
+#  --bench-codecs to compare them on the backup files.
+#  
+#  Parallel Objects, if True, archives each backup object in its own 
+#  process, up to Compress Workers at once, and joins the results into
+#  one archive. This pays off with several large backup objects.
+#  
+#  Scan Workers sets the number of threads listing the backup folders.
+#  More than 1 speeds up scanning storage with high latency, like NFS.
+#  
+#  Volume Size MB, if greater than 0, splits the archive into numbered
+#  volumes of at most that size, each emailed as a separate message, 
+#  with an index file describing how to reassemble them. Keep it below
+#  the attachment limit of the mail server, allowing for the third 
+#  added by base64 encoding.
+#  
+#  Store Incompressible, if True, stores files that are compressed 
+#  already, like images, video and archives, instead of compressing them
+#  again, saving much CPU time for little or no growth in size. They are
+#  found by extension, or by a sample of their data. The archive stays a
+#  standard one, and gzip stores them as such, while bz2 and xz compress
+#  them at their fastest level.
+#  
+#  Seekable, if True, writes a member index next to the archive, and 
+#  starts a new compressed block at least every MB, so single files or
+#  folders can be restored with "BackupApp.py --restore PATH" without
+#  decompressing the whole archive. The archive stays a standard one.
+#  
+#  Checksums, if True, takes the SHA-256 checksums of the archive and of
+#  each file in it as the archive is written, without reading the files
+#  again, and saves them next to it. Archives are checked against them 
+#  with "BackupApp.py --verify", several at once.
+#  
+#  Require Verified, if True, verifies each new archive after it is 
+#  written, and old archives are not deleted until the newest one has
+#  verified. It needs Checksums.
+#  
+#  Single Pass, if True, uploads the archive to the storage sinks, and 
+#  emails it when there is no Outbox Directory, as it is written, along
+#  with writing the file and taking its checksum, so it is produced once
+#  and never read back from disk. The outputs are written at once, at 
+#  the pace of the slowest. One that fails is sent from the file after,
+#  as are archives split into volumes. With Require Verified set, the
+#  archive is still read back once to verify it.
+#  
+#  Checkpoint MB, if greater than 0, writes the archive in segments of 
+#  about that many MB of files, each recorded in a journal in the folder
+#  "<Name-Stem>.checkpoint" in the Directory once it is safely on disk.
+#  A run that fails or is killed leaves them there, and the next run 
+#  with the same settings resumes from them, adding again only the files
+#  changed since, and joins the segments into the archive at the end. 
+#  It needs disk space for the archive twice, and does not apply with 
+#  Parallel Objects.
+#  
+#  Backend may be "tar", to write a tar archive each run, or 
+#  "repository", to store the backup files in a deduplicating folder 
+#  "<Name-Stem>.repo" in the Directory instead, where each run is a 
+#  snapshot of all the files, but data already stored by an earlier run
+#  takes no more space. Files are split into chunks of about Chunk Size 
+#  KB, fixed when the repository is created, at boundaries set by their
+#  content, and each distinct chunk is stored once, compressed with zlib
+#  at Level. The delete delay and keep settings prune the snapshots, 
+#  with Max Total MB counting the data each snapshot added, and the 
+#  chunks no snapshot needs are then deleted. Restore with 
+#  "BackupApp.py --restore PATH [--snapshot NAME]", and list the 
+#  snapshots with "BackupApp.py --snapshots". The backup mode, volumes,
+#  seekable and checksum settings, storage sinks and email do not apply
+#  to the repository.
+#  
+#  Compress Workers sets the number of threads compressing the archive.
+#  With more than 1, the archive is compressed in parallel blocks, for 
+#  a slightly larger file. If set to 0, one thread per CPU is used.
+#  
 
 TAR_FILE = {
                 "Name-Stem"     :   "BE_Backup",
@@ -65,6 +171,26 @@ TAR_FILE = {
                 "Stamp-Format"  :   "seconds",
                 "Directory"     :   "/tmp",
                 "Delete-Delay"  :   7,
+                "Keep-Daily"    :   0,
+                "Keep-Weekly"   :   0,
+                "Keep-Monthly"  :   0,
+                "Max-Total-MB"  :   0,
+                "Backup-Mode"   :   "full",
+                "Full-Every"    :   7,
+                "Codec"         :   "gzip",
+                "Level"         :   None,
+                "Store-Incompressible"  :   False,
+                "Compress-Workers"  :   1,
+                "Scan-Workers"      :   1,
+                "Parallel-Objects"  :   False,
+                "Volume-Size-MB"    :   0,
+                "Seekable"          :   False,
+                "Checksums"         :   False,
+                "Require-Verified"  :   False,
+                "Single-Pass"       :   False,
+                "Checkpoint-MB"     :   0,
+                "Backend"           :   "tar",
+                "Chunk-Size-KB"     :   1024,
             }
 
 # 
@@ -72,6 +198,22 @@ TAR_FILE = {
 # 
 #  None of the fields may be empty. Subject may be up to 100 chars. Body 
 #  may be up to 500 chars and must be ASCII text only.
+#  
+#  Address To may be one address, several separated by commas, or a 
+#  list of them.
+#  
+#  SMTP Host and Port are optional, and set the SMTP server to send the
+#  email with, by default the local one on port 25.
+#  
+#  Outbox Directory, if not empty, is a folder the archive is queued in
+#  to be emailed in the background, so the run does not wait for the 
+#  mail server, nor fails when it is down. The queued archives are sent
+#  to each recipient at once, and failed sends retried with increasing 
+#  delays, up to Max Attempts times, by a deliverer the run starts. It 
+#  can be started from cron as well, with "BackupApp.py --deliver". 
+#  Archives still queued when deleted by retention are not sent, their
+#  jobs dropped without retrying. If empty, the email is sent during 
+#  the run, once.
 # 
 
 EMAIL_PREFS = {
@@ -79,6 +221,141 @@ EMAIL_PREFS = {
                 "Address-To"    :   "to@address.com",
                 "Subject"       :   "Backup File",
                 "Body"          :   """Latest backup file from the server""",
+                "SMTP-Host"     :   "localhost",
+                "SMTP-Port"     :   25,
+                "Outbox-Directory"  :   "",
+                "Max-Attempts"      :   10,
+            }
+
+# 
+#  Preferences for storage sinks, where archives are uploaded to besides
+#  being emailed. This section is optional.
+#  
+#  S3 Endpoint, if not empty, is the URL of an S3-compatible server, 
+#  like "https://s3.eu-west-1.amazonaws.com" or "http://127.0.0.1:9000"
+#  for MinIO, to upload each archive to, into S3 Bucket, with the S3 
+#  Prefix before its file name. S3 Access Key and S3 Secret Key, if 
+#  empty, are read from the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+#  environment variables, so they need not be stored here.
+#  
+#  Archives are uploaded in parts of Part Size MB, at least 5, Upload 
+#  Workers at once, and an upload that was interrupted is resumed by the
+#  next run from the parts the server has.
+#  
+#  Stream, if True, uploads the archive as it is written, without a 
+#  local file, so it is not kept, verified or emailed, nor pruned by 
+#  retention. Only its checksums and member index are kept locally too.
+#  
+
+STORAGE = {
+                "S3-Endpoint"       :   "",
+                "S3-Region"         :   "us-east-1",
+                "S3-Bucket"         :   "",
+                "S3-Prefix"         :   "",
+                "S3-Access-Key"     :   "",
+                "S3-Secret-Key"     :   "",
+                "Part-Size-MB"      :   16,
+                "Upload-Workers"    :   4,
+                "Stream"            :   False,
+            }
+
+# 
+#  Preferences for the daemon mode, "BackupApp.py --daemon", which runs
+#  backups on a schedule of its own instead of from cron, until stopped.
+#  This section is optional. The config is read when the daemon starts,
+#  so restart it after changing it.
+#  
+#  Interval Minutes sets the time between runs, counted from midnight,
+#  so 60 runs on the hour. Run At, if not empty, is a list of "HH:MM" 
+#  local times to run at each day instead.
+#  
+#  Watch, if True, tracks the changes to the backup folders between 
+#  runs with Linux inotify, so incremental and differential runs archive
+#  the changed files without scanning the folders again. Should more 
+#  than Max Changes paths change, or events be lost, the next run scans
+#  the folders as usual. Each folder watched takes about 1 KB of kernel
+#  memory, and their number is limited by fs.inotify.max_user_watches,
+#  beyond which every run scans.
+#  
+#  Skip Unchanged, if True, skips the incremental and differential runs
+#  when nothing changed since the last run.
+#  
+
+DAEMON = {
+                "Interval-Minutes"  :   60,
+                "Run-At"            :   [],
+                "Watch"             :   True,
+                "Max-Changes"       :   100000,
+                "Skip-Unchanged"    :   True,
+            }
+
+# 
+#  Preferences for throttling the backup, so it leaves the server's 
+#  other work room to run. This section is optional, and its limits are
+#  off at 0 or empty.
+#  
+#  Max MBps caps the reading of the files archived, in MB a second, and
+#  Max Files Per Second the files and folders added a second, which 
+#  eases the load of many small files. Parallel archiving processes 
+#  share the caps.
+#  
+#  Nice, from 1 to 19, lowers the CPU priority of the backup, and IO 
+#  Class sets its disk priority on Linux, "best-effort" at IO Level 0, 
+#  highest, to 7, lowest, or "idle", to read only when no other process
+#  does, like the nice and ionice commands.
+#  
+#  Max Load, the 1-minute load average per CPU, and Max Disk Util, the
+#  percent of time the disks of the backup folders are busy, both read
+#  from /proc and including the backup itself, make the reading back 
+#  off while the system is above either: checked every second, each 
+#  check above halves the time spent reading, down to a twentieth, and
+#  each check below gives a tenth back.
+#  
+
+THROTTLE = {
+                "Max-MBps"              :   0,
+                "Max-Files-Per-Second"  :   0,
+                "Nice"                  :   0,
+                "IO-Class"              :   "",
+                "IO-Level"              :   4,
+                "Max-Load"              :   0,
+                "Max-Disk-Util"         :   0,
+            }
+
+# 
+#  Preferences for run output and metrics.
+#  
+#  Output Mode may be "quiet", to print errors only, as from cron, 
+#  "progress", to print a line of files and MB archived per second and
+#  the ETA, a few times a second on a terminal and once a minute when 
+#  redirected, or "verbose", the default, to print every file added to
+#  the archive, which slows runs of many small files. The --quiet, 
+#  --progress and --verbose commandline options override it.
+#  
+#  The time taken by each phase of a run, and counts of the files and
+#  bytes scanned, excluded, archived and emailed, are always written to
+#  the log as one "METRICS" line of JSON. This section is optional.
+#  
+#  JSON File, if not empty, is the path of a file the same metrics are
+#  written to after each run, replacing the previous run's.
+#  
+#  Prometheus File, if not empty, is the path of a file the numeric 
+#  metrics are written to in the Prometheus text format. Point it into
+#  the textfile collector folder of the node exporter, with the ".prom"
+#  extension, to chart the runs and alert on failures.
+#  
+#  Profile may be "cProfile", to save the run's profile statistics to 
+#  Profile File, for reading with the pstats module, or "tracemalloc",
+#  to write the peak memory use and the top allocations to it. Both 
+#  slow the run, so leave it empty unless tracking down a slow phase.
+#  
+
+METRICS = {
+                "Output-Mode"       :   "verbose",
+                "JSON-File"         :   "",
+                "Prometheus-File"   :   "",
+                "Profile"           :   "",
+                "Profile-File"      :   "/tmp/beBackupTool.profile",
             }
 
 
@@ -99,6 +376,10 @@ def main_test():
         assert isinstance(bo["Exclude-Extensions"], list)
         assert not len([x for x in bo["Exclude-Extensions"] if not isinstance(x, str)])
         assert not len([x for x in bo["Exclude-Extensions"] if not re.match(r"^\.?[A-Za-z]{2,10}$", x)]), "One or more Exclude-Extensions are incorrect."
+        assert isinstance(bo.get("Exclude-Patterns", []), list)
+        for pt in bo.get("Exclude-Patterns", []):
+            assert isinstance(pt, str) and len(pt) > 0
+            if pt.startswith("re:"): re.compile(pt[3:])
     
     # Tar name
     assert len(TAR_FILE["Name-Stem"]) > 0
@@ -107,14 +388,79 @@ def main_test():
     assert TAR_FILE["Stamp-Format"] == "seconds"
     assert os.path.exists(TAR_FILE["Directory"])
     assert isinstance(TAR_FILE["Delete-Delay"], int) and TAR_FILE["Delete-Delay"] > 0
+    for keepSetting in ("Keep-Daily", "Keep-Weekly", "Keep-Monthly"):
+        assert isinstance(TAR_FILE.get(keepSetting, 0), int) and TAR_FILE.get(keepSetting, 0) >= 0
+    assert isinstance(TAR_FILE.get("Max-Total-MB", 0), (int, float)) and TAR_FILE.get("Max-Total-MB", 0) >= 0
+    assert TAR_FILE.get("Backup-Mode", "full") in ("full", "incremental", "differential")
+    assert isinstance(TAR_FILE.get("Full-Every", 0), int) and TAR_FILE.get("Full-Every", 0) >= 0
+    assert TAR_FILE.get("Codec", "gzip") in ("gzip", "bz2", "xz", "lzma", "none"), "Invalid Codec."
+    assert TAR_FILE.get("Level", None) is None or (isinstance(TAR_FILE["Level"], int) and 0 <= TAR_FILE["Level"] <= 9)
+    assert isinstance(TAR_FILE.get("Store-Incompressible", False), bool)
+    assert isinstance(TAR_FILE.get("Compress-Workers", 1), int) and TAR_FILE.get("Compress-Workers", 1) >= 0
+    assert isinstance(TAR_FILE.get("Scan-Workers", 1), int) and TAR_FILE.get("Scan-Workers", 1) >= 1
+    assert isinstance(TAR_FILE.get("Parallel-Objects", False), bool)
+    assert isinstance(TAR_FILE.get("Seekable", False), bool)
+    assert isinstance(TAR_FILE.get("Checksums", False), bool)
+    assert isinstance(TAR_FILE.get("Require-Verified", False), bool)
+    assert TAR_FILE.get("Checksums", False) or not TAR_FILE.get("Require-Verified", False), "Require-Verified needs Checksums."
+    assert isinstance(TAR_FILE.get("Single-Pass", False), bool)
+    assert isinstance(TAR_FILE.get("Checkpoint-MB", 0), (int, float)) and TAR_FILE.get("Checkpoint-MB", 0) >= 0
+    assert TAR_FILE.get("Backend", "tar") in ("tar", "repository"), "Invalid Backend."
+    assert isinstance(TAR_FILE.get("Chunk-Size-KB", 1024), int) and TAR_FILE.get("Chunk-Size-KB", 1024) >= 16
+    assert isinstance(TAR_FILE.get("Volume-Size-MB", 0), (int, float)) and TAR_FILE.get("Volume-Size-MB", 0) >= 0
     
     # Email
     assert len(EMAIL_PREFS["Address-From"]) > 0
     assert re.match(r"^[A-Za-z0-9_\-\.]+@[A-Za-z0-9_-]+?\.[A-Za-z]{2,10}$", EMAIL_PREFS["Address-From"]), "Invalid email address."
     assert len(EMAIL_PREFS["Address-To"]) > 0
-    assert re.match(r"^[A-Za-z0-9_\-\.]+@[A-Za-z0-9_-]+?\.[A-Za-z]{2,10}$", EMAIL_PREFS["Address-To"]), "Invalid email address."
+    addressesTo = EMAIL_PREFS["Address-To"]
+    if isinstance(addressesTo, str):
+        addressesTo = addressesTo.split(",")
+    for addressTo in addressesTo:
+        assert re.match(r"^[A-Za-z0-9_\-\.]+@[A-Za-z0-9_-]+?\.[A-Za-z]{2,10}$", addressTo.strip()), "Invalid email address."
     assert 0 < len(EMAIL_PREFS["Subject"]) <= 100
     assert 0 < len(EMAIL_PREFS["Body"]) <= 500
+    assert isinstance(EMAIL_PREFS.get("SMTP-Host", "localhost"), str) and len(EMAIL_PREFS.get("SMTP-Host", "localhost")) > 0
+    assert isinstance(EMAIL_PREFS.get("SMTP-Port", 25), int) and 0 <= EMAIL_PREFS.get("SMTP-Port", 25) < 65536
+    assert isinstance(EMAIL_PREFS.get("Outbox-Directory", ""), str)
+    assert isinstance(EMAIL_PREFS.get("Max-Attempts", 10), int) and EMAIL_PREFS.get("Max-Attempts", 10) >= 1
+    
+    # Storage sinks
+    assert isinstance(STORAGE.get("S3-Endpoint", ""), str)
+    if STORAGE.get("S3-Endpoint", ""):
+        assert re.match(r"^https?://[^/]+", STORAGE["S3-Endpoint"]), "Invalid S3-Endpoint."
+        assert len(STORAGE.get("S3-Bucket", "")) > 0
+        assert len(STORAGE.get("S3-Access-Key", "") or os.environ.get("AWS_ACCESS_KEY_ID", "")) > 0
+        assert len(STORAGE.get("S3-Secret-Key", "") or os.environ.get("AWS_SECRET_ACCESS_KEY", "")) > 0
+    assert isinstance(STORAGE.get("Part-Size-MB", 16), (int, float)) and STORAGE.get("Part-Size-MB", 16) >= 5
+    assert isinstance(STORAGE.get("Upload-Workers", 4), int) and STORAGE.get("Upload-Workers", 4) >= 1
+    assert isinstance(STORAGE.get("Stream", False), bool)
+    
+    # Daemon
+    assert isinstance(DAEMON.get("Interval-Minutes", 60), int) and DAEMON.get("Interval-Minutes", 60) >= 1
+    assert isinstance(DAEMON.get("Run-At", []), list)
+    for runAt in DAEMON.get("Run-At", []):
+        assert re.match(r"^([01][0-9]|2[0-3]):[0-5][0-9]$", runAt), "Invalid Run-At time."
+    assert isinstance(DAEMON.get("Watch", True), bool)
+    assert isinstance(DAEMON.get("Max-Changes", 100000), int) and DAEMON.get("Max-Changes", 100000) >= 1
+    assert isinstance(DAEMON.get("Skip-Unchanged", True), bool)
+    
+    # Throttling
+    for rateSetting in ("Max-MBps", "Max-Files-Per-Second", "Max-Load", "Max-Disk-Util"):
+        assert isinstance(THROTTLE.get(rateSetting, 0), (int, float)) and THROTTLE.get(rateSetting, 0) >= 0
+    assert isinstance(THROTTLE.get("Nice", 0), int) and 0 <= THROTTLE.get("Nice", 0) <= 19, "Invalid Nice."
+    assert THROTTLE.get("IO-Class", "") in ("", "best-effort", "idle"), "Invalid IO-Class."
+    assert isinstance(THROTTLE.get("IO-Level", 4), int) and 0 <= THROTTLE.get("IO-Level", 4) <= 7, "Invalid IO-Level."
+    
+    # Output and metrics
+    assert METRICS.get("Output-Mode", "verbose") in ("quiet", "progress", "verbose"), "Invalid Output-Mode."
+    for fileSetting in ("JSON-File", "Prometheus-File"):
+        assert isinstance(METRICS.get(fileSetting, ""), str)
+        if METRICS.get(fileSetting, ""):
+            assert os.path.isdir(os.path.dirname(os.path.abspath(METRICS[fileSetting])))
+    assert METRICS.get("Profile", "") in ("", "cProfile", "tracemalloc"), "Invalid Profile."
+    if METRICS.get("Profile", ""):
+        assert isinstance(METRICS.get("Profile-File", ""), str) and len(METRICS["Profile-File"]) > 0
     print("All config tests passed OK")
     return 0
 
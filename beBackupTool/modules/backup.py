@@ -5,55 +5,406 @@
 Backup functions for reading configuration and saving compressed tar file
 """
 
-import sys, os, time, tarfile
+import sys, os, io, re, stat, time, shutil, tarfile, fnmatch, functools, itertools, queue, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+try:
+    from . import checkpoint, checksums, compress, manifest, progress, seekable, tee, volumes
+except ImportError: # Run as a script for testing
+    import checkpoint, checksums, compress, manifest, progress, seekable, tee, volumes
+
+# Max number of scanned paths waiting to be archived, see prefetch_backup_objects()
+SCAN_QUEUE_SIZE = 10000
+
+# Markers passed through the scan queue
+_OBJECT_END = object()
+_SCAN_END = object()
 
 
 def read_backup_files_config(configBackupPrefs):
     """
     Reads file configuration from passed list of dicts, returning list 
     of lists of file paths
+    
+    The whole scan is held in memory, see iter_backup_objects() for the
+    streaming equivalent
     """
-    backupObjects = []
+    return [list(filesToArchive) for filesToArchive in iter_backup_objects(configBackupPrefs)]
+
+
+def iter_backup_objects(configBackupPrefs, scanWorkers=1, scanStats=None):
+    """
+    Generator version of read_backup_files_config(), yielding a lazy 
+    generator of file paths for each valid backup object
+    
+    The folders are listed with os.scandir() by a pool of *scanWorkers*
+    threads, that work on several folders, across all backup objects, 
+    at once, which pays off on high-latency storage like NFS. Entries 
+    are sorted by name and yielded in the same order whatever the 
+    number of workers, so archives are reproducible
+    
+    The paths are ScannedPath strings, carrying the stat result from 
+    the scan
+    
+    If *scanStats* is a ScanStats object, the scan is counted in it
+    
+    The scan threads are shut down once the last of the generators 
+    yielded is exhausted or closed
+    """
+    validObjects = get_valid_backup_objects(configBackupPrefs)
+    # The generators yielded may still be consumed after this one is 
+    # exhausted, so the last of them to finish shuts the executor down
+    executor = ThreadPoolExecutor(max_workers=max(scanWorkers, 1), thread_name_prefix="backup-scandir")
+    # Start listing all backup folders at once
+    objectRoots = []
+    for bo in validObjects:
+        matcher = ExclusionMatcher(bo)
+        rootPath = strip_trailing_slash(bo["Backup-Folder"])
+        try:
+            rootPath = ScannedPath(rootPath, os.lstat(rootPath))
+        except OSError:
+            pass
+        if matcher.excludes_folder(rootPath):
+            objectRoots.append((matcher, rootPath, None))
+        else:
+            objectRoots.append((matcher, rootPath, executor.submit(scan_folder, rootPath, matcher, scanStats)))
+    unfinishedCount = [len(objectRoots)]
+    if not objectRoots:
+        executor.shutdown(wait=False)
+    for matcher, rootPath, rootFuture in objectRoots:
+        yield ObjectFiles(iter_backup_object_files(executor, matcher, rootPath, rootFuture, scanStats),
+                            executor, unfinishedCount)
+    if scanStats is not None:
+        scanStats.finish()
+
+
+class ObjectFiles(object):
+    """
+    Iterator over the *filesToArchive* generator of one backup object, 
+    which shuts *executor* down once exhausted or closed, if it was the
+    last of the *unfinishedCount* using it. Unlike a generator, it also
+    does so if closed before its first item
+    """
+    
+    def __init__(self, filesToArchive, executor, unfinishedCount):
+        self.filesToArchive = filesToArchive
+        self.executor = executor
+        self.unfinishedCount = unfinishedCount
+        self.closed = False
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        try:
+            return next(self.filesToArchive)
+        except BaseException:
+            self.close()
+            raise
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.filesToArchive.close()
+        self.unfinishedCount[0] -= 1
+        if self.unfinishedCount[0] == 0:
+            # Scans still running after an early close finish on their own
+            self.executor.shutdown(wait=False)
+    
+    def __del__(self):
+        self.close()
+
+
+def get_valid_backup_objects(configBackupPrefs):
+    """
+    Returns list of the backup objects of *configBackupPrefs* whose 
+    backup folder exists
+    """
+    validObjects = []
     for bo in configBackupPrefs:
-        filesToArchive = []
         if not isinstance(bo, dict) \
                 or "Backup-Folder" not in bo \
                 or not bo["Backup-Folder"] \
                 or not os.path.exists(bo["Backup-Folder"]):
             continue
-        for dp, ds, fs in os.walk(bo["Backup-Folder"]):
-            #print("dp:", dp)
-            #print("ds:", ds)
-            #print("fs:", fs)
-            excludeFolder = False
-            for ef in maybe_none(bo, "Exclude-Folders"):
-                if os.path.join(dp, "") == os.path.join(ef, ""):
-                    excludeFolder = True
-                    break
-            if not excludeFolder:
-                # Append non-excluded folder, without trailing slash
-                dp = dp[:-1] if dp[-1] == "/" or dp[-1] == "\\" else dp
-                filesToArchive.append(dp)
-                for f in fs:
-                    excludeFile = False
-                    for efl in maybe_none(bo, "Exclude-Files"):
-                        if os.path.join(dp, f) == efl:
-                            excludeFile = True
-                            break
-                    if not excludeFile:
-                        excludeExt = False
-                        for ex in maybe_none(bo, "Exclude-Extensions"):
-                            ex = ex if ex.startswith(".") else "."+ex
-                            if ex == os.path.splitext(f)[1]:
-                                excludeExt = True
-                                break
-                        if not excludeExt:
-                            # Append non-excluded file
-                            filesToArchive.append(os.path.join(dp, f))
-        #print("Files to archive in '%s':" % bo["Backup-Folder"])
-        #[print("  %s" % x) for x in filesToArchive]
-        backupObjects.append(filesToArchive)
-    return backupObjects
+        validObjects.append(bo)
+    return validObjects
+
+
+def iter_backup_object_files(executor, matcher, rootPath, rootFuture, scanStats=None):
+    """
+    Yields the non-excluded folder and file paths of one backup object, 
+    starting with the backup folder itself at *rootPath*, without 
+    trailing slash, whose listing is the *rootFuture* of scan_folder()
+    
+    Folders are walked depth first, each followed by its files. Once a
+    folder's listing is in, the listings of all its subfolders are 
+    submitted to the *executor*, to run while earlier entries are used
+    """
+    if rootFuture is None:
+        # Backup folder itself excluded
+        return
+    pendingStack = [iter([(rootPath, rootFuture)])]
+    while pendingStack:
+        pending = next(pendingStack[-1], None)
+        if pending is None:
+            pendingStack.pop()
+            continue
+        dirPath, future = pending
+        listing = future.result()
+        if listing is None:
+            # Unreadable folder, skipped like os.walk() does
+            continue
+        filePaths, subdirPaths = listing
+        subdirFutures = [executor.submit(scan_folder, d, matcher, scanStats) for d in subdirPaths]
+        yield dirPath
+        for fp in filePaths:
+            yield fp
+        pendingStack.append(iter(list(zip(subdirPaths, subdirFutures))))
+
+
+def scan_folder(dirPath, matcher, scanStats=None):
+    """
+    Lists folder *dirPath*, returning tuple of sorted lists of the 
+    ScannedPath of its non-excluded files and subfolders, or None if it
+    cannot be read
+    
+    Symlinks, including those to folders, are listed as files. The stat
+    results come from os.DirEntry, so are taken here, in a worker thread
+    
+    If *scanStats* is a ScanStats object, the listing is counted in it,
+    which also stats the excluded files, for their sizes
+    """
+    filePaths = []
+    subdirPaths = []
+    excludedFiles = 0
+    excludedBytes = 0
+    excludedFolders = 0
+    try:
+        with os.scandir(dirPath) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            fp = os.path.join(dirPath, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not matcher.excludes_folder(fp):
+                        subdirPaths.append(ScannedPath(fp, entry.stat(follow_symlinks=False)))
+                    else:
+                        excludedFolders += 1
+                elif not matcher.excludes_file(fp, entry.name):
+                    filePaths.append(ScannedPath(fp, entry.stat(follow_symlinks=False)))
+                elif scanStats is not None:
+                    excludedFiles += 1
+                    excludedBytes += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                # Vanished since listed
+                continue
+    except OSError:
+        if scanStats is not None:
+            scanStats.add(errors=1)
+        return None
+    if scanStats is not None:
+        scanStats.add(folders=1, files=len(filePaths), bytes=sum(fp.stat.st_size for fp in filePaths),
+                        excludedFiles=excludedFiles, excludedBytes=excludedBytes, excludedFolders=excludedFolders)
+    return filePaths, subdirPaths
+
+
+class ScanStats(object):
+    """
+    Counts of a scan, added to by the scan_folder() calls of all scan 
+    threads, and the time from creation to the last folder listed. It
+    is done once iter_backup_objects() is exhausted
+    
+    Files and bytes are of the files kept, not of those excluded, and
+    the files of excluded folders are not counted at all
+    """
+    
+    NAMES = ("folders", "files", "bytes", "excludedFiles", "excludedBytes", "excludedFolders", "errors")
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startTime = time.perf_counter()
+        self.seconds = 0.0
+        self.done = False
+        self.counts = dict((name, 0) for name in self.NAMES)
+    
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+            self.seconds = time.perf_counter() - self.startTime
+    
+    def finish(self):
+        with self.lock:
+            self.done = True
+    
+    def merge(self, statsDict):
+        """
+        Adds counts of dict *statsDict*, as from as_dict() of a scan in 
+        another process, whose seconds are taken as overlapping this one
+        """
+        with self.lock:
+            for name in self.NAMES:
+                self.counts[name] += statsDict.get(name, 0)
+            self.seconds = max(self.seconds, statsDict.get("seconds", 0))
+    
+    def as_dict(self):
+        with self.lock:
+            statsDict = dict(self.counts)
+            statsDict["seconds"] = self.seconds
+            statsDict["done"] = self.done
+        return statsDict
+
+
+class ScannedPath(str):
+    """
+    Path of a scanned file or folder, carrying the os.lstat() result 
+    taken in the scan as its *stat* attribute, so it is not stat'ed 
+    again by the manifest or the archiver
+    """
+    
+    def __new__(cls, path, stat=None):
+        scannedPath = str.__new__(cls, path)
+        scannedPath.stat = stat
+        return scannedPath
+
+
+def prefetch_backup_objects(backupObjects, queueSize=SCAN_QUEUE_SIZE):
+    """
+    Runs the scan of *backupObjects*, as from iter_backup_objects(), in
+    a background thread, feeding a bounded queue of at most *queueSize*
+    paths, so the scan overlaps archiving with flat memory
+    
+    Yields a generator of file paths for each backup object, and these 
+    must be consumed in order. Any exception in the scan is raised by 
+    the consumer
+    """
+    pathQueue = queue.Queue(maxsize=queueSize)
+    stopEvent = threading.Event()
+    
+    def put(item):
+        # Give up if the consumer has stopped, rather than block for ever
+        while not stopEvent.is_set():
+            try:
+                pathQueue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for filesToArchive in backupObjects:
+                for fp in filesToArchive:
+                    if not put(fp): return
+                if not put(_OBJECT_END): return
+            put(_SCAN_END)
+        except Exception as e:
+            put(e)
+    
+    def consume_object(firstItem):
+        item = firstItem
+        while item is not _OBJECT_END:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            item = pathQueue.get()
+    
+    producer = threading.Thread(target=produce, name="backup-scan", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = pathQueue.get()
+            if item is _SCAN_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield consume_object(item)
+    finally:
+        stopEvent.set()
+
+
+class ExclusionMatcher(object):
+    """
+    Exclusion settings of one backup object, compiled once for its scan
+    
+    Exact folders, files and extensions are held in sets. Any 
+    "Exclude-Patterns" are combined into one regex tested against names
+    and one tested against full paths. A pattern is an fnmatch glob, 
+    matched against the name unless it contains a slash, or a regex if 
+    prefixed with "re:", matched from the start of the full path
+    """
+    
+    def __init__(self, bo):
+        self.folders = set(strip_trailing_slash(x) for x in maybe_none(bo, "Exclude-Folders"))
+        self.files = set(maybe_none(bo, "Exclude-Files"))
+        self.extensions = set(x if x.startswith(".") else "."+x for x in maybe_none(bo, "Exclude-Extensions"))
+        namePatterns = []
+        pathPatterns = []
+        self.patterns = []
+        for pt in maybe_none(bo, "Exclude-Patterns"):
+            if pt.startswith("re:"):
+                pathPatterns.append("(?:%s)" % pt[3:])
+            elif "/" in pt:
+                pathPatterns.append("(?:%s)" % fnmatch.translate(pt))
+            else:
+                namePatterns.append("(?:%s)" % fnmatch.translate(pt))
+            self.patterns.append((pt, not pt.startswith("re:") and "/" not in pt))
+        self.nameRegex = re.compile("|".join(namePatterns)) if namePatterns else None
+        self.pathRegex = re.compile("|".join(pathPatterns)) if pathPatterns else None
+    
+    def excludes_folder(self, dirPath):
+        """
+        Returns bool whether folder *dirPath*, without trailing slash, 
+        and so all of its contents, is excluded
+        """
+        return dirPath in self.folders or self.matches_pattern(dirPath, os.path.basename(dirPath))
+    
+    def excludes_file(self, filePath, fileName):
+        """
+        Returns bool whether file *filePath*, named *fileName*, is excluded
+        """
+        return filePath in self.files \
+                or os.path.splitext(fileName)[1] in self.extensions \
+                or self.matches_pattern(filePath, fileName)
+    
+    def matches_pattern(self, path, name):
+        """
+        Returns bool whether *path* or its *name* matches an exclusion pattern
+        """
+        if self.nameRegex is not None and self.nameRegex.match(name):
+            return True
+        if self.pathRegex is not None and self.pathRegex.match(path):
+            return True
+        return False
+    
+    def find_rule(self, path, name, isFolder=False):
+        """
+        Returns tuple of the setting and the value of the first exclusion
+        rule that excludes *path*, named *name*, a folder if *isFolder*,
+        or None. The patterns are compiled one by one, so this is for 
+        reporting, once the path is known to be excluded
+        """
+        if isFolder and path in self.folders:
+            return "Exclude-Folders", path
+        if not isFolder and path in self.files:
+            return "Exclude-Files", path
+        if not isFolder and os.path.splitext(name)[1] in self.extensions:
+            return "Exclude-Extensions", os.path.splitext(name)[1]
+        for pt, byName in self.patterns:
+            regex = re.compile(pt[3:] if pt.startswith("re:") else fnmatch.translate(pt))
+            if regex.match(name if byName else path):
+                return "Exclude-Patterns", pt
+        return None
+
+
+def strip_trailing_slash(path):
+    """
+    Returns *path* without any trailing slash, unless it is the root
+    """
+    stripped = path.rstrip("/\\")
+    return stripped if stripped else path
 
 
 def maybe_none(tDict, tItem):
@@ -66,13 +417,14 @@ def maybe_none(tDict, tItem):
     return tDict[tItem]
 
 
-def create_tar_filepath(tarDir, tarNameStem, tarUseTimestamp, tarStampFormat):
+def create_tar_filepath(tarDir, tarNameStem, tarUseTimestamp, tarStampFormat, tarExtension=".tgz"):
     """
-    Creates tar filepath using tar file configuration
+    Creates tar filepath using tar file configuration, with the file 
+    extension of the compression codec
     """
     tms = get_timestamp_for_tarfile(tarUseTimestamp, tarStampFormat)
     if tms: tms = "_" + tms
-    tarPath = os.path.join(tarDir, tarNameStem + tms + ".tgz")
+    tarPath = os.path.join(tarDir, tarNameStem + tms + tarExtension)
     return tarPath
 
 
@@ -89,88 +441,756 @@ def get_timestamp_for_tarfile(tarUseTimestamp, tarStampFormat):
     else: return notime
 
 
-def delete_old_tarfiles(tarDir, tarNameStem, tarDeleteDelay):
+def write_tar_file(backupObjects, tarFilePath, extraMembers=None, compressWorkers=1,
+                                    codec="gzip", level=None, volumeSize=0, tarStats=None, reporter=None,
+                                    compressPolicy=None, seekableArchive=False, checksumArchive=False,
+                                    outFile=None, extraOutputs=None, throttle=None):
     """
-    Deletes old tarfiles according to prefs, returns report of num of deletions or error
+    Writes backup files to compressed tar file
+    
+    Documentation is not quite clear on the closing of tar files, so we
+    handle this with caution
+    
+    The *backupObjects* parameter is assumed to be obtained from the 
+    read_backup_files_config() function and cannot cause an error. The
+    lists may also be lazy iterables, as from iter_backup_objects() or
+    prefetch_backup_objects(), and are then archived as they are scanned
+    
+    The *extraMembers* parameter may be a callable returning a list of 
+    (archive name, bytes) tuples, called after the backup files are 
+    added, to append generated members such as the deletions list of an
+    incremental run
+    
+    The *compressWorkers* parameter sets the number of threads that 
+    compress the tar stream in parallel, with the *codec* at *level*,
+    see compress.CompressWriter
+    
+    If *volumeSize* is greater than 0, the compressed archive is split
+    into numbered volumes of at most that many bytes, with an index, see
+    volumes.VolumeWriter
+    
+    If *tarStats* is a dict, it is given the number of "members" and the
+    "uncompressedBytes" and "compressedBytes" of the archive
+    
+    The members added are reported to *reporter*, a ProgressReporter, 
+    which by default prints each of them
+    
+    If *compressPolicy* is a compress.CompressPolicy, the files it finds
+    incompressible are stored instead, see add_tar_member()
+    
+    If *seekableArchive* is True, a member index is written next to the
+    archive, for restoring single files, see seekable.restore_members()
+    
+    If *checksumArchive* is True, the SHA-256 checksums of the members 
+    and of the compressed archive are taken as it is written, saved next
+    to it, and the archive checksum given to *tarStats* as "sha256", see
+    checksums.verify_archive()
+    
+    If *outFile* is given, the compressed archive is written to that file
+    object, like a sinks.S3Sink stream, instead of to *tarFilePath*, and
+    closed, or aborted on error if it has an abort() method
+    
+    The *extraOutputs* parameter may be a list of file objects also given
+    the compressed archive as it is written, like an S3Sink stream or a
+    sendEmail.EmailStreamWriter, and closed or aborted the same way, see
+    open_archive_tee(). One failing does not fail the archive, and if 
+    *tarStats* is a dict, it is given their "outputErrors", in order, 
+    empty for those that did not fail
+    
+    If *throttle* is a throttle.Throttle, the files are read at its pace
+    
+    Return value is a tuple of tar file path and any error message
     """
-    # Get old tar files
-    if not os.path.exists(tarDir):
-        return "ERROR: Directory for tar files does not exist"
-    deletedCount = 0
-    for dp, ds, fs in os.walk(tarDir): # TODO scandir()
-        for f in fs:
-            if f.startswith(tarNameStem):
-                try:
-                    fb, fx = os.path.splitext(f)
-                    if fx != ".tgz":
-                        continue
-                    # Only delete if timestamp is used as part of file name, otherwise
-                    # assume that tar files are overwritten on each save
-                    fts = int(fb.rsplit("_", maxsplit=1)[1])
-                except Exception:
-                    continue
-                if is_time_to_delete_tar(tarDeleteDelay, fts):
-                    # Delete file
-                    try:
-                        os.remove(os.path.join(dp, f))
-                    except Exception:
-                        # If we can't delete a file, we might as well bail
-                        return "ERROR: file '%s' could not be deleted" % os.path.join(dp, f)
-                    deletedCount += 1
-            else:
-                continue
-        break
-    return "Number of old tar files deleted: %d" % deletedCount
+    returnError = ""
+    if reporter is None:
+        reporter = progress.ProgressReporter("verbose")
+    memberIndex = seekable.MemberIndex() if seekableArchive else None
+    archiveSums = checksums.ArchiveSums(compress.get_codec(codec)) if checksumArchive else None
+    # Write the file
+    archiveFile = outFile
+    try:
+        if outFile is None:
+            outFile = archiveFile = open_archive_output(tarFilePath, volumeSize)
+        archiveFile, hashingFile = open_archive_tee(outFile, checksumArchive, extraOutputs)
+        compressor = compress.CompressWriter(archiveFile, codec=codec, level=level, workers=compressWorkers)
+        tar = tarfile.open(fileobj=compressor, mode="w")
+        for filesToArchive in backupObjects:
+            add_backup_object(tar, filesToArchive, tarFilePath, reporter, compressPolicy, memberIndex, archiveSums,
+                                                                                                        throttle)
+        add_extra_members(tar, extraMembers, archiveSums)
+    except Exception as e:
+        reporter.error(str(e))
+        returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    finally: # Always runs
+        try: tar.close()
+        except Exception: pass
+        try: compressor.close()
+        except Exception as e:
+            if not returnError:
+                returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        if tarStats is not None and not returnError:
+            tarStats["members"] = tarStats.get("members", 0) + len(tar.members)
+            tarStats["uncompressedBytes"] = tarStats.get("uncompressedBytes", 0) + compressor.tell()
+            tarStats["compressedBytes"] = tarStats.get("compressedBytes", 0) + archiveFile.tell()
+        returnError = close_archive_output(archiveFile, returnError, extraOutputs, tarStats)
+    if not returnError:
+        try:
+            if memberIndex is not None:
+                seekable.save_member_index(tarFilePath, compressor.codec, memberIndex.get_entries(compressor.flushPoints))
+            if archiveSums is not None:
+                save_archive_sums(tarFilePath, archiveSums, hashingFile, tarStats)
+        except Exception:
+            returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    return tarFilePath, returnError
 
 
-def is_time_to_delete_tar(deleteDelay, fileTimestamp):
+def save_archive_sums(tarFilePath, archiveSums, hashingFile, tarStats=None):
     """
-    Returns bool whether *fileTimestamp* is old enough for deletion 
-    specified with *deleteDelay*
+    Saves *archiveSums* of the archive at *tarFilePath*, with the 
+    checksum and size of the compressed data written to *hashingFile*, 
+    a checksums.HashingWriter, giving the checksum to *tarStats* if a 
+    dict
     """
-    ddsecs = deleteDelay * 24 * 60 * 60
-    secsNow = int(time.time())
-    deletableTime = secsNow - ddsecs
-    if fileTimestamp <= deletableTime: return True
-    else: return False
+    archiveSums.sha256 = hashingFile.hexdigest()
+    archiveSums.size = hashingFile.tell()
+    checksums.save_sums(tarFilePath, archiveSums)
+    if tarStats is not None:
+        tarStats["sha256"] = archiveSums.sha256
 
 
-def write_tar_file(backupObjects, tarFilePath):
+def write_tar_file_parallel(configBackupPrefs, tarFilePath, extraMembers=None, processes=1,
+                            codec="gzip", level=None, volumeSize=0, scanWorkers=1,
+                            baseEntries=None, newEntries=None, scanStats=None, tarStats=None,
+                            reporter=None, compressPolicy=None, seekableArchive=False, checksumArchive=False,
+                            outFile=None, extraOutputs=None, throttle=None):
     """
-    Writes backup files to compressed tar file
+    Writes backup files to compressed tar file like write_tar_file(), 
+    but archives each backup object of *configBackupPrefs* in its own 
+    worker process, up to *processes* at once
     
-    Documentation is not quite clear on the closing of tar files, so we
-    handle this with caution
+    Each worker scans its backup object and writes its tar members, 
+    compressed, without the end-of-archive marker, to a segment file 
+    next to the archive. The segments are then concatenated in order, 
+    followed by the extra members and the end-of-archive marker, as a 
+    valid archive of concatenated gzip members or bz2 or xz streams
     
-    The *backupObjects* parameter is assumed to be obtained from the 
-    read_backup_files_config() function and cannot cause an error
+    If *baseEntries* is given, only files new or changed since then are
+    archived, and *newEntries* is updated with the scanned entries, as 
+    by manifest.filter_changed_files()
+    
+    The counts of the scans in the workers are added to *scanStats*, and
+    *tarStats* is filled as by write_tar_file()
+    
+    The workers print each member only if *reporter* is in verbose mode,
+    and otherwise each backup object is reported as it is done
+    
+    The workers store files as chosen by a copy of *compressPolicy*, and
+    their counts of stored files are added to it
+    
+    If *seekableArchive* is True, the member indexes of the segments are
+    joined into one for the archive
+    
+    If *checksumArchive* is True, the member checksums of the segments
+    are joined, and the archive checksum taken as they are copied in
+    
+    The archive is written to *outFile* instead, if given, and to the
+    *extraOutputs* too, as by write_tar_file()
+    
+    If *throttle* is a throttle.Throttle, each worker reads its files at
+    its share of the rates, and the time the workers paused is added to
+    its "sleptSeconds"
     
     Return value is a tuple of tar file path and any error message
     """
-    origCWD = os.getcwd()
     returnError = ""
-    # Write the file
+    if reporter is None:
+        reporter = progress.ProgressReporter("verbose")
+    archiveSums = checksums.ArchiveSums(compress.get_codec(codec)) if checksumArchive else None
+    validPrefs = [bo for bo in configBackupPrefs if isinstance(bo, dict) and bo.get("Backup-Folder")]
+    segmentPaths = ["%s.segment%03d.tmp" % (tarFilePath, n) for n in range(len(validPrefs))]
+    outputsUsed = False
+    workers = max(1, min(processes, len(validPrefs)))
+    throttleShare = throttle.get_share(workers) if throttle is not None else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(write_tar_segment, bo, segmentPath, tarFilePath, codec, level, scanWorkers,
+                                        _select_entries(baseEntries, bo["Backup-Folder"]), reporter.mode,
+                                        compressPolicy, seekableArchive, checksumArchive, throttleShare)
+                        for bo, segmentPath in zip(validPrefs, segmentPaths)]
+            for doneCount, future in enumerate(as_completed(futures), 1):
+                segmentStats = future.result()[2]
+                reporter.add_counts(segmentStats["files"], segmentStats["fileBytes"])
+                if compressPolicy is not None:
+                    compressPolicy.storedFiles += segmentStats["storedFiles"]
+                    compressPolicy.storedBytes += segmentStats["storedBytes"]
+                if throttle is not None:
+                    throttle.sleptSeconds += segmentStats["throttleSeconds"]
+                if reporter.mode != "verbose":
+                    reporter.message("Archived %d of %d backup objects" % (doneCount, len(futures)))
+            results = [f.result() for f in futures]
+        if scanStats is not None:
+            scanStats.finish()
+        for segmentEntries, segmentError, segmentStats in results:
+            if segmentError:
+                raise RuntimeError(segmentError)
+            if newEntries is not None:
+                newEntries.update(segmentEntries)
+            if scanStats is not None:
+                scanStats.merge(segmentStats["scan"])
+            if tarStats is not None:
+                for name in ("members", "uncompressedBytes"):
+                    tarStats[name] = tarStats.get(name, 0) + segmentStats[name]
+            if archiveSums is not None:
+                archiveSums.members.update(segmentStats["sums"])
+        outputsUsed = True
+        join_tar_segments([(p, r[2]["seekIndex"]) for p, r in zip(segmentPaths, results)], tarFilePath, extraMembers,
+                            codec, level, volumeSize, tarStats, archiveSums, seekableArchive, outFile, extraOutputs)
+    except Exception as e:
+        reporter.error(str(e))
+        returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    finally: # Always runs
+        if not outputsUsed:
+            # Failed before the archive was written to its outputs
+            tee.abort_outputs([x for x in [outFile] + list(extraOutputs or []) if x is not None])
+        for segmentPath in segmentPaths:
+            try: os.remove(segmentPath)
+            except Exception: pass
+    return tarFilePath, returnError
+
+
+def join_tar_segments(segments, tarFilePath, extraMembers=None, codec="gzip", level=None, volumeSize=0,
+                        tarStats=None, archiveSums=None, seekableArchive=False, outFile=None, extraOutputs=None):
+    """
+    Writes the archive from *segments*, list of tuples of the path of a
+    segment of compressed tar members and of the member index entries 
+    of the segment, relative to its start, concatenated in order and 
+    followed by the extra members and the end-of-archive marker
+    
+    The archive is written to *tarFilePath*, or *outFile* and the 
+    *extraOutputs*, with the member index and the *archiveSums*, if 
+    given, saved next to it, and *tarStats* given the counts of the extra
+    members and the "compressedBytes", as by write_tar_file()
+    
+    Raises an exception on error, having aborted the outputs
+    """
+    archiveFile = None
+    try:
+        if outFile is None:
+            outFile = open_archive_output(tarFilePath, volumeSize)
+        archiveFile, hashingFile = open_archive_tee(outFile, archiveSums is not None, extraOutputs)
+    finally:
+        if archiveFile is None:
+            tee.abort_outputs([x for x in [outFile] + list(extraOutputs or []) if x is not None])
+    indexEntries = []
+    outError = ""
+    try:
+        for segmentPath, seekIndex in segments:
+            # Member offsets are relative to the segment
+            if seekableArchive:
+                compressedBase = archiveFile.tell()
+                indexEntries.extend([e[0], e[1] + compressedBase, e[2], e[3]] for e in seekIndex)
+            with open(segmentPath, "rb") as fp:
+                shutil.copyfileobj(fp, archiveFile, 1024 * 1024)
+        # Extra members and end-of-archive marker, as the last segment
+        compressor = compress.CompressWriter(archiveFile, codec=codec, level=level)
+        tar = tarfile.open(fileobj=compressor, mode="w")
+        add_extra_members(tar, extraMembers, archiveSums)
+        tar.close()
+        compressor.close()
+        if tarStats is not None:
+            tarStats["members"] = tarStats.get("members", 0) + len(tar.members)
+            tarStats["uncompressedBytes"] = tarStats.get("uncompressedBytes", 0) + compressor.tell()
+            tarStats["compressedBytes"] = tarStats.get("compressedBytes", 0) + archiveFile.tell()
+    except Exception:
+        outError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        raise
+    finally:
+        outError = close_archive_output(archiveFile, outError, extraOutputs, tarStats)
+    if outError:
+        raise RuntimeError(outError)
+    if seekableArchive:
+        seekable.save_member_index(tarFilePath, compress.get_codec(codec), indexEntries)
+    if archiveSums is not None:
+        save_archive_sums(tarFilePath, archiveSums, hashingFile, tarStats)
+
+
+def write_tar_segment(bo, segmentPath, tarFilePath, codec, level, scanWorkers, baseEntries, outputMode="verbose",
+                                compressPolicy=None, seekableArchive=False, checksumArchive=False, throttle=None):
+    """
+    Writes the compressed tar members of backup object *bo* to 
+    *segmentPath*, without the end-of-archive marker, for 
+    write_tar_file_parallel(), in a worker process
+    
+    Returns tuple of dict of scanned manifest entries, if *baseEntries*
+    is not None, any error message, and dict of the segment's "scan" 
+    counts, tar "members" and "uncompressedBytes", the "files" and 
+    "fileBytes" added, the "storedFiles" and "storedBytes" of them 
+    stored as chosen by *compressPolicy*, if *seekableArchive* is True,
+    the "seekIndex" entries of the segment, and if *checksumArchive* is
+    True, the "sums" of its members, and the "throttleSeconds" paused by
+    *throttle*, if given
+    
+    Members are printed only if *outputMode* is "verbose", and other 
+    modes are quiet, as reporting is left to the parent process
+    """
+    newEntries = {}
+    reporter = progress.ProgressReporter("verbose" if outputMode == "verbose" else "quiet")
+    scanStats = ScanStats()
+    segmentStats = {"scan": {}, "members": 0, "uncompressedBytes": 0, "files": 0, "fileBytes": 0,
+                    "storedFiles": 0, "storedBytes": 0, "seekIndex": [], "sums": {}, "throttleSeconds": 0.0}
+    memberIndex = seekable.MemberIndex() if seekableArchive else None
+    archiveSums = checksums.ArchiveSums() if checksumArchive else None
+    try:
+        with open(segmentPath, "wb") as outFile:
+            compressor = compress.CompressWriter(outFile, codec=codec, level=level)
+            # The tar file is deliberately not closed, as that would end the archive
+            tar = tarfile.open(fileobj=compressor, mode="w")
+            backupObjects = iter_backup_objects([bo], scanWorkers, scanStats)
+            if baseEntries is not None:
+                backupObjects = manifest.filter_changed_files(backupObjects, baseEntries, newEntries)
+            for filesToArchive in backupObjects:
+                add_backup_object(tar, filesToArchive, tarFilePath, reporter, compressPolicy, memberIndex, archiveSums,
+                                                                                                        throttle)
+            compressor.close()
+            segmentStats["members"] = len(tar.members)
+            segmentStats["uncompressedBytes"] = compressor.tell()
+            segmentStats["files"] = reporter.files
+            segmentStats["fileBytes"] = reporter.bytes
+            if compressPolicy is not None:
+                segmentStats["storedFiles"] = compressPolicy.storedFiles
+                segmentStats["storedBytes"] = compressPolicy.storedBytes
+            if memberIndex is not None:
+                segmentStats["seekIndex"] = memberIndex.get_entries(compressor.flushPoints)
+            if archiveSums is not None:
+                segmentStats["sums"] = archiveSums.members
+            if throttle is not None:
+                segmentStats["throttleSeconds"] = throttle.sleptSeconds
+    except Exception as e:
+        return newEntries, "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1]), segmentStats
+    segmentStats["scan"] = scanStats.as_dict()
+    return newEntries, "", segmentStats
+
+
+def write_tar_file_checkpointed(backupObjects, tarFilePath, checkpointDir, segmentSize, runKey=None,
+                                extraMembers=None, compressWorkers=1, codec="gzip", level=None, volumeSize=0,
+                                tarStats=None, reporter=None, compressPolicy=None, seekableArchive=False,
+                                checksumArchive=False, outFile=None, extraOutputs=None, throttle=None):
+    """
+    Writes backup files to compressed tar file like write_tar_file(), but
+    in segments of about *segmentSize* uncompressed bytes, each sealed in
+    the journal in *checkpointDir* once written, see checkpoint.Journal,
+    then joined into the archive
+    
+    If a run with the same settings, and the same dict *runKey* of the 
+    caller's, like the backup type, was interrupted, the segments it 
+    sealed are kept. Of the files in them, only those changed since are
+    added again, to later segments, so they replace the earlier copies 
+    on extraction. Files deleted since are still in the archive
+    
+    The checkpoint folder is deleted once the archive is complete, and 
+    kept on error, for the next run to resume from
+    
+    The other parameters are as for write_tar_file()
+    
+    Return value is a tuple of tar file path and any error message
+    """
+    returnError = ""
+    if reporter is None:
+        reporter = progress.ProgressReporter("verbose")
+    archiveSums = checksums.ArchiveSums(compress.get_codec(codec)) if checksumArchive else None
+    runKey = dict(runKey or {}, **{"Codec": compress.get_codec(codec), "Level": compress.get_level(codec, level),
+                                    "Seekable": bool(seekableArchive), "Checksums": bool(checksumArchive),
+                                    "Store-Incompressible": compressPolicy is not None})
+    checkpointPrefix = os.path.join(os.path.abspath(checkpointDir), "")
+    segment = None
+    outputsUsed = False
+
+    def get_counts():
+        return [reporter.files, reporter.bytes] + ([compressPolicy.storedFiles, compressPolicy.storedBytes]
+                                                    if compressPolicy is not None else [0, 0])
+
+    def seal_segment():
+        segmentStats = segment.close()
+        for name, count, startCount in zip(("files", "fileBytes", "storedFiles", "storedBytes"), get_counts(),
+                                            segment.startCounts):
+            segmentStats[name] = count - startCount
+        journal.seal(segment.segmentPath, segment.entries, segmentStats)
+
     try:
-        tar = tarfile.open(tarFilePath, "w:gz")
+        journal = checkpoint.Journal(checkpointDir, runKey)
+        sealedEntries = journal.get_entries()
+        for sealed in journal.segments:
+            reporter.add_counts(sealed["stats"]["files"], sealed["stats"]["fileBytes"])
+            if compressPolicy is not None:
+                compressPolicy.storedFiles += sealed["stats"]["storedFiles"]
+                compressPolicy.storedBytes += sealed["stats"]["storedBytes"]
+        if journal.resumed:
+            reporter.message("Resuming from checkpoint of %d segments, %d files archived already"
+                                % (len(journal.segments), len(sealedEntries)))
+        # Hard links to files archived in earlier segments of the run
+        inodes = {}
         for filesToArchive in backupObjects:
-            # Wrestle the containing dir of the backup dir from its (non)slashed path
-            bkpDirContainer = os.path.dirname(os.path.dirname(os.path.join(filesToArchive[0], "")))
-            os.chdir(bkpDirContainer)
-            print("Adding backup files in '%s':" % bkpDirContainer)
-            for fName in filesToArchive:
-                relfName = os.path.relpath(fName)
-                tar.add(relfName, recursive=False)
-                print("  %s" % relfName)
+            for fName, arcName, statResult in iter_object_members(filesToArchive, tarFilePath, reporter):
+                if fName.startswith(checkpointPrefix):
+                    continue
+                entry = manifest.stat_entry(fName)
+                if entry is not None and sealedEntries.get(fName) == entry:
+                    # Sealed by an interrupted run, and unchanged since
+                    continue
+                if segment is not None and segment.compressor.tell() >= segmentSize:
+                    seal_segment()
+                    segment = None
+                if segment is None:
+                    segment = TarSegment(journal.new_segment_path(), codec, level, compressWorkers,
+                                            seekableArchive, checksumArchive, inodes)
+                    segment.startCounts = get_counts()
+                if add_tar_member(segment.tar, fName, arcName, statResult, compressPolicy, segment.memberIndex,
+                                                                                segment.archiveSums, throttle):
+                    reporter.add_member(arcName, statResult.st_size if statResult is not None and stat.S_ISREG(statResult.st_mode) else 0)
+                    segment.entries[fName] = entry
+        if segment is not None:
+            seal_segment()
+            segment = None
+        for sealed in journal.segments:
+            if tarStats is not None:
+                for name in ("members", "uncompressedBytes"):
+                    tarStats[name] = tarStats.get(name, 0) + sealed["stats"][name]
+            if archiveSums is not None:
+                archiveSums.members.update(sealed["stats"]["sums"])
+        outputsUsed = True
+        join_tar_segments([(journal.get_segment_path(x), x["stats"]["seekIndex"]) for x in journal.segments],
+                            tarFilePath, extraMembers, codec, level, volumeSize, tarStats, archiveSums,
+                            seekableArchive, outFile, extraOutputs)
+        journal.discard()
     except Exception as e:
-        print(e)
+        reporter.error(str(e))
         returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
     finally: # Always runs
-        try: tar.close()
-        except Exception: pass
-        os.chdir(origCWD)
+        if segment is not None:
+            # Left unsealed, to be deleted by the next run
+            segment.abort()
+        if not outputsUsed:
+            tee.abort_outputs([x for x in [outFile] + list(extraOutputs or []) if x is not None])
     return tarFilePath, returnError
 
 
+class TarSegment(object):
+    """
+    Tar members compressed with *codec* at *level*, by *compressWorkers*
+    threads, to the file *segmentPath*, without the end-of-archive 
+    marker, recording their index if *seekableArchive* and checksums if
+    *checksumArchive*, see write_tar_file_checkpointed()
+    
+    The dict *inodes* of hard link targets is shared by the segments of 
+    a run. The *entries* of the files added are collected by the caller
+    """
+    
+    def __init__(self, segmentPath, codec, level, compressWorkers=1, seekableArchive=False, checksumArchive=False,
+                                                                                                    inodes=None):
+        self.segmentPath = segmentPath
+        self.outFile = open(segmentPath, "wb")
+        self.compressor = compress.CompressWriter(self.outFile, codec=codec, level=level, workers=compressWorkers)
+        # The tar file is deliberately not closed, as that would end the archive
+        self.tar = tarfile.open(fileobj=self.compressor, mode="w")
+        if inodes is not None:
+            self.tar.inodes = inodes
+        self.memberIndex = seekable.MemberIndex() if seekableArchive else None
+        self.archiveSums = checksums.ArchiveSums() if checksumArchive else None
+        self.entries = {}
+    
+    def close(self):
+        """
+        Finishes the segment, synced to disk, returning dict of its tar
+        "members" and "uncompressedBytes", its "seekIndex" entries and the
+        "sums" of its members
+        """
+        self.compressor.close()
+        self.outFile.flush()
+        os.fsync(self.outFile.fileno())
+        self.outFile.close()
+        return {
+                    "members"           :   len(self.tar.members),
+                    "uncompressedBytes" :   self.compressor.tell(),
+                    "seekIndex"         :   self.memberIndex.get_entries(self.compressor.flushPoints)
+                                                if self.memberIndex is not None else [],
+                    "sums"              :   self.archiveSums.members if self.archiveSums is not None else {},
+                }
+    
+    def abort(self):
+        try: self.compressor.close()
+        except Exception: pass
+        self.outFile.close()
+
+
+def _select_entries(entries, folderPath):
+    """
+    Returns the manifest entries under *folderPath*, or None
+    """
+    if entries is None:
+        return None
+    folderPath = strip_trailing_slash(folderPath)
+    prefix = os.path.join(folderPath, "")
+    return dict((fp, e) for fp, e in entries.items() if fp == folderPath or fp.startswith(prefix))
+
+
+def open_archive_output(tarFilePath, volumeSize):
+    """
+    Returns file object to write the compressed archive to, split into
+    volumes if *volumeSize* is greater than 0
+    """
+    if volumeSize > 0:
+        return volumes.VolumeWriter(tarFilePath, volumeSize)
+    return open(tarFilePath, "wb")
+
+
+def open_archive_tee(outFile, checksumArchive=False, extraOutputs=None):
+    """
+    Returns tuple of file object to write the compressed archive to, and
+    the checksums.HashingWriter taking its checksum if *checksumArchive*
+    is True, or else None
+    
+    Unless *outFile* is the only output, the archive is teed to it, the
+    HashingWriter and the *extraOutputs*, written concurrently, see
+    tee.TeeWriter, and only the first two are required
+    """
+    hashingFile = checksums.HashingWriter() if checksumArchive else None
+    outputs = [outFile] + ([hashingFile] if hashingFile is not None else []) + list(extraOutputs or [])
+    if len(outputs) == 1:
+        return outFile, None
+    return tee.TeeWriter(outputs, requiredCount=len(outputs) - len(extraOutputs or [])), hashingFile
+
+
+def close_archive_output(outFile, returnError="", extraOutputs=None, tarStats=None):
+    """
+    Closes the archive *outFile*, or aborts it if there is *returnError*
+    and it can be, returning *returnError* or else any error closing it
+    
+    If *outFile* is from open_archive_tee(), the errors of its 
+    *extraOutputs* are given to *tarStats* as "outputErrors", and if 
+    not, as the archive failed before they were teed, they are aborted
+    """
+    try:
+        if returnError and hasattr(outFile, "abort"):
+            outFile.abort()
+        else:
+            outFile.close()
+    except Exception:
+        if not returnError:
+            returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    if extraOutputs:
+        if isinstance(outFile, tee.TeeWriter):
+            outputErrors = outFile.errors[-len(extraOutputs):]
+        else:
+            tee.abort_outputs(extraOutputs)
+            outputErrors = [returnError] * len(extraOutputs)
+        if tarStats is not None:
+            tarStats["outputErrors"] = outputErrors
+    return returnError
+
+
+def add_backup_object(tar, filesToArchive, tarFilePath, reporter=None, compressPolicy=None, memberIndex=None,
+                                                                                archiveSums=None, throttle=None):
+    """
+    Adds the files of one backup object to *tar*, with member names 
+    relative to the folder containing the backup folder, which is the 
+    first of *filesToArchive*
+    
+    The archive at *tarFilePath* is skipped if it is in the backup folder
+    
+    Each member added is counted by *reporter*, a ProgressReporter, which
+    by default prints it
+    
+    Files are stored or compressed as chosen by *compressPolicy*, if given,
+    and recorded in *memberIndex*, a seekable.MemberIndex, and their 
+    checksums in *archiveSums*, a checksums.ArchiveSums, if given, and 
+    read at the pace of *throttle*, a throttle.Throttle, if given
+    """
+    if reporter is None:
+        reporter = progress.ProgressReporter("verbose")
+    for fName, arcName, statResult in iter_object_members(filesToArchive, tarFilePath, reporter):
+        if add_tar_member(tar, fName, arcName, statResult, compressPolicy, memberIndex, archiveSums, throttle):
+            reporter.add_member(arcName, statResult.st_size if statResult is not None and stat.S_ISREG(statResult.st_mode) else 0)
+
+
+def iter_object_members(filesToArchive, tarFilePath, reporter):
+    """
+    Yields tuple of the path, member name and any stat result from the 
+    scan of each of the files of one backup object, for add_backup_object(),
+    skipping the archive at *tarFilePath*, and reporting the folder the
+    names are relative to to *reporter*
+    """
+    tarFileAbsPath = os.path.abspath(tarFilePath)
+    filesIter = iter(filesToArchive)
+    firstFile = next(filesIter, None)
+    if firstFile is None:
+        # Backup folder itself excluded
+        return
+    # Wrestle the containing dir of the backup dir from its (non)slashed path
+    bkpDirContainer = os.path.dirname(os.path.dirname(os.path.join(firstFile, "")))
+    reporter.detail("Adding backup files in '%s':" % bkpDirContainer)
+    for fName in itertools.chain([firstFile], filesIter):
+        if fName == tarFileAbsPath:
+            # Don't archive the archive
+            continue
+        yield fName, os.path.relpath(fName, bkpDirContainer), fName.stat if isinstance(fName, ScannedPath) else None
+
+
+def add_extra_members(tar, extraMembers, archiveSums=None):
+    """
+    Adds the generated members returned by the *extraMembers* callable,
+    if not None, to *tar*, recording their checksums in *archiveSums* if
+    given
+    """
+    if extraMembers is None:
+        return
+    for arcName, data in extraMembers():
+        tarInfo = tarfile.TarInfo(arcName)
+        tarInfo.size = len(data)
+        tarInfo.mtime = int(time.time())
+        if archiveSums is not None:
+            archiveSums.add_member(tar, tarInfo, io.BytesIO(data))
+        else:
+            tar.addfile(tarInfo, io.BytesIO(data))
+
+
+def read_sample_tar(backupObjects, maxBytes):
+    """
+    Returns bytes of an uncompressed tar stream of the first files of 
+    *backupObjects*, of about *maxBytes* in size, as a sample for 
+    comparing compression codecs
+    """
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w") as tar:
+        for filesToArchive in backupObjects:
+            for fName in filesToArchive:
+                if out.tell() >= maxBytes:
+                    break
+                try:
+                    tar.add(fName, arcname=fName.lstrip("/"), recursive=False)
+                except OSError:
+                    continue
+    return out.getvalue()
+
+
+def add_tar_member(tar, filePath, arcName, statResult=None, compressPolicy=None, memberIndex=None,
+                                                                        archiveSums=None, throttle=None):
+    """
+    Adds file or folder *filePath* to *tar* as *arcName*, without its 
+    contents if a folder, like tar.add(filePath, arcName, recursive=False)
+    but using *statResult* from the scan if given, instead of another
+    os.lstat() call
+    
+    If *compressPolicy* finds the file incompressible, and *tar* writes 
+    to a compress.CompressWriter, the member is written at the codec's 
+    store level, in its own gzip member or bz2 or xz stream
+    
+    The member is recorded in *memberIndex*, a seekable.MemberIndex, if
+    given, which may start a new member or stream before it, and its 
+    checksum in *archiveSums*, a checksums.ArchiveSums, if given
+    
+    If *throttle* is a throttle.Throttle, each member counts as a file 
+    for its file rate, and the file is read at its pace
+    
+    Returns bool whether the member was added, which it is not if it is
+    of a type tar cannot hold, like a socket
+    """
+    if throttle is not None:
+        throttle.pace(files=1)
+    if statResult is None:
+        tarInfo = tar.gettarinfo(filePath, arcName)
+    else:
+        tarInfo = get_tarinfo_from_stat(tar, filePath, arcName, statResult)
+    if tarInfo is None:
+        return False
+    if memberIndex is not None:
+        memberIndex.add_member(tar, tarInfo)
+    addFile = tar.addfile if archiveSums is None else functools.partial(archiveSums.add_member, tar)
+    if tarInfo.isreg():
+        with open(filePath, "rb") as fp:
+            readFile = throttle.wrap(fp) if throttle is not None else fp
+            if compressPolicy is not None and isinstance(tar.fileobj, compress.CompressWriter) \
+                    and compressPolicy.is_incompressible(filePath, fp, tarInfo.size):
+                tar.fileobj.set_store(True)
+                try:
+                    addFile(tarInfo, readFile)
+                finally:
+                    tar.fileobj.set_store(False)
+            else:
+                addFile(tarInfo, readFile)
+    else:
+        addFile(tarInfo)
+    return True
+
+
+def get_tarinfo_from_stat(tar, filePath, arcName, statResult):
+    """
+    Returns TarInfo for *filePath* as *arcName* in *tar*, built from 
+    *statResult* the way tar.gettarinfo() builds it from os.lstat(), or
+    None if the file type cannot be archived
+    """
+    tarInfo = tar.tarinfo()
+    tarInfo.tarfile = tar
+    arcName = os.path.splitdrive(arcName)[1].replace(os.sep, "/").lstrip("/")
+    stMode = statResult.st_mode
+    linkName = ""
+    if stat.S_ISREG(stMode):
+        inode = (statResult.st_ino, statResult.st_dev)
+        if not tar.dereference and statResult.st_nlink > 1 \
+                and inode in tar.inodes and arcName != tar.inodes[inode]:
+            # Hard link to a file already archived
+            memberType = tarfile.LNKTYPE
+            linkName = tar.inodes[inode]
+        else:
+            memberType = tarfile.REGTYPE
+            if inode[0]:
+                tar.inodes[inode] = arcName
+    elif stat.S_ISDIR(stMode):
+        memberType = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(stMode):
+        memberType = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(stMode):
+        memberType = tarfile.SYMTYPE
+        linkName = os.readlink(filePath)
+    elif stat.S_ISCHR(stMode):
+        memberType = tarfile.CHRTYPE
+    elif stat.S_ISBLK(stMode):
+        memberType = tarfile.BLKTYPE
+    else:
+        return None
+    tarInfo.name = arcName
+    tarInfo.mode = stMode
+    tarInfo.uid = statResult.st_uid
+    tarInfo.gid = statResult.st_gid
+    tarInfo.size = statResult.st_size if memberType == tarfile.REGTYPE else 0
+    tarInfo.mtime = statResult.st_mtime
+    tarInfo.type = memberType
+    tarInfo.linkname = linkName
+    tarInfo.uname = _get_user_name(tarInfo.uid)
+    tarInfo.gname = _get_group_name(tarInfo.gid)
+    if memberType in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarInfo.devmajor = os.major(statResult.st_rdev)
+        tarInfo.devminor = os.minor(statResult.st_rdev)
+    return tarInfo
+
+
+@functools.lru_cache(maxsize=None)
+def _get_user_name(uid):
+    try:
+        import pwd
+        return pwd.getpwuid(uid)[0]
+    except (ImportError, KeyError):
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _get_group_name(gid):
+    try:
+        import grp
+        return grp.getgrgid(gid)[0]
+    except (ImportError, KeyError):
+        return ""
+
+
 def main_test():
     """
     Run tests on objects in this module
@@ -198,6 +1218,11 @@ def main_test():
                                                             ".md",
                                                             ".txt",
                                                         ],
+                                                        
+                            "Exclude-Patterns"      :   [
+                                                            "log",
+                                                            "re:.*/modules/sendEm",
+                                                        ],
                         },
                         {
                             "Backup-Folder"         :   "/non/existent/folder",
@@ -229,17 +1254,95 @@ def main_test():
     assert os.path.join(bkpDir, "config.py") in confFiles
     assert os.path.join(bkpDir, "modules") in confFiles
     assert os.path.join(bkpDir, "modules/backup.py") in confFiles
+    assert os.path.join(bkpDir, "log") not in confFiles
+    assert os.path.join(bkpDir, "log/app.log") not in confFiles
+    pycFailed = False
     if os.path.join(bkpDir, "modules/__pycache__") in confFiles:
-        pycFailed = False
         for fp in confFiles:
             if os.path.splitext(fp)[1] == ".pyc":
                 pycFailed = True
                 break
     assert not pycFailed, "Exclusion of .pyc files failed"
+    # The scan threads exit once the scan is consumed, or closed early
+    for objectCount in (1, 2, 0):
+        objectIter = iter_backup_objects(BACKUP_FILES[:objectCount] * 2, scanWorkers=4)
+        if objectCount == 2:
+            firstObject = next(objectIter)
+            next(firstObject)
+            firstObject.close()
+            next(objectIter).close()
+        else:
+            for filesToArchive in objectIter:
+                list(filesToArchive)
+        deadline = time.time() + 5
+        while [t for t in threading.enumerate() if t.name.startswith("backup-scandir")] and time.time() < deadline:
+            time.sleep(0.01)
+        assert not [t for t in threading.enumerate() if t.name.startswith("backup-scandir")]
+    
+    # Test ExclusionMatcher, including pruning of excluded subtrees
+    matcher = ExclusionMatcher({
+                                    "Exclude-Folders"       :   ["/a/b/", "/a/c"],
+                                    "Exclude-Files"         :   ["/a/d/e.py"],
+                                    "Exclude-Extensions"    :   ["pyc", ".o"],
+                                    "Exclude-Patterns"      :   ["*.tmp", "/a/*/cache", "re:/a/x[0-9]+$"],
+                                })
+    assert matcher.excludes_folder("/a/b") and matcher.excludes_folder("/a/c")
+    assert not matcher.excludes_folder("/a/d")
+    assert matcher.excludes_folder("/a/d/cache") and not matcher.excludes_folder("/b/d/cache")
+    assert matcher.excludes_folder("/a/x12") and not matcher.excludes_folder("/a/x12y")
+    assert matcher.excludes_file("/a/d/e.py", "e.py") and not matcher.excludes_file("/a/d/f.py", "f.py")
+    assert matcher.excludes_file("/a/f.pyc", "f.pyc") and matcher.excludes_file("/a/f.o", "f.o")
+    assert matcher.excludes_file("/a/f.tmp", "f.tmp") and not matcher.excludes_file("/a/f.tmpx", "f.tmpx")
+    assert not ExclusionMatcher({}).excludes_file("/a/f.tmp", "f.tmp")
+    assert matcher.find_rule("/a/b", "b", True) == ("Exclude-Folders", "/a/b")
+    assert matcher.find_rule("/a/d/cache", "cache", True) == ("Exclude-Patterns", "/a/*/cache")
+    assert matcher.find_rule("/a/x12", "x12", True) == ("Exclude-Patterns", "re:/a/x[0-9]+$")
+    assert matcher.find_rule("/a/d/e.py", "e.py") == ("Exclude-Files", "/a/d/e.py")
+    assert matcher.find_rule("/a/f.o", "f.o") == ("Exclude-Extensions", ".o")
+    assert matcher.find_rule("/a/f.tmp", "f.tmp") == ("Exclude-Patterns", "*.tmp")
+    assert matcher.find_rule("/a/d", "d", True) is None
+    assert strip_trailing_slash("/a/b/") == "/a/b" and strip_trailing_slash("/") == "/"
+    
+    # Test parallel scan, which must give the same order with any number of workers
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_scan_")
+    try:
+        for i in range(5):
+            for j in range(4):
+                os.makedirs(os.path.join(testDir, "d%d" % i, "e%d" % j, "skip"))
+                for k in range(3):
+                    open(os.path.join(testDir, "d%d" % i, "e%d" % j, "f%d.txt" % k), "w").close()
+        os.symlink(os.path.join(testDir, "d0"), os.path.join(testDir, "link"))
+        scanPrefs = [{"Backup-Folder": testDir, "Exclude-Patterns": ["skip"]}, {"Backup-Folder": bkpDir}]
+        serialScan = [list(x) for x in iter_backup_objects(scanPrefs, scanWorkers=1)]
+        parallelScan = [list(x) for x in iter_backup_objects(scanPrefs, scanWorkers=8)]
+        assert serialScan == parallelScan
+        assert len(serialScan[0]) == 1 + 5 * (1 + 4 * (1 + 3)) + 1
+        assert serialScan[0][:4] == [testDir] + [os.path.join(testDir, x) for x in ("link", "d0", "d0/e0")]
+        assert all(isinstance(x, ScannedPath) and x.stat is not None for x in serialScan[0])
+        assert stat.S_ISLNK(serialScan[0][1].stat.st_mode)
+        assert not [x for x in serialScan[0] if x.endswith("skip")]
+        #   Scan counts
+        scanStats = ScanStats()
+        scanFiles = [list(x) for x in iter_backup_objects(scanPrefs[:1], scanWorkers=4, scanStats=scanStats)][0]
+        counts = scanStats.as_dict()
+        assert counts["folders"] == 1 + 5 * (1 + 4) and counts["excludedFolders"] == 5 * 4
+        assert counts["files"] == len(scanFiles) - counts["folders"]
+        assert counts["bytes"] == os.lstat(os.path.join(testDir, "link")).st_size
+        assert counts["excludedFiles"] == 0 and counts["seconds"] > 0
+        # Stat results from the scan make the same tar members as tar.gettarinfo()
+        with tarfile.open(fileobj=io.BytesIO(), mode="w") as tar:
+            for fp in serialScan[0][:8]:
+                fromScan = get_tarinfo_from_stat(tar, fp, fp, fp.stat).get_info()
+                fromStat = tar.gettarinfo(fp, fp).get_info()
+                assert fromScan == fromStat
+    finally:
+        shutil.rmtree(testDir)
     
     # Test create_tar_filepath(), including get_timestamp_for_tarfile()
     #   No timestamp
     assert create_tar_filepath("/test/dir/", "fileName", False, "seconds") == "/test/dir/fileName.tgz"
+    assert create_tar_filepath("/test/dir/", "fileName", False, "seconds", ".txz") == "/test/dir/fileName.txz"
     assert create_tar_filepath("/test/dir/", "fileName", True, "days") == "/test/dir/fileName.tgz"
     #   With timestamp
     ts = int(time.time())
@@ -249,26 +1352,284 @@ def main_test():
     assert tsBaseName == "/test/dir/fileName"
     assert 0 <= int(tsTS) - ts < 2
     
-    # Test is_time_to_delete_tar()
-    #   Delay is 2 days, but timestamp is one second less, should return False
-    fileTimestamp = int(time.time()) - (2*24*60*60 - 1)
-    deleteDelay = 2
-    assert not is_time_to_delete_tar(deleteDelay, fileTimestamp)
-    #   Delay is 2 days, but timestamp is one second more, should return True
-    fileTimestamp = int(time.time()) - (2*24*60*60 + 1)
-    deleteDelay = 2
-    assert is_time_to_delete_tar(deleteDelay, fileTimestamp)
-    
-    # Partly test delete_old_tarfiles()
-    assert delete_old_tarfiles("/d09bjdjk988dnx98sjkjbxbv?dAKqiA@d", "a", 0) == "ERROR: Directory for tar files does not exist"
-    assert delete_old_tarfiles("/tmp", "test", 0) == "Number of old tar files deleted: 0"
-    assert delete_old_tarfiles("/tmp", "test", 10) == "Number of old tar files deleted: 0"
-    
     # Test tarfile
     savedTarFile, tarError = write_tar_file(backupObjects, os.path.join("/tmp", "testtarfile.tgz"))
     assert os.path.exists(savedTarFile)
     if os.path.exists(os.path.join("/tmp", "testtarfile.tgz")): os.remove(os.path.join("/tmp", "testtarfile.tgz"))
     assert tarError == ""
+    
+    # Test streaming scan, archived while the scan runs in the background
+    streamedObjects = prefetch_backup_objects(iter_backup_objects(BACKUP_FILES), queueSize=2)
+    assert [list(x) for x in streamedObjects] == backupObjects
+    #   Parallel compression
+    streamedObjects = prefetch_backup_objects(iter_backup_objects(BACKUP_FILES), queueSize=2)
+    tarStats = {}
+    savedTarFile, tarError = write_tar_file(streamedObjects, os.path.join("/tmp", "testtarfile.tgz"),
+                                            extraMembers=lambda: [(".test/extra.txt", b"extra")],
+                                            compressWorkers=3, tarStats=tarStats)
+    assert tarError == ""
+    assert tarStats["members"] == len(confFiles) + 1 and tarStats["compressedBytes"] == os.path.getsize(savedTarFile)
+    assert tarStats["uncompressedBytes"] % tarfile.RECORDSIZE == 0
+    with tarfile.open(savedTarFile, "r:gz") as tar:
+        assert len(tar.getnames()) == len(confFiles) + 1
+        assert tar.extractfile(".test/extra.txt").read() == b"extra"
+    os.remove(savedTarFile)
+    #   Progress mode prints no member names, and counts the file sizes
+    progressOut = io.StringIO()
+    scanStats = ScanStats()
+    streamedObjects = prefetch_backup_objects(iter_backup_objects(BACKUP_FILES, scanStats=scanStats), queueSize=2)
+    with progress.ProgressReporter("progress", progressOut, scanStats) as reporter:
+        savedTarFile, tarError = write_tar_file(streamedObjects, os.path.join("/tmp", "testtarfile.tgz"), reporter=reporter)
+    assert tarError == "" and scanStats.as_dict()["done"]
+    assert reporter.files == len(confFiles) and reporter.bytes == sum(os.path.getsize(x) for x in confFiles if os.path.isfile(x))
+    assert progressOut.getvalue().startswith("%d files, " % len(confFiles)) and "ETA 0:00" in progressOut.getvalue()
+    assert "Adding" not in progressOut.getvalue()
+    os.remove(savedTarFile)
+    #   Split into volumes
+    savedTarFile, tarError = write_tar_file(backupObjects, os.path.join("/tmp", "testtarfile.tgz"), volumeSize=1000)
+    assert tarError == "" and not os.path.exists(savedTarFile)
+    tarParts = volumes.list_archive_files(savedTarFile)
+    assert len(tarParts) > 1
+    joined = io.BytesIO()
+    for part in tarParts:
+        with open(part, "rb") as fp:
+            joined.write(fp.read())
+        os.remove(part)
+    os.remove(volumes.get_index_path(savedTarFile))
+    joined.seek(0)
+    with tarfile.open(fileobj=joined, mode="r:gz") as tar:
+        assert len(tar.getnames()) == len(confFiles)
+    #   Each backup object in its own process, members named without chdir()
+    origCWD = os.getcwd()
+    newEntries = {}
+    scanStats = ScanStats()
+    tarStats = {}
+    savedTarFile, tarError = write_tar_file_parallel(BACKUP_FILES + [{"Backup-Folder": os.path.join(bkpDir, "modules")}],
+                                                    os.path.join("/tmp", "testtarfile.tgz"), processes=2,
+                                                    extraMembers=lambda: [(".test/extra.txt", b"extra")],
+                                                    baseEntries={}, newEntries=newEntries,
+                                                    scanStats=scanStats, tarStats=tarStats)
+    assert tarError == "" and os.getcwd() == origCWD
+    assert scanStats.as_dict()["files"] > 0 and tarStats["compressedBytes"] == os.path.getsize(savedTarFile)
+    assert not [x for x in os.listdir("/tmp") if x.startswith("testtarfile.tgz.segment")]
+    with tarfile.open(savedTarFile, "r:gz") as tar:
+        tarNames = tar.getnames()
+    assert tarStats["members"] == len(tarNames)
+    assert tarNames[:len(confFiles)] == [os.path.relpath(x, os.path.dirname(bkpDir[:-1])) for x in confFiles]
+    assert tarNames[-1] == ".test/extra.txt" and "modules/backup.py" in tarNames
+    assert os.path.join(bkpDir, "modules/backup.py") in newEntries
+    os.remove(savedTarFile)
+    #   Incompressible files stored, in an archive stock tools read
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_store_")
+    try:
+        noise = os.urandom(256 * 1024)
+        for name in ("photo.jpg", "noise.dat"):
+            with open(os.path.join(testDir, name), "wb") as fp:
+                fp.write(noise[::-1] if name == "photo.jpg" else noise)
+        with open(os.path.join(testDir, "text.txt"), "wb") as fp:
+            fp.write(b"compressible text\n" * 20000)
+        storePrefs = [{"Backup-Folder": testDir}]
+        for codecName in ("gzip", "xz"):
+            sizes = []
+            for compressPolicy in (None, compress.CompressPolicy()):
+                savedTarFile, tarError = write_tar_file(read_backup_files_config(storePrefs),
+                                                        os.path.join("/tmp", "testtarfile" + compress.get_extension(codecName)),
+                                                        codec=codecName, reporter=progress.ProgressReporter("quiet"),
+                                                        compressPolicy=compressPolicy)
+                assert tarError == ""
+                sizes.append(os.path.getsize(savedTarFile))
+                with tarfile.open(savedTarFile, "r:*") as tar:
+                    assert tar.extractfile(os.path.basename(testDir) + "/noise.dat").read() == noise
+                os.remove(savedTarFile)
+            assert compressPolicy.storedFiles == 2 and compressPolicy.storedBytes == 2 * len(noise)
+            assert sizes[1] < sizes[0] * 1.01
+        compressPolicy = compress.CompressPolicy()
+        savedTarFile, tarError = write_tar_file_parallel(storePrefs, os.path.join("/tmp", "testtarfile.tgz"),
+                                                        reporter=progress.ProgressReporter("quiet"),
+                                                        compressPolicy=compressPolicy)
+        assert tarError == "" and compressPolicy.storedFiles == 2
+        with tarfile.open(savedTarFile, "r:gz") as tar:
+            assert tar.extractfile(os.path.basename(testDir) + "/photo.jpg").read() == noise[::-1]
+        os.remove(savedTarFile)
+    finally:
+        shutil.rmtree(testDir)
+    #   Seekable, restoring single files by the member index, and 
+    #   checksummed, also from volumes and from archives made of segments,
+    #   with the archive teed to another output
+    class AbortableOutput(io.BytesIO):
+        aborted = False
+        def close(self):
+            self.data = self.getvalue()
+            io.BytesIO.close(self)
+        def abort(self):
+            self.aborted = True
+    restoreDir = tempfile.mkdtemp(prefix="beBackupTool_restore_")
+    try:
+        memberName = os.path.relpath(confFiles[-1], os.path.dirname(bkpDir[:-1]))
+        for volumeSize, parallel in ((0, False), (2000, False), (0, True)):
+            tarPath = os.path.join(restoreDir, "test_1.tgz")
+            tarStats = {}
+            teeOutput = AbortableOutput()
+            if parallel:
+                savedTarFile, tarError = write_tar_file_parallel(BACKUP_FILES, tarPath, reporter=progress.ProgressReporter("quiet"),
+                                                                seekableArchive=True, checksumArchive=True, tarStats=tarStats,
+                                                                extraMembers=lambda: [(".extra", b"x")],
+                                                                extraOutputs=[teeOutput])
+            else:
+                savedTarFile, tarError = write_tar_file(backupObjects, tarPath, volumeSize=volumeSize, tarStats=tarStats,
+                                                        reporter=progress.ProgressReporter("quiet"), seekableArchive=True,
+                                                        checksumArchive=True, extraOutputs=[teeOutput])
+            assert tarError == "" and os.path.exists(seekable.get_member_index_path(tarPath))
+            assert tarStats["outputErrors"] == [""]
+            with volumes.open_archive(tarPath) as fp:
+                assert teeOutput.data == fp.read()
+            archiveSums = checksums.load_sums(tarPath)
+            assert archiveSums["SHA256"] == tarStats["sha256"] and archiveSums["Size"] == tarStats["compressedBytes"]
+            assert len(archiveSums["Members"]) == len([f for f in confFiles if os.path.isfile(f)]) + (1 if parallel else 0)
+            assert checksums.verify_archive(tarPath) == ""
+            restoredNames, restoreError = seekable.restore_members(tarPath, memberName, os.path.join(restoreDir, "out"))
+            assert restoreError == "" and restoredNames == [memberName]
+            with open(os.path.join(restoreDir, "out", memberName), "rb") as fp, open(confFiles[-1], "rb") as fpOrig:
+                assert fp.read() == fpOrig.read()
+            shutil.rmtree(os.path.join(restoreDir, "out"))
+            for fileName in os.listdir(restoreDir):
+                os.remove(os.path.join(restoreDir, fileName))
+    finally:
+        shutil.rmtree(restoreDir)
+    #   Other codecs
+    for codecName in ("bz2", "xz", "none"):
+        savedTarFile, tarError = write_tar_file(backupObjects, os.path.join("/tmp", "testtarfile" + compress.get_extension(codecName)),
+                                                codec=codecName, level=1 if codecName != "none" else None)
+        assert tarError == ""
+        with tarfile.open(savedTarFile, "r:*") as tar:
+            assert len(tar.getnames()) == len(confFiles)
+        os.remove(savedTarFile)
+    assert tarfile.open(fileobj=io.BytesIO(read_sample_tar(backupObjects, 1)), mode="r").getnames() == [confFiles[0].lstrip("/")]
+    #   Scan errors surface in the consumer
+    def failing_objects():
+        yield iter(["/a"])
+        raise OSError("scan failed")
+    streamedObjects = prefetch_backup_objects(failing_objects())
+    assert list(next(streamedObjects)) == ["/a"]
+    try:
+        next(streamedObjects)
+        assert False, "Scan error not raised"
+    except OSError:
+        pass
+    #   Written to a given file object, aborted on error
+    outFile = AbortableOutput()
+    tarPath = os.path.join("/tmp", "testtarfile.tgz")
+    assert write_tar_file(backupObjects, tarPath, reporter=progress.ProgressReporter("quiet"), outFile=outFile) == (tarPath, "")
+    assert not os.path.exists(tarPath) and not outFile.aborted
+    with tarfile.open(fileobj=io.BytesIO(outFile.data), mode="r:gz") as tar:
+        assert len(tar.getnames()) == len(confFiles)
+    outFile = AbortableOutput()
+    tarError = write_tar_file(failing_objects(), tarPath, reporter=progress.ProgressReporter("quiet"), outFile=outFile)[1]
+    assert tarError.startswith("ERROR") and outFile.aborted and not outFile.closed
+    #   Teed to outputs, one failing without failing the archive
+    class FailingOutput(AbortableOutput):
+        def write(self, data):
+            raise OSError("output failed")
+    outFile, extraOutputs, tarStats = AbortableOutput(), [FailingOutput(), AbortableOutput()], {}
+    assert write_tar_file(backupObjects, tarPath, reporter=progress.ProgressReporter("quiet"), outFile=outFile,
+                            extraOutputs=extraOutputs, tarStats=tarStats) == (tarPath, "")
+    assert extraOutputs[0].aborted and extraOutputs[1].data == outFile.data
+    assert "output failed" in tarStats["outputErrors"][0] and tarStats["outputErrors"][1] == ""
+    assert tarStats["compressedBytes"] == len(outFile.data)
+    outFile, extraOutputs = AbortableOutput(), [AbortableOutput()]
+    tarError = write_tar_file(failing_objects(), tarPath, reporter=progress.ProgressReporter("quiet"), outFile=outFile,
+                                extraOutputs=extraOutputs)[1]
+    assert tarError.startswith("ERROR") and outFile.aborted and extraOutputs[0].aborted
+    outFile, extraOutputs = AbortableOutput(), [AbortableOutput()]
+    tarError = write_tar_file_parallel([{"Backup-Folder": bkpDir, "Exclude-Patterns": ["re:("]}], tarPath,
+                                        reporter=progress.ProgressReporter("quiet"), outFile=outFile,
+                                        extraOutputs=extraOutputs)[1]
+    assert tarError.startswith("ERROR") and outFile.aborted and extraOutputs[0].aborted
+    #   Checkpointed, an interrupted run resumed from its sealed segments,
+    #   adding the files changed since again
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_checkpoint_")
+    try:
+        dataDir = os.path.join(testDir, "data")
+        os.makedirs(os.path.join(dataDir, "sub"))
+        for n in range(12):
+            with open(os.path.join(dataDir, "sub" if n % 2 else "", "f%02d.txt" % n), "wb") as fp:
+                fp.write(b"file %02d\n" % n * 3000)
+        os.link(os.path.join(dataDir, "f00.txt"), os.path.join(dataDir, "sub", "link.txt"))
+        checkpointPrefs = [{"Backup-Folder": dataDir}]
+        checkpointDir = os.path.join(testDir, "BE_Backup.checkpoint")
+        checkpointTarPath = os.path.join(testDir, "test_1.tgz")
+        def interrupted_objects():
+            def files():
+                for n, fp in enumerate(read_backup_files_config(checkpointPrefs)[0]):
+                    if n == 9:
+                        raise OSError("interrupted")
+                    yield fp
+            yield files()
+        tarError = write_tar_file_checkpointed(interrupted_objects(), checkpointTarPath, checkpointDir, 30000,
+                                                reporter=progress.ProgressReporter("quiet"), seekableArchive=True,
+                                                checksumArchive=True)[1]
+        assert "interrupted" in tarError and not os.path.exists(checkpointTarPath)
+        journal = checkpoint.Journal(checkpointDir, {"Codec": "gzip", "Level": compress.get_level("gzip", None),
+                                        "Seekable": True, "Checksums": True, "Store-Incompressible": False})
+        assert len(journal.segments) == 3 and len(journal.get_entries()) == 7
+        assert os.path.join(dataDir, "f02.txt") in journal.get_entries()
+        with open(os.path.join(dataDir, "f02.txt"), "wb") as fp:
+            fp.write(b"changed since the checkpoint\n")
+        tarStats = {}
+        reporter = progress.ProgressReporter("quiet")
+        assert write_tar_file_checkpointed(read_backup_files_config(checkpointPrefs), checkpointTarPath, checkpointDir, 30000,
+                                            reporter=reporter, seekableArchive=True, checksumArchive=True,
+                                            tarStats=tarStats, extraMembers=lambda: [(".extra", b"x")]) == (checkpointTarPath, "")
+        assert not os.path.exists(checkpointDir) and reporter.files == 15 + 1
+        with tarfile.open(checkpointTarPath, "r:gz") as tar:
+            tarNames = tar.getnames()
+            assert tarNames.count("data/f02.txt") == 2 and len(tarNames) == 15 + 1 + 1
+            assert tarStats["members"] == len(tarNames)
+            for name in tarNames:
+                if tar.getmember(name).isfile() and name.startswith("data/"):
+                    with open(os.path.join(testDir, name), "rb") as fp:
+                        assert tar.extractfile(name).read() == fp.read()
+        assert checksums.verify_archive(checkpointTarPath) == ""
+        restoredNames, restoreError = seekable.restore_members(checkpointTarPath, "data/f02.txt", os.path.join(testDir, "out"))
+        with open(os.path.join(testDir, "out", "data", "f02.txt"), "rb") as fp:
+            assert restoreError == "" and fp.read() == b"changed since the checkpoint\n"
+        # Uninterrupted, hard links across segments kept
+        assert write_tar_file_checkpointed(read_backup_files_config(checkpointPrefs), checkpointTarPath, checkpointDir, 30000,
+                                            reporter=progress.ProgressReporter("quiet")) == (checkpointTarPath, "")
+        with tarfile.open(checkpointTarPath, "r:gz") as tar:
+            assert len(tar.getnames()) == 15 and tar.getmember("data/sub/link.txt").islnk()
+    finally:
+        shutil.rmtree(testDir)
+    #   Read at the pace of a throttle, in a worker process with its share
+    class RecordingThrottle(object):
+        def __init__(self):
+            self.files, self.bytes, self.sleptSeconds = 0, 0, 0.0
+        def pace(self, nbytes=0, files=0):
+            self.files += files
+            self.bytes += nbytes
+            self.sleptSeconds += 0.5
+        def wrap(self, fileobj):
+            throttle = self
+            class Reader(object):
+                def read(self, size=-1):
+                    data = fileobj.read(size)
+                    throttle.pace(len(data))
+                    return data
+            return Reader()
+    recordingThrottle = RecordingThrottle()
+    assert write_tar_file(backupObjects, tarPath, reporter=progress.ProgressReporter("quiet"),
+                            throttle=recordingThrottle) == (tarPath, "")
+    assert recordingThrottle.files == len(confFiles)
+    assert recordingThrottle.bytes == sum(os.path.getsize(f) for f in confFiles if os.path.isfile(f))
+    try:
+        from . import throttle
+    except ImportError:
+        import throttle
+    fileThrottle = throttle.Throttle(maxFilesPerSecond=200)
+    assert write_tar_file_parallel([{"Backup-Folder": bkpDir}], tarPath, reporter=progress.ProgressReporter("quiet"),
+                                    throttle=fileThrottle) == (tarPath, "")
+    assert fileThrottle.sleptSeconds > 0
+    os.remove(tarPath)
     print("All backup tests passed OK")
     return 0
 
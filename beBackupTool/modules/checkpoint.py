@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints of an archive being written, so an interrupted run resumes
+where it stopped rather than from the start
+
+The archive is written as a sequence of segments, each a run of tar
+members compressed on its own, in the checkpoint folder next to the
+archive. Once a segment is complete and synced to disk it is sealed by
+appending a line to the journal there, with the manifest entries of the
+files in it. A run interrupted, or killed, leaves the sealed segments
+and the journal behind, and the next run with the same settings skips
+the files sealed that have not changed since, then joins the segments
+into the archive, see backup.write_tar_file_checkpointed()
+"""
+
+import sys, os, json, shutil
+
+JOURNAL_VERSION = 1
+JOURNAL_NAME = "journal.jsonl"
+
+
+def get_checkpoint_dir(tarDir, tarNameStem):
+    """
+    Returns path of the checkpoint folder of the archives
+    """
+    return os.path.join(tarDir, tarNameStem + ".checkpoint")
+
+
+class Journal(object):
+    """
+    Journal of the segments sealed in *checkpointDir*, for a run with
+    the settings of dict *runKey*
+
+    The journal of an earlier run is resumed if it was for the same
+    settings, keeping the segments whose files are intact, and is
+    otherwise discarded with its segments. Segments never sealed, as
+    being written when the run stopped, are deleted
+
+    Each of *segments* is a dict of the segment "name", its "size", the
+    "entries" of the files in it, and the "stats" given to seal()
+    """
+
+    def __init__(self, checkpointDir, runKey):
+        self.checkpointDir = checkpointDir
+        self.journalPath = os.path.join(checkpointDir, JOURNAL_NAME)
+        # As read back from the journal, so tuples compare as lists
+        self.runKey = json.loads(json.dumps(runKey))
+        self.segments = self._load()
+        self.resumed = bool(self.segments)
+        if not self.segments:
+            shutil.rmtree(checkpointDir, ignore_errors=True)
+        os.makedirs(checkpointDir, exist_ok=True)
+        segmentNames = set(s["name"] for s in self.segments)
+        for fileName in os.listdir(checkpointDir):
+            if fileName != JOURNAL_NAME and fileName not in segmentNames:
+                os.remove(os.path.join(checkpointDir, fileName))
+        self._rewrite()
+        self.nextNumber = len(self.segments) and max(int(s["name"][7:12]) for s in self.segments) + 1
+
+    def _load(self):
+        """
+        Returns list of the segments sealed in the journal up to the
+        first one not intact, as hard links may refer to members of
+        earlier segments, or empty if it is missing or for other settings.
+        A last line cut short, as by the run being killed while writing
+        it, is ignored
+        """
+        segments = []
+        try:
+            with open(self.journalPath, "r", encoding="utf-8") as fp:
+                header = json.loads(fp.readline())
+                if header.get("version") != JOURNAL_VERSION or header.get("key") != self.runKey:
+                    return []
+                for line in fp:
+                    try:
+                        segment = json.loads(line)
+                    except ValueError:
+                        break
+                    if not self._is_intact(segment):
+                        break
+                    segments.append(segment)
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            return []
+        return segments
+
+    def _is_intact(self, segment):
+        try:
+            return os.path.getsize(self.get_segment_path(segment)) == segment["size"]
+        except OSError:
+            return False
+
+    def _rewrite(self):
+        """
+        Writes the journal afresh, with the segments kept only, replacing
+        the old one once the new one is synced to disk
+        """
+        tmpPath = self.journalPath + ".tmp"
+        with open(tmpPath, "w", encoding="utf-8") as fp:
+            for record in [{"version": JOURNAL_VERSION, "key": self.runKey}] + self.segments:
+                fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpPath, self.journalPath)
+
+    def _append(self, record):
+        """
+        Appends *record* as a line to the journal, synced to disk
+        """
+        with open(self.journalPath, "a", encoding="utf-8") as fp:
+            fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.checkpointDir, segment["name"])
+
+    def get_entries(self):
+        """
+        Returns dict of the manifest entries of the files in the sealed
+        segments, those of later segments replacing earlier ones
+        """
+        entries = {}
+        for segment in self.segments:
+            entries.update(segment["entries"])
+        return entries
+
+    def new_segment_path(self):
+        """
+        Returns path to write the next segment to
+        """
+        segmentPath = os.path.join(self.checkpointDir, "segment%05d.tmp" % self.nextNumber)
+        self.nextNumber += 1
+        return segmentPath
+
+    def seal(self, segmentPath, entries, stats):
+        """
+        Records the segment written to *segmentPath*, closed and synced
+        to disk, holding the files of the manifest *entries* dict, with
+        dict *stats* of its counts
+        """
+        segment = {"name": os.path.basename(segmentPath), "size": os.path.getsize(segmentPath),
+                    "entries": entries, "stats": stats}
+        self._append(segment)
+        self.segments.append(segment)
+
+    def discard(self):
+        """
+        Deletes the checkpoint folder, once the archive is complete
+        """
+        shutil.rmtree(self.checkpointDir, ignore_errors=True)
+        self.segments = []
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in checkpoint")
+    import tempfile
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_checkpoint_")
+    try:
+        checkpointDir = get_checkpoint_dir(testDir, "BE_Backup")
+        assert checkpointDir == os.path.join(testDir, "BE_Backup.checkpoint")
+        runKey = {"Codec": "gzip", "Folders": ("/a", "/b")}
+        journal = Journal(checkpointDir, runKey)
+        assert not journal.resumed and journal.segments == [] and journal.get_entries() == {}
+        segmentPaths = []
+        for n in range(3):
+            segmentPaths.append(journal.new_segment_path())
+            with open(segmentPaths[-1], "wb") as fp:
+                fp.write(b"x" * (n + 1))
+            if n < 2:
+                journal.seal(segmentPaths[-1], {"/a/f": [n, n, n, n], "/a/g%d" % n: [1, 2, 3, 4]}, {"members": n})
+        assert [os.path.basename(p) for p in segmentPaths] == ["segment00000.tmp", "segment00001.tmp", "segment00002.tmp"]
+        # Resumed with the sealed segments, the unsealed one deleted
+        journal = Journal(checkpointDir, runKey)
+        assert journal.resumed and [s["size"] for s in journal.segments] == [1, 2]
+        assert journal.get_entries() == {"/a/f": [1, 1, 1, 1], "/a/g0": [1, 2, 3, 4], "/a/g1": [1, 2, 3, 4]}
+        assert journal.segments[1]["stats"] == {"members": 1} and not os.path.exists(segmentPaths[2])
+        assert journal.new_segment_path() == segmentPaths[2]
+        # A line cut short, and a segment changed since sealed, are ignored
+        with open(segmentPaths[1], "ab") as fp:
+            fp.write(b"y")
+        with open(os.path.join(checkpointDir, JOURNAL_NAME), "a") as fp:
+            fp.write('{"name":"segment0')
+        journal = Journal(checkpointDir, runKey)
+        assert [s["name"] for s in journal.segments] == ["segment00000.tmp"]
+        assert not os.path.exists(segmentPaths[1]) and journal.new_segment_path() == segmentPaths[1]
+        with open(segmentPaths[1], "wb") as fp:
+            fp.write(b"z")
+        journal.seal(segmentPaths[1], {"/a/h": [5, 5, 5, 5]}, {})
+        assert [s["name"] for s in Journal(checkpointDir, runKey).segments] == ["segment00000.tmp", "segment00001.tmp"]
+        # Other settings start afresh
+        journal = Journal(checkpointDir, dict(runKey, Codec="xz"))
+        assert not journal.resumed and os.listdir(checkpointDir) == [JOURNAL_NAME]
+        assert journal.new_segment_path() == segmentPaths[0]
+        journal.discard()
+        assert not os.path.exists(checkpointDir)
+    finally:
+        shutil.rmtree(testDir)
+    print("All checkpoint tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
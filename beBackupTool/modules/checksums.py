@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SHA-256 checksums of archives and their members, taken while the archive
+is written, and verification of archives against them
+
+The checksums are kept in "name.tgz.sums.json.gz" next to the archive.
+The archive checksum is of the compressed file, or of its volumes joined
+"""
+
+import sys, os, io, json, gzip, hashlib, tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import seekable, volumes
+except ImportError: # Run as a script for testing
+    import seekable, volumes
+
+SUMS_VERSION = 1
+SUMS_SUFFIX = ".sums.json.gz"
+
+
+def get_sums_path(tarFilePath):
+    """
+    Returns path of the checksums file of the archive
+    """
+    return tarFilePath + SUMS_SUFFIX
+
+
+class HashingReader(object):
+    """
+    Read-only file object passing reads of *fileobj* through, hashing
+    the data read
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class HashingWriter(io.RawIOBase):
+    """
+    Write-only file object passing writes to *fileobj*, which is not
+    closed with it, hashing the data written, or only hashing it if 
+    *fileobj* is None. The tell() method returns the number of bytes
+    written
+    """
+
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        self.hash.update(data)
+        self.position += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class ArchiveSums(object):
+    """
+    Checksums of the members of an archive compressed with *codec*, and
+    of the archive itself once it is written
+    """
+
+    def __init__(self, codec="gzip"):
+        self.codec = codec
+        self.members = {}
+        self.sha256 = None
+        self.size = 0
+
+    def add_member(self, tar, tarInfo, fileobj=None):
+        """
+        Adds *tarInfo* to *tar*, with data read from *fileobj* if a
+        regular file, recording the checksum of the data
+        """
+        reader = HashingReader(fileobj if fileobj is not None else io.BytesIO())
+        tar.addfile(tarInfo, reader if fileobj is not None else None)
+        if tarInfo.isreg():
+            self.members[tarInfo.name] = reader.hexdigest()
+
+
+def save_sums(tarFilePath, archiveSums):
+    """
+    Writes *archiveSums* of the archive next to it
+    """
+    sums = {
+                "Version"   :   SUMS_VERSION,
+                "Archive"   :   os.path.basename(tarFilePath),
+                "Codec"     :   archiveSums.codec,
+                "SHA256"    :   archiveSums.sha256,
+                "Size"      :   archiveSums.size,
+                "Members"   :   archiveSums.members,
+            }
+    sumsPath = get_sums_path(tarFilePath)
+    with gzip.open(sumsPath + ".tmp", "wt", encoding="utf-8") as fp:
+        json.dump(sums, fp, separators=(",", ":"))
+    os.replace(sumsPath + ".tmp", sumsPath)
+
+
+def load_sums(tarFilePath):
+    """
+    Returns checksums dict of the archive, or None if it has none
+    """
+    try:
+        with gzip.open(get_sums_path(tarFilePath), "rt", encoding="utf-8") as fp:
+            sums = json.load(fp)
+        if sums.get("Version") != SUMS_VERSION:
+            return None
+        return sums
+    except (OSError, ValueError):
+        return None
+
+
+def verify_archive(tarFilePath):
+    """
+    Checks the archive at *tarFilePath*, possibly split into volumes,
+    against its checksums, in one pass that hashes the compressed data
+    while decompressing it and hashing every member
+
+    Returns error message, empty if the archive is intact
+    """
+    sums = load_sums(tarFilePath)
+    if sums is None:
+        return "ERROR: Archive '%s' has no checksums" % tarFilePath
+    # A member added again, like a file changed since a checkpoint, 
+    # replaces the earlier copies, so only the last is checked
+    memberHashes = {}
+    try:
+        with volumes.open_archive(tarFilePath) as fp:
+            reader = HashingReader(fp)
+            # Decompressed here, as tarfile's stream mode stops at the end
+            # of the first gzip member
+            stream = seekable.open_decompressed(reader, sums["Codec"])
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for tarInfo in tar:
+                    if not tarInfo.isreg():
+                        continue
+                    memberHash = hashlib.sha256()
+                    memberFile = tar.extractfile(tarInfo)
+                    for chunk in iter(lambda: memberFile.read(1024 * 1024), b""):
+                        memberHash.update(chunk)
+                    memberHashes[tarInfo.name] = memberHash.hexdigest()
+            # Hash what follows the end-of-archive marker too
+            while reader.read(1024 * 1024):
+                pass
+    except Exception as e:
+        return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    if reader.hexdigest() != sums["SHA256"]:
+        return "ERROR: Archive '%s' checksum mismatch" % tarFilePath
+    badMembers = [x for x in memberHashes if sums["Members"].get(x) not in (None, memberHashes[x])]
+    missingMembers = set(sums["Members"]) - set(memberHashes)
+    if badMembers or missingMembers:
+        return "ERROR: Archive '%s' has %d corrupt and %d missing members, first '%s'" \
+                % (tarFilePath, len(badMembers), len(missingMembers), (badMembers or sorted(missingMembers))[0])
+    return ""
+
+
+def verify_archives(tarFilePaths, workers=1):
+    """
+    Verifies the archives of *tarFilePaths* in up to *workers* processes
+    at once
+
+    Returns list of the error messages, empty for intact archives, in
+    the order of *tarFilePaths*
+    """
+    if workers <= 1 or len(tarFilePaths) <= 1:
+        return [verify_archive(x) for x in tarFilePaths]
+    with ProcessPoolExecutor(max_workers=min(workers, len(tarFilePaths))) as executor:
+        return list(executor.map(verify_archive, tarFilePaths))
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in checksums")
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_checksums_")
+    try:
+        data = dict(("d/f%d.txt" % i, os.urandom(1000 * i)) for i in range(20))
+        tarPaths = []
+        for n in range(3):
+            tarPath = os.path.join(testDir, "test_%d.tgz" % n)
+            archiveSums = ArchiveSums()
+            with open(tarPath, "wb") as outFile:
+                hashingFile = HashingWriter(outFile)
+                with tarfile.open(fileobj=hashingFile, mode="w:gz") as tar:
+                    dirInfo = tarfile.TarInfo("d")
+                    dirInfo.type = tarfile.DIRTYPE
+                    archiveSums.add_member(tar, dirInfo)
+                    for name in sorted(data):
+                        tarInfo = tarfile.TarInfo(name)
+                        tarInfo.size = len(data[name])
+                        archiveSums.add_member(tar, tarInfo, io.BytesIO(data[name]))
+            archiveSums.sha256 = hashingFile.hexdigest()
+            archiveSums.size = hashingFile.tell()
+            assert archiveSums.size == os.path.getsize(tarPath)
+            with open(tarPath, "rb") as fp:
+                assert hashlib.sha256(fp.read()).hexdigest() == archiveSums.sha256
+            assert archiveSums.members["d/f3.txt"] == hashlib.sha256(data["d/f3.txt"]).hexdigest()
+            assert "d" not in archiveSums.members
+            save_sums(tarPath, archiveSums)
+            tarPaths.append(tarPath)
+        assert load_sums(tarPaths[0])["Members"] == archiveSums.members
+        assert verify_archives(tarPaths, workers=2) == ["", "", ""]
+        # Corrupt one byte of an archive
+        with open(tarPaths[1], "r+b") as fp:
+            fp.seek(2000)
+            byte = fp.read(1)
+            fp.seek(2000)
+            fp.write(bytes([byte[0] ^ 0xFF]))
+        results = verify_archives(tarPaths, workers=2)
+        assert results[0] == results[2] == "" and results[1].startswith("ERROR")
+        os.remove(get_sums_path(tarPaths[2]))
+        assert verify_archive(tarPaths[2]) == "ERROR: Archive '%s' has no checksums" % tarPaths[2]
+    finally:
+        shutil.rmtree(testDir)
+    print("All checksums tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
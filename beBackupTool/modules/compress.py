@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compression of the tar stream with a selectable codec, optionally across
+several cores
+
+With more than one worker, the stream is cut into blocks that are
+compressed by a thread pool, in the manner of pigz. As zlib, bz2 and 
+lzma release the GIL while compressing, the workers run in parallel. 
+Each block is written as a separate gzip member or bz2 or xz stream, and
+the concatenated blocks form a valid file that "tar xf" and the Python
+modules read as one stream
+
+Files that will not compress, like media and archives, may be written
+at the codec's store level instead, see CompressPolicy. This too starts
+a new member or stream, so the file stays one valid archive
+"""
+
+import sys, os, io, math, time, zlib, bz2, lzma, collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed size of each block compressed by a worker
+BLOCK_SIZE = 1024 * 1024
+
+# Files of at least this size are checked by CompressPolicy, as switching
+# level for smaller ones costs more than it saves
+MIN_STORE_SIZE = 32 * 1024
+
+# Bytes sampled from the start of files of unknown type, and the Shannon
+# entropy in bits per byte above which they are taken as incompressible
+ENTROPY_SAMPLE_SIZE = 4096
+MAX_ENTROPY = 7.5
+
+# Extensions of file formats that are compressed already
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+            ".7z", ".aac", ".apk", ".avi", ".avif", ".br", ".bz2", ".cab", ".deb", ".docx",
+            ".epub", ".flac", ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz", ".lz4",
+            ".lzma", ".m4a", ".m4v", ".mkv", ".mov", ".mp3", ".mp4", ".odp", ".ods", ".odt",
+            ".ogg", ".opus", ".png", ".pptx", ".rar", ".rpm", ".tbz2", ".tgz", ".txz", ".webm",
+            ".webp", ".whl", ".wma", ".wmv", ".xlsx", ".xz", ".zip", ".zst",
+        ])
+
+# Archive file extension, MIME type, default, valid and store levels of 
+# each codec. The store level is the cheapest, and only stores for gzip
+CODECS = {
+            "gzip"  :   {
+                            "Extension"     :   ".tgz",
+                            "MIME-Type"     :   ("application", "gzip"),
+                            "Level"         :   9, # As used by tarfile for "w:gz"
+                            "Levels"        :   range(0, 10),
+                            "Store-Level"   :   0,
+                        },
+            "bz2"   :   {
+                            "Extension"     :   ".tbz2",
+                            "MIME-Type"     :   ("application", "x-bzip2"),
+                            "Level"         :   9,
+                            "Levels"        :   range(1, 10),
+                            "Store-Level"   :   1,
+                        },
+            "xz"    :   {
+                            "Extension"     :   ".txz",
+                            "MIME-Type"     :   ("application", "x-xz"),
+                            "Level"         :   6,
+                            "Levels"        :   range(0, 10),
+                            "Store-Level"   :   0,
+                        },
+            "none"  :   {
+                            "Extension"     :   ".tar",
+                            "MIME-Type"     :   ("application", "x-tar"),
+                            "Level"         :   0,
+                            "Levels"        :   range(0, 1),
+                            "Store-Level"   :   0,
+                        },
+        }
+
+CODEC_ALIASES = {"gz": "gzip", "bzip2": "bz2", "lzma": "xz"}
+
+
+def get_codec(codecName):
+    """
+    Returns canonical codec name for *codecName*, including aliases,
+    raising ValueError if unknown
+    """
+    codecName = CODEC_ALIASES.get(codecName, codecName)
+    if codecName not in CODECS:
+        raise ValueError("Unknown compression codec '%s'" % codecName)
+    return codecName
+
+
+def get_level(codecName, level):
+    """
+    Returns *level* for *codecName*, or its default level if None
+    """
+    codecName = get_codec(codecName)
+    if level is None:
+        return CODECS[codecName]["Level"]
+    if level not in CODECS[codecName]["Levels"]:
+        raise ValueError("Invalid level %s for codec '%s'" % (level, codecName))
+    return level
+
+
+def get_extension(codecName):
+    """
+    Returns archive file extension for *codecName*
+    """
+    return CODECS[get_codec(codecName)]["Extension"]
+
+
+def get_all_extensions():
+    """
+    Returns tuple of the archive file extensions of all codecs
+    """
+    return tuple(c["Extension"] for c in CODECS.values())
+
+
+def get_mime_type(filePath):
+    """
+    Returns tuple of MIME maintype and subtype for *filePath*, based on
+    its archive file extension
+    """
+    for c in CODECS.values():
+        if filePath.endswith(c["Extension"]):
+            return c["MIME-Type"]
+    return ("application", "octet-stream")
+
+
+def get_worker_count(configWorkers):
+    """
+    Returns number of compression workers for *configWorkers* setting,
+    where 0 means one per CPU
+    """
+    if configWorkers > 0:
+        return configWorkers
+    return os.cpu_count() or 1
+
+
+class _NoCompressor(object):
+    """
+    Compressor of the "none" codec, passing data through
+    """
+    def compress(self, data):
+        return bytes(data)
+    def flush(self):
+        return b""
+
+
+def new_compressor(codecName, level):
+    """
+    Returns new streaming compressor object of *codecName* at *level*
+    """
+    codecName = get_codec(codecName)
+    if codecName == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif codecName == "bz2":
+        return bz2.BZ2Compressor(level)
+    elif codecName == "xz":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+    return _NoCompressor()
+
+
+def compress_block(data, codecName, level):
+    """
+    Returns *data* compressed as one complete gzip member or bz2 or xz
+    stream, that may be concatenated with others
+    """
+    compressor = new_compressor(codecName, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def get_entropy(data):
+    """
+    Returns Shannon entropy of *data* in bits per byte, from 0 for one
+    repeated byte to 8 for random data
+    """
+    if not data:
+        return 0.0
+    size = len(data)
+    return -sum(n / size * math.log2(n / size) for n in collections.Counter(data).values())
+
+
+class CompressPolicy(object):
+    """
+    Chooses which files are stored rather than compressed, by their
+    extension, or if of unknown type, by the entropy of a sample of 
+    their first bytes. Files smaller than *minSize* are always compressed
+    
+    Counts the *storedFiles* and *storedBytes*
+    """
+
+    def __init__(self, extensions=INCOMPRESSIBLE_EXTENSIONS, minSize=MIN_STORE_SIZE,
+                    sampleSize=ENTROPY_SAMPLE_SIZE, maxEntropy=MAX_ENTROPY):
+        self.extensions = frozenset(x.lower() for x in extensions)
+        self.minSize = minSize
+        self.sampleSize = sampleSize
+        self.maxEntropy = maxEntropy
+        self.storedFiles = 0
+        self.storedBytes = 0
+
+    def is_incompressible(self, filePath, fp, size):
+        """
+        Returns bool whether the file at *filePath*, of *size* bytes, 
+        open as *fp* at its start, should be stored, sampling it from 
+        *fp* if need be and seeking back to the start
+        """
+        if size < self.minSize:
+            return False
+        incompressible = os.path.splitext(filePath)[1].lower() in self.extensions
+        if not incompressible:
+            sample = fp.read(self.sampleSize)
+            fp.seek(0)
+            incompressible = get_entropy(sample) > self.maxEntropy
+        if incompressible:
+            self.storedFiles += 1
+            self.storedBytes += size
+        return incompressible
+
+
+class CompressWriter(io.RawIOBase):
+    """
+    Write-only file object compressing all data written to it into
+    *fileobj*, which is not closed with it, using *codec* at *level*,
+    or the codec's default level if None
+
+    With *workers* greater than 1, blocks of *blockSize* bytes are
+    compressed in parallel and written in order, with at most two
+    blocks per worker held in memory. The tell() method returns the
+    uncompressed position, as tarfile requires
+    
+    Data written between set_store(True) and set_store(False) is written
+    at the store level of the codec, in its own member or stream
+    
+    The uncompressed and compressed positions at which each member or
+    stream starts, where decompression can begin, are kept in the list
+    *flushPoints*, and *compressedPosition* is the bytes written so far
+    """
+
+    def __init__(self, fileobj, codec="gzip", level=None, workers=1, blockSize=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.codec = get_codec(codec)
+        self.level = get_level(self.codec, level)
+        self.compressLevel = self.level
+        self.storeLevel = CODECS[self.codec]["Store-Level"]
+        self.workers = workers
+        self.blockSize = blockSize
+        self.position = 0
+        self.compressedPosition = 0
+        # Uncompressed position the current member or stream starts at
+        self.streamStart = 0
+        # Uncompressed and compressed positions of each member or stream
+        self.flushPoints = [(0, 0)]
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        if workers > 1 and self.codec != "none":
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            self.compressor = None
+        else:
+            self.executor = None
+            self.compressor = new_compressor(self.codec, self.level)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed CompressWriter")
+        size = len(data)
+        self.position += size
+        if self.executor is None:
+            self._write_out(self.compressor.compress(data))
+            return size
+        self.buffer += data
+        while len(self.buffer) >= self.blockSize:
+            block = bytes(self.buffer[:self.blockSize])
+            del self.buffer[:self.blockSize]
+            self._submit(block)
+        return size
+
+    def set_store(self, store):
+        """
+        Switches to the store level of the codec if *store* is True, or
+        back to the level compressed at
+        """
+        self.set_level(self.storeLevel if store else self.compressLevel)
+
+    def set_level(self, level):
+        """
+        Ends the current gzip member or bz2 or xz stream, if any data has
+        been written to it, and compresses what follows at *level*
+        """
+        if level == self.level or self.codec == "none":
+            return
+        self._restart(level)
+
+    def restart(self):
+        """
+        Ends the current gzip member or bz2 or xz stream, if any data has
+        been written to it, so decompression can start at the current 
+        position, which is added to the *flushPoints*
+        """
+        self._restart(self.level)
+
+    def _restart(self, level):
+        if self.executor is None:
+            if self.position > self.streamStart:
+                self._write_out(self.compressor.flush())
+                self.streamStart = self.position
+                self._add_flush_point(self.position, self.compressedPosition)
+            self.compressor = new_compressor(self.codec, level)
+        elif self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.level = level
+
+    def _add_flush_point(self, position, compressedPosition):
+        if self.flushPoints[-1][0] == position:
+            self.flushPoints[-1] = (position, compressedPosition)
+        else:
+            self.flushPoints.append((position, compressedPosition))
+
+    def _write_out(self, data):
+        self.fileobj.write(data)
+        self.compressedPosition += len(data)
+
+    def _submit(self, block):
+        self.pending.append((self.streamStart, self.executor.submit(compress_block, block, self.codec, self.level)))
+        self.streamStart += len(block)
+        # Bound memory by writing out the oldest blocks
+        while len(self.pending) > 2 * self.workers:
+            self._write_block()
+
+    def _write_block(self):
+        blockStart, future = self.pending.popleft()
+        self._add_flush_point(blockStart, self.compressedPosition)
+        self._write_out(future.result())
+
+    def close(self):
+        """
+        Writes out all remaining data, then marks the writer closed
+        """
+        if self.closed:
+            return
+        try:
+            if self.executor is None:
+                self._write_out(self.compressor.flush())
+            else:
+                if self.buffer or self.position == 0:
+                    self._submit(bytes(self.buffer))
+                    self.buffer = bytearray()
+                while self.pending:
+                    self._write_block()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            super().close()
+
+
+def bench_codecs(sampleData, codecLevels, workers=1):
+    """
+    Compresses *sampleData* with each (codec, level) tuple in the 
+    *codecLevels* list, returning list of dicts of codec, level, 
+    compression ratio and throughput in MB/s of uncompressed data
+    """
+    results = []
+    for codecName, level in codecLevels:
+        out = io.BytesIO()
+        startTime = time.perf_counter()
+        writer = CompressWriter(out, codec=codecName, level=level, workers=workers)
+        for i in range(0, len(sampleData), BLOCK_SIZE):
+            writer.write(sampleData[i:i+BLOCK_SIZE])
+        writer.close()
+        seconds = max(time.perf_counter() - startTime, 1e-9)
+        results.append({
+                            "Codec"     :   writer.codec,
+                            "Level"     :   writer.level,
+                            "Ratio"     :   len(sampleData) / max(len(out.getvalue()), 1),
+                            "MBps"      :   len(sampleData) / seconds / 1000000,
+                        })
+    return results
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in compress")
+    import gzip, tarfile
+    data = b"".join(b"line %d of test data\n" % i for i in range(200000))
+    decompressors = {"gzip": gzip.decompress, "bz2": bz2.decompress, "xz": lzma.decompress, "none": bytes}
+    for codecName in CODECS:
+        for workers in (1, 4):
+            out = io.BytesIO()
+            writer = CompressWriter(out, codec=codecName, workers=workers, blockSize=64 * 1024)
+            for i in range(0, len(data), 10000):
+                writer.write(data[i:i+10000])
+            assert writer.tell() == len(data)
+            writer.close()
+            assert writer.closed and not out.closed
+            assert decompressors[codecName](out.getvalue()) == data
+            if codecName != "none":
+                assert len(out.getvalue()) < len(data) // 4
+    # Incompressible data stored, in the same valid stream
+    noise = os.urandom(200000)
+    for codecName in CODECS:
+        for workers in (1, 4):
+            out = io.BytesIO()
+            writer = CompressWriter(out, codec=codecName, workers=workers, blockSize=64 * 1024)
+            writer.write(data[:100000])
+            writer.set_store(True)
+            writer.write(noise)
+            writer.set_store(False)
+            writer.write(data[100000:200000])
+            writer.close()
+            assert decompressors[codecName](out.getvalue()) == data[:100000] + noise + data[100000:200000]
+    out = io.BytesIO()
+    writer = CompressWriter(out, level=6)
+    writer.set_store(True)
+    assert writer.level == 0 and writer.position == 0
+    writer.write(noise)
+    writer.set_store(False)
+    assert writer.level == 6
+    writer.close()
+    assert len(noise) < len(out.getvalue()) < len(noise) * 1.01
+    # Flush points, where decompression can start
+    for workers in (1, 3):
+        out = io.BytesIO()
+        writer = CompressWriter(out, workers=workers, blockSize=64 * 1024)
+        writer.write(data[:100000])
+        writer.restart()
+        writer.restart()
+        writer.write(data[100000:300000])
+        writer.close()
+        assert writer.compressedPosition == len(out.getvalue())
+        assert 100000 in [p[0] for p in writer.flushPoints]
+        assert len(writer.flushPoints) == (2 if workers == 1 else 6)
+        for position, compressedPosition in writer.flushPoints:
+            assert gzip.decompress(out.getvalue()[compressedPosition:]) == data[position:300000]
+    # Compression policy
+    assert get_entropy(b"") == 0 and get_entropy(b"aaaa") == 0 and get_entropy(bytes(range(256))) == 8
+    policy = CompressPolicy()
+    assert policy.is_incompressible("/a/b.JPG", io.BytesIO(), MIN_STORE_SIZE)
+    assert not policy.is_incompressible("/a/b.jpg", io.BytesIO(), MIN_STORE_SIZE - 1)
+    sampleFile = io.BytesIO(noise)
+    assert policy.is_incompressible("/a/b.dat", sampleFile, len(noise)) and sampleFile.tell() == 0
+    assert not policy.is_incompressible("/a/b.dat", io.BytesIO(data), len(data))
+    assert policy.storedFiles == 2 and policy.storedBytes == MIN_STORE_SIZE + len(noise)
+    # Empty stream is still a valid gzip file
+    out = io.BytesIO()
+    CompressWriter(out, workers=2).close()
+    assert gzip.decompress(out.getvalue()) == b""
+    # Tar stream readable as one archive
+    out = io.BytesIO()
+    writer = CompressWriter(out, workers=3, blockSize=4096)
+    with tarfile.open(fileobj=writer, mode="w") as tar:
+        for i in range(20):
+            tarInfo = tarfile.TarInfo("file%d" % i)
+            tarInfo.size = len(data[:5000 * i])
+            tar.addfile(tarInfo, io.BytesIO(data[:5000 * i]))
+    writer.close()
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode="r:gz") as tar:
+        assert tar.extractfile("file19").read() == data[:5000 * 19]
+    assert get_worker_count(3) == 3 and get_worker_count(0) >= 1
+    # Codec settings
+    assert get_codec("lzma") == "xz" and get_extension("bz2") == ".tbz2"
+    assert get_level("gzip", None) == 9 and get_level("xz", 2) == 2
+    for badCall in (lambda: get_codec("zip"), lambda: get_level("bz2", 0)):
+        try:
+            badCall()
+            assert False, "Invalid codec setting accepted"
+        except ValueError:
+            pass
+    assert get_mime_type("/a/b_1.txz") == ("application", "x-xz")
+    assert get_mime_type("/a/LICENSE") == ("application", "octet-stream")
+    assert ".tar" in get_all_extensions()
+    results = bench_codecs(data[:200000], [("gzip", 1), ("none", None)])
+    assert results[0]["Ratio"] > 1 and results[1]["Ratio"] == 1.0 and results[0]["MBps"] > 0
+    print("All compress tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
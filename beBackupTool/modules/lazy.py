@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lazy imports, so the commandline starts quickly and loads only what the
+command run uses
+
+A module imported with lazy_import() is loaded on first use of any of
+its attributes, with the modules it imports in turn, rather than when
+imported. Loading is then the same as by the import statement
+"""
+
+import sys, importlib, importlib.util
+
+
+def lazy_import(moduleName):
+    """
+    Returns module *moduleName*, as an absolute name, loaded on first use
+    of one of its attributes, or the module itself if already loaded
+    """
+    if moduleName in sys.modules:
+        return sys.modules[moduleName]
+    parentName, _, childName = moduleName.rpartition(".")
+    parent = importlib.import_module(parentName) if parentName else None
+    spec = importlib.util.find_spec(moduleName)
+    if spec is None:
+        raise ImportError("No module named '%s'" % moduleName, name=moduleName)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[moduleName] = module
+    spec.loader.exec_module(module)
+    if parent is not None:
+        # As the import statement does, for "from package import module"
+        setattr(parent, childName, module)
+    return module
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in lazy")
+    import os, tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_lazy_")
+    try:
+        os.makedirs(os.path.join(testDir, "lazypkg"))
+        open(os.path.join(testDir, "lazypkg", "__init__.py"), "w").close()
+        with open(os.path.join(testDir, "lazypkg", "heavy.py"), "w") as fp:
+            fp.write("import sys\nsys.lazyTestLoaded = True\nVALUE = 42\n")
+        sys.path.insert(0, testDir)
+        try:
+            module = lazy_import("lazypkg.heavy")
+            assert not hasattr(sys, "lazyTestLoaded")
+            assert lazy_import("lazypkg.heavy") is module
+            from lazypkg import heavy
+            assert heavy is module and not hasattr(sys, "lazyTestLoaded")
+            assert module.VALUE == 42 and sys.lazyTestLoaded
+            try:
+                lazy_import("lazypkg.missing")
+                assert False, "Missing module not reported"
+            except ImportError:
+                pass
+        finally:
+            sys.path.remove(testDir)
+            for name in ("lazypkg.heavy", "lazypkg"):
+                sys.modules.pop(name, None)
+            if hasattr(sys, "lazyTestLoaded"):
+                del sys.lazyTestLoaded
+    finally:
+        shutil.rmtree(testDir)
+    print("All lazy tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
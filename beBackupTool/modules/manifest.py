@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Manifest functions for incremental and differential backups
+
+A manifest records the path, size, mtime_ns, inode and mode of every
+scanned entry of a run. The next run archives only entries that are new
+or changed since the base manifest, which for incremental runs is that
+of the last run and for differential runs that of the last full run
+"""
+
+import sys, os, time, json, gzip
+
+BACKUP_MODES = ("full", "incremental", "differential")
+
+# Archive member listing paths deleted since the base manifest
+DELETED_MEMBER_NAME = ".beBackupTool/deleted.json"
+
+
+def get_manifest_paths(tarDir, tarNameStem):
+    """
+    Returns tuple of paths of the last run and last full run manifests
+    """
+    return (os.path.join(tarDir, tarNameStem + ".last-manifest.json.gz"),
+            os.path.join(tarDir, tarNameStem + ".full-manifest.json.gz"))
+
+
+def load_manifest(manifestPath):
+    """
+    Returns manifest dict read from *manifestPath*, or None if it is
+    missing or unreadable, in which case a full backup is due
+    """
+    try:
+        with gzip.open(manifestPath, "rt", encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        if not isinstance(manifest, dict) or not isinstance(manifest.get("entries"), dict):
+            return None
+        return manifest
+    except Exception:
+        return None
+
+
+def save_manifest(manifestPath, manifest):
+    """
+    Writes *manifest* dict to *manifestPath*, replacing any old one only
+    once the new one is complete
+    """
+    tmpPath = manifestPath + ".tmp"
+    with gzip.open(tmpPath, "wt", encoding="utf-8") as fp:
+        json.dump(manifest, fp, separators=(",", ":"))
+    os.replace(tmpPath, manifestPath)
+
+
+def choose_backup_type(backupMode, fullEvery, lastManifest, fullManifest):
+    """
+    Returns "full", "incremental" or "differential" for this run
+
+    A full backup is taken if *backupMode* is "full", if there is no base
+    manifest, or if *fullEvery* days (if greater than 0) have passed
+    since the last full backup
+    """
+    if backupMode not in BACKUP_MODES or backupMode == "full":
+        return "full"
+    if fullManifest is None or (backupMode == "incremental" and lastManifest is None):
+        return "full"
+    if fullEvery > 0 and fullManifest.get("timestamp", 0) <= int(time.time()) - fullEvery * 24 * 60 * 60:
+        return "full"
+    return backupMode
+
+
+def stat_entry(path):
+    """
+    Returns manifest entry list of size, mtime_ns, inode and mode of
+    *path*, not following symlinks, or None if it has vanished
+
+    The stat result carried by a backup.ScannedPath is used if present
+    """
+    st = getattr(path, "stat", None)
+    if st is None:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode]
+
+
+def filter_changed_files(backupObjects, baseEntries, newEntries):
+    """
+    Wraps *backupObjects*, as from backup.iter_backup_objects(), yielding
+    for each backup object a generator of only the paths that are new or
+    changed compared to *baseEntries*
+
+    Every scanned path is recorded in the *newEntries* dict, so once the
+    generators are consumed it holds the manifest entries of this run.
+    The first path, the backup folder itself, is always yielded, as
+    write_tar_file() derives the archive layout from it
+    """
+    for filesToArchive in backupObjects:
+        yield _filter_changed_object(filesToArchive, baseEntries, newEntries)
+
+
+def _filter_changed_object(filesToArchive, baseEntries, newEntries):
+    isFirst = True
+    for fp in filesToArchive:
+        entry = stat_entry(fp)
+        if entry is None:
+            continue
+        newEntries[fp] = entry
+        if isFirst or baseEntries.get(fp) != entry:
+            yield fp
+        isFirst = False
+
+
+def find_deleted_paths(baseEntries, newEntries):
+    """
+    Returns sorted list of paths in *baseEntries* not in *newEntries*
+    """
+    return sorted(fp for fp in baseEntries if fp not in newEntries)
+
+
+def create_manifest(backupType, tarPath, entries, deleted, fullManifest):
+    """
+    Returns manifest dict for a run of *backupType* that wrote *tarPath*
+    """
+    timestamp = int(time.time())
+    if backupType == "full" or fullManifest is None:
+        fullTimestamp = timestamp
+    else:
+        fullTimestamp = fullManifest.get("timestamp", timestamp)
+    return {
+                "version"       :   1,
+                "type"          :   backupType,
+                "timestamp"     :   timestamp,
+                "fullTimestamp" :   fullTimestamp,
+                "archive"       :   tarPath,
+                "deleted"       :   deleted,
+                "entries"       :   entries,
+            }
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in manifest")
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_manifest_")
+    try:
+        bkpDir = os.path.join(testDir, "data")
+        os.mkdir(bkpDir)
+        for n in ("a.txt", "b.txt", "c.txt"):
+            with open(os.path.join(bkpDir, n), "w") as fp:
+                fp.write(n)
+        paths = [bkpDir] + [os.path.join(bkpDir, n) for n in ("a.txt", "b.txt", "c.txt")]
+
+        # First run records everything
+        entries = {}
+        changed = [list(x) for x in filter_changed_files([iter(paths)], {}, entries)]
+        assert changed == [paths]
+        assert sorted(entries) == sorted(paths)
+
+        # Save and reload
+        lastPath, fullPath = get_manifest_paths(testDir, "test")
+        assert load_manifest(lastPath) is None
+        manifest = create_manifest("full", "/x.tgz", entries, [], None)
+        save_manifest(lastPath, manifest)
+        loaded = load_manifest(lastPath)
+        assert loaded["entries"] == entries and loaded["type"] == "full"
+        assert loaded["fullTimestamp"] == loaded["timestamp"]
+
+        # Second run yields folder, changed and new files only, and finds deletions
+        with open(paths[1], "w") as fp:
+            fp.write("changed content")
+        os.remove(paths[2])
+        newFile = os.path.join(bkpDir, "d.txt")
+        with open(newFile, "w") as fp:
+            fp.write("d")
+        newEntries = {}
+        changed = [list(x) for x in filter_changed_files([iter(paths + [newFile])], loaded["entries"], newEntries)]
+        assert changed == [[bkpDir, paths[1], newFile]]
+        assert find_deleted_paths(loaded["entries"], newEntries) == [paths[2]]
+
+        # Backup type policy
+        assert choose_backup_type("full", 0, loaded, loaded) == "full"
+        assert choose_backup_type("incremental", 0, None, None) == "full"
+        assert choose_backup_type("incremental", 0, None, loaded) == "full"
+        assert choose_backup_type("differential", 0, None, loaded) == "differential"
+        assert choose_backup_type("incremental", 7, loaded, loaded) == "incremental"
+        loaded["timestamp"] -= 8 * 24 * 60 * 60
+        assert choose_backup_type("incremental", 7, loaded, loaded) == "full"
+        assert choose_backup_type("incremental", 0, loaded, loaded) == "incremental"
+        incManifest = create_manifest("incremental", "/y.tgz", newEntries, [paths[2]], loaded)
+        assert incManifest["fullTimestamp"] == loaded["timestamp"]
+    finally:
+        shutil.rmtree(testDir)
+    print("All manifest tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
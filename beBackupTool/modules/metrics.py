@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-phase timing and counters of a backup run, logged as structured
+data and optionally exported as a JSON summary or a Prometheus textfile
+collector file, with optional cProfile or tracemalloc profiling
+"""
+
+import sys, os, time, json, contextlib, collections
+
+PROMETHEUS_PREFIX = "bebackuptool_"
+
+
+class RunMetrics(object):
+    """
+    Timings of the phases of one run, and counters and values of it
+    """
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.phases = collections.OrderedDict()
+        self.values = collections.OrderedDict()
+        self.status = "running"
+
+    @contextlib.contextmanager
+    def phase(self, phaseName):
+        """
+        Context manager timing the phase *phaseName*, adding to its time
+        if it is run more than once
+        """
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(phaseName, time.perf_counter() - startTime)
+
+    def add_phase_time(self, phaseName, seconds):
+        self.phases[phaseName] = self.phases.get(phaseName, 0.0) + seconds
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def update(self, values):
+        """
+        Sets the values of dict *values*, with names taken as is
+        """
+        for name, value in values.items():
+            self.values[name] = value
+
+    def as_dict(self):
+        """
+        Returns dict of all metrics, with derived throughputs
+        """
+        summary = collections.OrderedDict()
+        summary["Start-Time"] = int(self.startTime)
+        summary["Status"] = self.status
+        summary["Total-Seconds"] = round(time.time() - self.startTime, 6)
+        summary["Phases"] = collections.OrderedDict((k, round(v, 6)) for k, v in self.phases.items())
+        summary.update(self.values)
+        archiveSeconds = self.phases.get("Archive", 0)
+        if archiveSeconds > 0 and "Tar-Uncompressed-Bytes" in self.values:
+            summary["Tar-MBps"] = round(self.values["Tar-Uncompressed-Bytes"] / archiveSeconds / 1000000, 3)
+        if self.values.get("Tar-Compressed-Bytes"):
+            summary["Compression-Ratio"] = round(self.values.get("Tar-Uncompressed-Bytes", 0)
+                                                    / self.values["Tar-Compressed-Bytes"], 3)
+        return summary
+
+    def log(self, logger):
+        """
+        Writes the metrics as one JSON line to *logger*
+        """
+        logger.info("METRICS %s" % json.dumps(self.as_dict(), separators=(",", ":")))
+
+    def write_json(self, filePath):
+        write_file_atomically(filePath, json.dumps(self.as_dict(), indent=4) + "\n")
+
+    def write_prometheus(self, filePath):
+        """
+        Writes the numeric metrics in the Prometheus text format, for the
+        node exporter textfile collector, which needs a ".prom" file
+        """
+        summary = self.as_dict()
+        lines = []
+        for phaseName, seconds in summary.pop("Phases").items():
+            lines.append('%sphase_seconds{phase="%s"} %s' % (PROMETHEUS_PREFIX, to_metric_name(phaseName), seconds))
+        lines.append('%slast_run_success %d' % (PROMETHEUS_PREFIX, 1 if summary.pop("Status") == "success" else 0))
+        for name, value in summary.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append("%s%s %s" % (PROMETHEUS_PREFIX, to_metric_name(name), value))
+        write_file_atomically(filePath, "\n".join(lines) + "\n")
+
+
+def to_metric_name(name):
+    """
+    Returns *name*, like "Scan-Files", as a Prometheus metric name
+    """
+    return "".join(c if c.isalnum() else "_" for c in name.lower())
+
+
+def write_file_atomically(filePath, text):
+    """
+    Writes *text* to *filePath* via a temporary file, so readers never
+    see it half written
+    """
+    with open(filePath + ".tmp", "w", encoding="utf-8") as fp:
+        fp.write(text)
+    os.replace(filePath + ".tmp", filePath)
+
+
+def export_metrics(runMetrics, logger, configMetrics):
+    """
+    Logs *runMetrics* and writes the files set in *configMetrics*,
+    returning any error message
+    """
+    runMetrics.log(logger)
+    try:
+        if configMetrics.get("JSON-File"):
+            runMetrics.write_json(configMetrics["JSON-File"])
+        if configMetrics.get("Prometheus-File"):
+            runMetrics.write_prometheus(configMetrics["Prometheus-File"])
+    except Exception:
+        return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    return ""
+
+
+def read_logged_metrics(logPath, maxRuns=20):
+    """
+    Returns list of the metrics dicts of the last *maxRuns* runs, oldest
+    first, from the "METRICS" lines of the log at *logPath* and of its
+    rotated backups, "<logPath>.1" being the newest of them
+    """
+    rotatedPaths = []
+    n = 1
+    while os.path.exists("%s.%d" % (logPath, n)):
+        rotatedPaths.insert(0, "%s.%d" % (logPath, n))
+        n += 1
+    runs = []
+    for filePath in rotatedPaths + [logPath]:
+        try:
+            with open(filePath, "r", encoding="utf-8", errors="replace") as fp:
+                for line in fp:
+                    position = line.find("METRICS {")
+                    if position < 0 or (position > 0 and line[position - 1] != " "):
+                        continue
+                    try:
+                        runs.append(json.loads(line[position + len("METRICS "):]))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return runs[-maxRuns:] if maxRuns else runs
+
+
+def run_profiled(runFunc, profiler, profileFile, logger):
+    """
+    Returns result of *runFunc*, run under *profiler*, "cProfile" or
+    "tracemalloc", or without one if empty. cProfile stats are saved to
+    *profileFile*, for pstats, and the tracemalloc peak and top
+    allocations are logged and written to it
+    """
+    if profiler == "cProfile":
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(runFunc)
+        finally:
+            profile.dump_stats(profileFile)
+            logger.info("cProfile stats saved to '%s'" % profileFile)
+    elif profiler == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start(10)
+        try:
+            return runFunc()
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            topStats = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            tracemalloc.stop()
+            report = ["Peak traced memory: %d bytes" % peak] + [str(s) for s in topStats]
+            logger.info("tracemalloc peak %d bytes" % peak)
+            write_file_atomically(profileFile, "\n".join(report) + "\n")
+    return runFunc()
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in metrics")
+    import logging, tempfile, shutil
+    runMetrics = RunMetrics()
+    with runMetrics.phase("Archive"):
+        time.sleep(0.01)
+    runMetrics.add_phase_time("Archive", 0.5)
+    runMetrics.set("Tar-Uncompressed-Bytes", 4000000)
+    runMetrics.set("Tar-Compressed-Bytes", 1000000)
+    runMetrics.update({"Scan-Files": 10, "Archive-Path": "/x.tgz"})
+    runMetrics.status = "success"
+    summary = runMetrics.as_dict()
+    assert 0.51 <= summary["Phases"]["Archive"] < 1
+    assert summary["Compression-Ratio"] == 4.0 and 4 < summary["Tar-MBps"] < 8
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_metrics_")
+    try:
+        configMetrics = {"JSON-File": os.path.join(testDir, "run.json"), "Prometheus-File": os.path.join(testDir, "run.prom")}
+        assert export_metrics(runMetrics, logging.getLogger("metrics-test"), configMetrics) == ""
+        with open(configMetrics["JSON-File"]) as fp:
+            assert json.load(fp)["Scan-Files"] == 10
+        with open(configMetrics["Prometheus-File"]) as fp:
+            promLines = fp.read().splitlines()
+        assert 'bebackuptool_phase_seconds{phase="archive"} %s' % summary["Phases"]["Archive"] in promLines
+        assert "bebackuptool_scan_files 10" in promLines and "bebackuptool_last_run_success 1" in promLines
+        assert not [x for x in promLines if "archive_path" in x]
+        # Read back from the log and its rotated backups
+        logPath = os.path.join(testDir, "app.log")
+        handler = logging.FileHandler(logPath)
+        testLogger = logging.getLogger("metrics-test-log")
+        testLogger.addHandler(handler)
+        testLogger.setLevel(logging.INFO)
+        runMetrics.log(testLogger)
+        testLogger.info("Backup done.")
+        handler.close()
+        testLogger.removeHandler(handler)
+        with open(logPath + ".1", "w") as fp:
+            fp.write("2024/01/01 - INFO - METRICS {\"Status\":\"error\"}\n")
+            fp.write("2024/01/01 - INFO - METRICS {broken\n")
+        loggedRuns = read_logged_metrics(logPath)
+        assert [r["Status"] for r in loggedRuns] == ["error", "success"]
+        assert loggedRuns[1]["Tar-Uncompressed-Bytes"] == 4000000
+        assert read_logged_metrics(logPath, maxRuns=1) == loggedRuns[1:]
+        assert read_logged_metrics(os.path.join(testDir, "missing.log")) == []
+        # Profilers
+        profileFile = os.path.join(testDir, "profile")
+        assert run_profiled(lambda: 42, "cProfile", profileFile, logging.getLogger("metrics-test")) == 42
+        import pstats
+        pstats.Stats(profileFile)
+        assert run_profiled(lambda: [0] * 1000, "tracemalloc", profileFile, logging.getLogger("metrics-test")) == [0] * 1000
+        with open(profileFile) as fp:
+            assert fp.read().startswith("Peak traced memory")
+    finally:
+        shutil.rmtree(testDir)
+    print("All metrics tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
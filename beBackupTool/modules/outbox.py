@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Outbox spool for emailing archives in the background, with retries
+
+An archive to email is queued as a job file in the outbox folder, once
+it is on disk for good, and the backup run goes on without waiting for
+the mail server. A deliverer, run with "BackupApp.py --deliver", sends
+the queued archives to each recipient in parallel, recording every part
+sent in the job file, so nothing is sent twice, and retries failures
+with exponential backoff. Only one deliverer runs at a time
+"""
+
+import sys, os, time, json, fcntl, random, hashlib, asyncio, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import sendEmail, volumes
+except ImportError: # Run as a script for testing
+    import sendEmail, volumes
+
+JOB_SUFFIX = ".job.json"
+FAILED_SUFFIX = ".failed.json"
+SENT_LEDGER_NAME = "sent.json"
+LOCK_NAME = ".deliver.lock"
+
+# Number of delivered jobs remembered, so the same archive is not queued again
+SENT_LEDGER_SIZE = 1000
+
+# Seconds to wait before the first retry, doubled on each one, up to the max
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+
+# Seconds a deliverer waits for retries that are due, before leaving them
+# to the next one, and between checks for new jobs
+DELIVER_WAIT_SECONDS = 3600
+POLL_SECONDS = 5
+
+# Recipients sent to at once
+MAX_PARALLEL_SENDS = 4
+
+
+class Outbox(object):
+    """
+    Spool of email jobs in the folder *outboxDir*, created if missing
+    """
+
+    def __init__(self, outboxDir):
+        self.outboxDir = outboxDir
+        self.lock = threading.Lock()
+        self.lockFile = None
+        os.makedirs(outboxDir, exist_ok=True)
+
+    def get_job_path(self, jobId, suffix=JOB_SUFFIX):
+        return os.path.join(self.outboxDir, jobId + suffix)
+
+    def enqueue(self, tarFilePath, recipients, sha256=None):
+        """
+        Queues the archive at *tarFilePath*, possibly split into volumes,
+        to be emailed to the *recipients*, after flushing it to disk
+
+        Returns the job id, or "" if the archive is queued or was sent
+        already
+        """
+        filePaths = volumes.list_archive_files(tarFilePath)
+        jobId = get_job_id(tarFilePath, sha256)
+        if os.path.exists(self.get_job_path(jobId)) or jobId in self.load_sent_ledger():
+            return ""
+        for filePath in filePaths:
+            sync_file(filePath)
+        job = {
+                "Id"            :   jobId,
+                "Archive"       :   os.path.abspath(tarFilePath),
+                "Files"         :   [os.path.abspath(x) for x in filePaths],
+                "Recipients"    :   list(recipients),
+                "Sent"          :   [],
+                "Attempts"      :   0,
+                "Next-Attempt"  :   0,
+                "Last-Error"    :   "",
+                "Created"       :   int(time.time()),
+            }
+        self.save_job(job)
+        return jobId
+
+    def save_job(self, job, suffix=JOB_SUFFIX):
+        """
+        Writes the *job* file, flushed to disk, replacing any old one
+        """
+        with self.lock:
+            write_json_durably(self.get_job_path(job["Id"], suffix), job)
+
+    def load_jobs(self):
+        """
+        Returns list of the queued jobs, oldest first
+        """
+        jobs = []
+        for fileName in sorted(os.listdir(self.outboxDir)):
+            if not fileName.endswith(JOB_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.outboxDir, fileName), "r", encoding="utf-8") as fp:
+                    jobs.append(json.load(fp))
+            except (OSError, ValueError):
+                continue
+        return sorted(jobs, key=lambda j: (j["Created"], j["Id"]))
+
+    def load_failed_jobs(self):
+        return [x for x in sorted(os.listdir(self.outboxDir)) if x.endswith(FAILED_SUFFIX)]
+
+    def load_sent_ledger(self):
+        """
+        Returns dict of the ids of delivered jobs and the times they were
+        """
+        try:
+            with open(os.path.join(self.outboxDir, SENT_LEDGER_NAME), "r", encoding="utf-8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def mark_sent(self, job, recipient, partNum):
+        """
+        Records part *partNum* of *job* sent to *recipient*, in the job
+        file, before anything else is sent
+        """
+        with self.lock:
+            job["Sent"].append([recipient, partNum])
+            write_json_durably(self.get_job_path(job["Id"]), job)
+
+    def finish_job(self, job):
+        """
+        Removes the delivered *job*, remembering its id
+        """
+        with self.lock:
+            sentLedger = self.load_sent_ledger()
+            sentLedger[job["Id"]] = int(time.time())
+            if len(sentLedger) > SENT_LEDGER_SIZE:
+                sentLedger = dict(sorted(sentLedger.items(), key=lambda x: x[1])[-SENT_LEDGER_SIZE:])
+            write_json_durably(os.path.join(self.outboxDir, SENT_LEDGER_NAME), sentLedger)
+            os.remove(self.get_job_path(job["Id"]))
+
+    def drop_job(self, job):
+        """
+        Removes the *job* whose archive is gone, as deleted by retention
+        """
+        with self.lock:
+            os.remove(self.get_job_path(job["Id"]))
+
+    def retry_later(self, job, errorText, maxAttempts):
+        """
+        Sets the time *job* is retried, further off after each attempt,
+        or moves it aside as failed after *maxAttempts*
+        """
+        job["Attempts"] += 1
+        job["Last-Error"] = errorText
+        if job["Attempts"] >= maxAttempts:
+            self.save_job(job, FAILED_SUFFIX)
+            os.remove(self.get_job_path(job["Id"]))
+            return False
+        job["Next-Attempt"] = time.time() + get_retry_delay(job["Attempts"])
+        self.save_job(job)
+        return True
+
+    def try_lock(self):
+        """
+        Returns bool whether the delivery lock was taken, which is held
+        until unlock() or the process ends
+        """
+        lockFile = open(os.path.join(self.outboxDir, LOCK_NAME), "w")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockFile.close()
+            return False
+        self.lockFile = lockFile
+        return True
+
+    def unlock(self):
+        if self.lockFile is not None:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+            self.lockFile.close()
+            self.lockFile = None
+
+    def get_next_attempt(self):
+        """
+        Returns time the next queued job is due, or None if none is
+        """
+        jobs = self.load_jobs()
+        return min(j["Next-Attempt"] for j in jobs) if jobs else None
+
+    async def deliver(self, configEmail, maxWait=DELIVER_WAIT_SECONDS, maxAttempts=10, deliverStats=None):
+        """
+        Delivers the queued jobs as they fall due, and jobs queued
+        meanwhile, until none is due within *maxWait* seconds of the
+        start, retrying each up to *maxAttempts* times
+
+        Jobs whose archive files are gone, as deleted by retention while
+        queued, are dropped rather than retried
+
+        The *deliverStats* dict is given the numbers of "messages" and
+        "bytes" sent, and of jobs "delivered", "retried", "failed" and
+        "dropped"
+        """
+        if deliverStats is None:
+            deliverStats = {}
+        for name in ("messages", "bytes", "delivered", "retried", "failed", "dropped"):
+            deliverStats.setdefault(name, 0)
+        deadline = time.time() + maxWait
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(MAX_PARALLEL_SENDS)
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_SENDS) as executor:
+
+            async def send_to(job, recipient):
+                async with semaphore:
+                    return await loop.run_in_executor(executor, self.send_job, job, recipient,
+                                                        configEmail, deliverStats)
+
+            while True:
+                timeNow = time.time()
+                jobs = self.load_jobs()
+                dueJobs = [j for j in jobs if j["Next-Attempt"] <= timeNow]
+                for job in [j for j in dueJobs if not all(os.path.exists(x) for x in j["Files"])]:
+                    self.drop_job(job)
+                    dueJobs.remove(job)
+                    deliverStats["dropped"] += 1
+                if not dueJobs:
+                    nextAttempt = min([j["Next-Attempt"] for j in jobs] or [deadline + 1])
+                    if nextAttempt > deadline:
+                        break
+                    await asyncio.sleep(min(nextAttempt - timeNow, POLL_SECONDS))
+                    continue
+                sends = [(job, r) for job in dueJobs for r in job["Recipients"]]
+                sendErrors = await asyncio.gather(*[send_to(job, r) for job, r in sends])
+                for job in dueJobs:
+                    jobErrors = [e for (j, r), e in zip(sends, sendErrors) if j is job and e]
+                    if not jobErrors:
+                        self.finish_job(job)
+                        deliverStats["delivered"] += 1
+                    elif self.retry_later(job, jobErrors[0], maxAttempts):
+                        deliverStats["retried"] += 1
+                    else:
+                        deliverStats["failed"] += 1
+        return deliverStats
+
+    def send_job(self, job, recipient, configEmail, deliverStats):
+        """
+        Sends the parts of *job* not yet sent to *recipient* over one
+        SMTP connection, in a worker thread
+
+        Returns error message, empty if all parts were sent
+        """
+        sentParts = set(p for r, p in job["Sent"] if r == recipient)
+        partNums = [n for n in range(1, len(job["Files"]) + 1) if n not in sentParts]
+        if not partNums:
+            return ""
+        recipientEmail = dict(configEmail, **{"Address-To": recipient})
+        emailStats = {"bytes": 0}
+        try:
+            with sendEmail.open_smtp_connection(configEmail) as s:
+                for partNum in partNums:
+                    filePath = job["Files"][partNum - 1]
+                    msgHead, msgTail = sendEmail.create_part_envelope(job["Files"], partNum, recipientEmail,
+                                                messageId=get_message_id(job["Id"], recipient, partNum))
+                    chunks = sendEmail.iter_counted_chunks(sendEmail.iter_message_chunks(filePath, msgHead, msgTail),
+                                                            emailStats)
+                    sendEmail.send_streamed_message(s, configEmail["Address-From"], [recipient], chunks)
+                    self.mark_sent(job, recipient, partNum)
+                    with self.lock:
+                        deliverStats["messages"] += 1
+        except Exception as e:
+            return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        finally:
+            with self.lock:
+                deliverStats["bytes"] += emailStats["bytes"]
+        return ""
+
+
+def get_job_id(tarFilePath, sha256=None):
+    """
+    Returns id of the job emailing the archive, the same each time the
+    same archive is queued
+    """
+    key = "%s:%s" % (os.path.basename(tarFilePath), sha256 or os.path.getsize(volumes.list_archive_files(tarFilePath)[0]))
+    return "%s-%s" % (os.path.basename(tarFilePath), hashlib.sha256(key.encode("utf-8")).hexdigest()[:12])
+
+
+def get_message_id(jobId, recipient, partNum):
+    """
+    Returns Message-ID header of part *partNum* of job *jobId* to
+    *recipient*, the same on each attempt
+    """
+    recipientHash = hashlib.sha256(recipient.encode("utf-8")).hexdigest()[:12]
+    return "<%s.%d.%s@beBackupTool>" % (jobId.rsplit("-", 1)[1], partNum, recipientHash)
+
+
+def get_retry_delay(attempts):
+    """
+    Returns seconds to wait after the failed attempt number *attempts*,
+    doubling each time up to the max, with some jitter so jobs spread
+    """
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.9, 1.1)
+
+
+def sync_file(filePath):
+    """
+    Flushes the file at *filePath* to disk
+    """
+    with open(filePath, "rb") as fp:
+        os.fsync(fp.fileno())
+
+
+def write_json_durably(filePath, data):
+    """
+    Writes *data* as JSON to *filePath* via a temporary file flushed to
+    disk, and then the rename of it
+    """
+    with open(filePath + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=1)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(filePath + ".tmp", filePath)
+    dirFd = os.open(os.path.dirname(os.path.abspath(filePath)), os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+
+def deliver_outbox(outboxDir, configEmail, maxWait=DELIVER_WAIT_SECONDS, maxAttempts=10):
+    """
+    Delivers the jobs queued in *outboxDir*, unless another deliverer
+    is running, see Outbox.deliver()
+
+    Returns report of the jobs delivered, retried and failed, or error
+    """
+    outbox = Outbox(outboxDir)
+    deliverStats = {}
+    while True:
+        if not outbox.try_lock():
+            return "Outbox delivery already running"
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(outbox.deliver(configEmail, maxWait, maxAttempts, deliverStats))
+        except Exception as e:
+            return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        finally:
+            loop.close()
+            outbox.unlock()
+        # A job queued just before the lock was released, whose own 
+        # deliverer found it taken, is delivered here
+        nextAttempt = outbox.get_next_attempt()
+        if nextAttempt is None or nextAttempt > time.time():
+            break
+    return "Outbox: %d jobs delivered in %d messages, %d to retry, %d failed, %d dropped, %d queued" \
+            % (deliverStats["delivered"], deliverStats["messages"], deliverStats["retried"],
+                deliverStats["failed"], deliverStats["dropped"], len(outbox.load_jobs()))
+
+
+def spawn_deliverer(commandArgs):
+    """
+    Starts the deliverer command *commandArgs* detached, in a session of
+    its own so it outlives the backup run, and returns without waiting
+    """
+    with open(os.devnull, "r+b") as devNull:
+        subprocess.Popen(commandArgs, stdin=devNull, stdout=devNull, stderr=devNull, close_fds=True,
+                            start_new_session=True)
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in outbox")
+    import tempfile, shutil
+    try:
+        from . import smtpSink
+    except ImportError:
+        import smtpSink
+    assert 54 <= get_retry_delay(1) <= 66 and 108 <= get_retry_delay(2) <= 132
+    assert get_retry_delay(30) <= RETRY_MAX_SECONDS * 1.1
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_outbox_")
+    try:
+        outboxDir = os.path.join(testDir, "outbox")
+        tarPath = os.path.join(testDir, "test_1.tgz")
+        writer = volumes.VolumeWriter(tarPath, 3000)
+        writer.write(os.urandom(7000))
+        writer.close()
+        configEmail = {"Address-From": "from@address.com", "Subject": "Backup File", "Body": "Body",
+                        "SMTP-Host": "127.0.0.1"}
+        recipients = ["a@address.com", "b@address.com"]
+        outbox = Outbox(outboxDir)
+        jobId = outbox.enqueue(tarPath, recipients)
+        assert jobId and outbox.enqueue(tarPath, recipients) == ""
+        # Mail server down, so the job is retried later
+        with smtpSink.SMTPSink() as sink:
+            closedPort = sink.port
+        configEmail["SMTP-Port"] = closedPort
+        report = deliver_outbox(outboxDir, configEmail, maxWait=0)
+        assert report.startswith("Outbox: 0 jobs delivered in 0 messages, 1 to retry"), report
+        job = outbox.load_jobs()[0]
+        assert job["Attempts"] == 1 and job["Next-Attempt"] > time.time() + 50 and "ERROR" in job["Last-Error"]
+        # Sent to both recipients, skipping the part already sent to one
+        outbox.mark_sent(job, "a@address.com", 1)
+        job["Next-Attempt"] = 0
+        outbox.save_job(job)
+        with smtpSink.SMTPSink(keepMessages=True) as sink:
+            configEmail["SMTP-Port"] = sink.port
+            assert outbox.try_lock()
+            assert deliver_outbox(outboxDir, configEmail, maxWait=0) == "Outbox delivery already running"
+            outbox.unlock()
+            report = deliver_outbox(outboxDir, configEmail, maxWait=0)
+        assert report.startswith("Outbox: 1 jobs delivered in 5 messages, 0 to retry, 0 failed, 0 dropped, 0 queued"), report
+        assert sink.messageCount == 5
+        messageIds = [m.split(b"Message-ID: ", 1)[1].split(b"\r\n", 1)[0] for m in sink.messages]
+        assert len(set(messageIds)) == 5
+        assert get_message_id(jobId, "b@address.com", 2).encode("ascii") in messageIds
+        assert outbox.load_jobs() == [] and jobId in outbox.load_sent_ledger()
+        assert outbox.enqueue(tarPath, recipients) == ""
+        # Given up on after the max attempts
+        os.remove(os.path.join(outboxDir, SENT_LEDGER_NAME))
+        jobId = outbox.enqueue(tarPath, recipients)
+        configEmail["SMTP-Port"] = closedPort
+        report = deliver_outbox(outboxDir, configEmail, maxWait=0, maxAttempts=1)
+        assert report.startswith("Outbox: 0 jobs delivered in 0 messages, 0 to retry, 1 failed"), report
+        assert outbox.load_failed_jobs() == [jobId + FAILED_SUFFIX]
+        # Dropped, not retried, once retention deleted the archive
+        os.remove(os.path.join(outboxDir, jobId + FAILED_SUFFIX))
+        jobId = outbox.enqueue(tarPath, recipients)
+        os.remove(volumes.get_volume_path(tarPath, 2))
+        report = deliver_outbox(outboxDir, configEmail, maxWait=0)
+        assert report == "Outbox: 0 jobs delivered in 0 messages, 0 to retry, 0 failed, 1 dropped, 0 queued", report
+        assert outbox.load_failed_jobs() == [] and jobId not in outbox.load_sent_ledger()
+    finally:
+        shutil.rmtree(testDir)
+    print("All outbox tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
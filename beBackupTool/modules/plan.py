@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Dry run of a backup, for --plan, reporting what would be archived
+without reading any file but a small sample
+
+The backup folders are walked with os.scandir() using stat data only,
+counting the files and bytes of each backup object, and of each
+exclusion rule for those excluded. A sample of the files to archive,
+picked at random weighted by size, is compressed with the configured
+codec to estimate the archive size, and the runtime is predicted from
+the throughput of earlier runs, as logged on their METRICS lines
+"""
+
+import sys, os, io, heapq, random, collections, statistics
+
+try:
+    from . import backup, compress, manifest
+except ImportError: # Run as a script for testing
+    import backup, compress, manifest
+
+# Number of files sampled, and bytes read from the start of each, to
+# estimate the compression ratio
+SAMPLE_FILES = 64
+SAMPLE_FILE_BYTES = 256 * 1024
+
+# Phases of earlier runs whose time is predicted from the compressed
+# size, the others from their median time
+COMPRESSED_PHASES = ("Upload", "Email")
+
+
+def scan_plan_object(bo, compressPolicy=None, baseEntries=None, sampleFiles=SAMPLE_FILES, rng=None):
+    """
+    Walks backup object *bo* using stat data only, returning dict of its
+    counts, the counts excluded by each rule, and a size weighted random
+    sample of the files to archive, of up to *sampleFiles* paths
+
+    With *baseEntries*, the manifest entries of the base archive, only
+    the files changed since are to archive. With *compressPolicy*, the
+    files it stores by extension are counted apart, and not sampled.
+    Their content is not read, so files stored for their entropy are not
+    """
+    rng = rng or random.Random(0)
+    matcher = backup.ExclusionMatcher(bo)
+    rootPath = backup.strip_trailing_slash(bo["Backup-Folder"])
+    counts = collections.OrderedDict((k, 0) for k in ("Folders", "Files", "Bytes", "Archive-Files",
+                                                        "Archive-Bytes", "Stored-Bytes", "Errors"))
+    excluded = collections.OrderedDict()
+    # Weighted reservoir sample of (key, path), keeping the largest keys
+    sampleHeap = []
+
+    def exclude(rule, files, size):
+        ruleCounts = excluded.setdefault("%s %s" % rule, [0, 0])
+        ruleCounts[0] += files
+        ruleCounts[1] += size
+
+    if matcher.excludes_folder(rootPath):
+        exclude(matcher.find_rule(rootPath, os.path.basename(rootPath), True), *count_tree(rootPath))
+        return {"Backup-Folder": rootPath, "Counts": counts, "Excluded": excluded, "Sample": []}
+    pendingPaths = [rootPath]
+    while pendingPaths:
+        dirPath = pendingPaths.pop()
+        try:
+            with os.scandir(dirPath) as it:
+                entries = list(it)
+        except OSError:
+            counts["Errors"] += 1
+            continue
+        counts["Folders"] += 1
+        for entry in entries:
+            fp = os.path.join(dirPath, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not matcher.excludes_folder(fp):
+                        pendingPaths.append(fp)
+                    else:
+                        exclude(matcher.find_rule(fp, entry.name, True), *count_tree(fp))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                # Vanished since listed
+                continue
+            if matcher.excludes_file(fp, entry.name):
+                exclude(matcher.find_rule(fp, entry.name), 1, st.st_size)
+                continue
+            counts["Files"] += 1
+            counts["Bytes"] += st.st_size
+            if baseEntries is not None and baseEntries.get(fp) == manifest.stat_entry(backup.ScannedPath(fp, st)):
+                continue
+            counts["Archive-Files"] += 1
+            counts["Archive-Bytes"] += st.st_size
+            if compressPolicy is not None and st.st_size >= compressPolicy.minSize \
+                    and os.path.splitext(fp)[1].lower() in compressPolicy.extensions:
+                counts["Stored-Bytes"] += st.st_size
+            elif st.st_size > 0 and sampleFiles > 0:
+                key = rng.random() ** (1.0 / st.st_size)
+                if len(sampleHeap) < sampleFiles:
+                    heapq.heappush(sampleHeap, (key, fp))
+                elif key > sampleHeap[0][0]:
+                    heapq.heapreplace(sampleHeap, (key, fp))
+    return {"Backup-Folder": rootPath, "Counts": counts, "Excluded": excluded,
+            "Sample": sorted(fp for key, fp in sampleHeap)}
+
+
+def count_tree(dirPath):
+    """
+    Returns tuple of the number of files in folder *dirPath* and its
+    subfolders, and of their total bytes, from stat data only
+    """
+    files = 0
+    size = 0
+    pendingPaths = [dirPath]
+    while pendingPaths:
+        try:
+            with os.scandir(pendingPaths.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        pendingPaths.append(entry.path)
+                    else:
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            continue
+    return files, size
+
+
+def estimate_compression(samplePaths, codecName, level, maxFileBytes=SAMPLE_FILE_BYTES):
+    """
+    Compresses the first *maxFileBytes* of each of *samplePaths* with
+    *codecName* at *level*, returning tuple of the compression ratio,
+    the MB/s compressed and the bytes of the sample, or of 1.0, None
+    and 0 if nothing could be read
+    """
+    sampleData = io.BytesIO()
+    for fp in samplePaths:
+        try:
+            with open(fp, "rb") as f:
+                sampleData.write(f.read(maxFileBytes))
+        except OSError:
+            continue
+    sampleData = sampleData.getvalue()
+    if not sampleData:
+        return 1.0, None, 0
+    result = compress.bench_codecs(sampleData, [(codecName, level)])[0]
+    return result["Ratio"], result["MBps"], len(sampleData)
+
+
+def predict_seconds(archiveBytes, compressedBytes, loggedRuns, sampleMBps=None):
+    """
+    Returns tuple of OrderedDict of the predicted seconds of each phase
+    of a run archiving *archiveBytes* into *compressedBytes*, and of the
+    number of *loggedRuns*, dicts of earlier run metrics, it is based on
+
+    The archive phase runs at the median Tar-MBps of the runs that wrote
+    an archive, even if they failed later, or at *sampleMBps* without 
+    any. For the successful runs, the upload and email phases scale with
+    the compressed size, and other phases take their median time
+    """
+    archiveRuns = [r for r in loggedRuns if r.get("Tar-MBps")]
+    runs = [r for r in archiveRuns if r.get("Status") == "success"]
+    phaseSeconds = collections.OrderedDict()
+    archiveMBps = statistics.median([r["Tar-MBps"] for r in archiveRuns]) if archiveRuns else sampleMBps
+    if archiveMBps:
+        phaseSeconds["Archive"] = archiveBytes / 1000000 / archiveMBps
+    phaseNames = []
+    for r in runs:
+        phaseNames.extend(x for x in r.get("Phases", {}) if x != "Archive" and x not in phaseNames)
+    for phaseName in phaseNames:
+        if phaseName in COMPRESSED_PHASES:
+            rates = [r["Phases"][phaseName] / r["Tar-Compressed-Bytes"] for r in runs
+                        if phaseName in r.get("Phases", {}) and r.get("Tar-Compressed-Bytes")]
+            if rates:
+                phaseSeconds[phaseName] = statistics.median(rates) * compressedBytes
+        else:
+            phaseSeconds[phaseName] = statistics.median([r["Phases"].get(phaseName, 0) for r in runs])
+    return phaseSeconds, len(archiveRuns)
+
+
+def make_plan(backupObjects, codecName="gzip", level=None, compressPolicy=None, baseEntries=None,
+                loggedRuns=(), sampleFiles=SAMPLE_FILES):
+    """
+    Returns dict of the plan of a run archiving the valid ones of the
+    *backupObjects* dicts, with the scan of each object, see
+    scan_plan_object(), the totals, and the estimated compressed size
+    and seconds of each phase
+    """
+    rng = random.Random(0)
+    objectPlans = [scan_plan_object(bo, compressPolicy, baseEntries, sampleFiles, rng)
+                    for bo in backup.get_valid_backup_objects(backupObjects)]
+    totals = collections.OrderedDict()
+    for objectPlan in objectPlans:
+        for name, value in objectPlan["Counts"].items():
+            totals[name] = totals.get(name, 0) + value
+    # Sample across objects, in proportion to the bytes of each
+    samplePaths = []
+    compressBytes = totals.get("Archive-Bytes", 0) - totals.get("Stored-Bytes", 0)
+    for objectPlan in objectPlans:
+        objectBytes = objectPlan["Counts"]["Archive-Bytes"] - objectPlan["Counts"]["Stored-Bytes"]
+        share = int(round(sampleFiles * objectBytes / compressBytes)) if compressBytes else 0
+        samplePaths.extend(objectPlan["Sample"][:max(share, 1)])
+    ratio, sampleMBps, sampleBytes = estimate_compression(samplePaths, codecName, level)
+    compressedBytes = int(totals.get("Stored-Bytes", 0) + compressBytes / ratio)
+    phaseSeconds, basedOnRuns = predict_seconds(totals.get("Archive-Bytes", 0), compressedBytes, loggedRuns,
+                                                sampleMBps)
+    return {
+                "Codec"             :   codecName,
+                "Level"             :   compress.get_level(codecName, level),
+                "Objects"           :   objectPlans,
+                "Totals"            :   totals,
+                "Ratio"             :   ratio,
+                "Sample-Files"      :   len(samplePaths),
+                "Sample-Bytes"      :   sampleBytes,
+                "Compressed-Bytes"  :   compressedBytes,
+                "Phase-Seconds"     :   phaseSeconds,
+                "Based-On-Runs"     :   basedOnRuns,
+            }
+
+
+def format_plan(plan, backupType="full"):
+    """
+    Returns list of the lines of a report of *plan*, from make_plan()
+    """
+    def mb(size):
+        return "%.1f MB" % (size / 1000000)
+
+    lines = ["Backup plan: %s backup, %s level %s, from stat data only" % (backupType, plan["Codec"], plan["Level"])]
+    for objectPlan in plan["Objects"]:
+        counts = objectPlan["Counts"]
+        lines.append("")
+        lines.append(objectPlan["Backup-Folder"])
+        lines.append("    Included:   %d files in %d folders, %s" % (counts["Files"], counts["Folders"],
+                                                                    mb(counts["Bytes"])))
+        lines.append("    To archive: %d files, %s, of which %s stored uncompressed" % (counts["Archive-Files"],
+                                                    mb(counts["Archive-Bytes"]), mb(counts["Stored-Bytes"])))
+        for rule, (files, size) in sorted(objectPlan["Excluded"].items(), key=lambda x: -x[1][1]):
+            lines.append("    Excluded:   %d files, %s, by %s" % (files, mb(size), rule))
+        if counts["Errors"]:
+            lines.append("    Unreadable: %d folders" % counts["Errors"])
+    totals = plan["Totals"]
+    lines.append("")
+    lines.append("Total to archive: %d files, %s" % (totals.get("Archive-Files", 0), mb(totals.get("Archive-Bytes", 0))))
+    lines.append("Estimated archive size: %s, ratio %.2f on a %s sample of %d files" % (mb(plan["Compressed-Bytes"]),
+                                                    plan["Ratio"], mb(plan["Sample-Bytes"]), plan["Sample-Files"]))
+    phaseSeconds = plan["Phase-Seconds"]
+    if not phaseSeconds:
+        lines.append("Estimated runtime: unknown, no earlier runs or sample")
+    else:
+        basis = "the throughput of %d earlier runs" % plan["Based-On-Runs"] if plan["Based-On-Runs"] \
+                    else "the sample compression speed, archive phase only"
+        lines.append("Estimated runtime: %.1f s (%s), from %s" % (sum(phaseSeconds.values()),
+                        ", ".join("%s %.1f s" % x for x in phaseSeconds.items()), basis))
+    return lines
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in plan")
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_plan_")
+    try:
+        for name, data in (("a.txt", b"text line\n" * 10000), ("b.log", b"x" * 500), ("c.jpg", os.urandom(40000)),
+                            ("cache/d.txt", b"d" * 3000), ("cache/sub/e.txt", b"e" * 2000), ("sub/f.txt", b"f" * 700)):
+            os.makedirs(os.path.dirname(os.path.join(testDir, name)), exist_ok=True)
+            with open(os.path.join(testDir, name), "wb") as fp:
+                fp.write(data)
+        bo = {"Backup-Folder": testDir + "/", "Exclude-Folders": [os.path.join(testDir, "cache")],
+                "Exclude-Extensions": ["log"], "Exclude-Patterns": ["f.*"]}
+        policy = compress.CompressPolicy()
+        objectPlan = scan_plan_object(bo, policy)
+        assert objectPlan["Backup-Folder"] == testDir
+        assert list(objectPlan["Counts"].values()) == [2, 2, 140000, 2, 140000, 40000, 0], objectPlan["Counts"]
+        assert objectPlan["Excluded"] == {"Exclude-Folders %s" % os.path.join(testDir, "cache"): [2, 5000],
+                                            "Exclude-Extensions .log": [1, 500], "Exclude-Patterns f.*": [1, 700]}
+        assert objectPlan["Sample"] == [os.path.join(testDir, "a.txt")]
+        # Unchanged files are not to archive
+        baseEntries = {os.path.join(testDir, "a.txt"): manifest.stat_entry(os.path.join(testDir, "a.txt"))}
+        counts = scan_plan_object(bo, policy, baseEntries)["Counts"]
+        assert counts["Files"] == 2 and counts["Archive-Files"] == 1 and counts["Archive-Bytes"] == 40000
+        # Backup folder itself excluded
+        excludedPlan = scan_plan_object({"Backup-Folder": testDir, "Exclude-Patterns": ["beBackupTool_plan_*"]})
+        assert excludedPlan["Counts"]["Files"] == 0
+        assert excludedPlan["Excluded"] == {"Exclude-Patterns beBackupTool_plan_*": [6, 146200]}
+        # Weighted sample favours large files
+        sampleDir = os.path.join(testDir, "sample")
+        os.makedirs(sampleDir)
+        for i in range(20):
+            with open(os.path.join(sampleDir, "%02d.txt" % i), "wb") as fp:
+                fp.write(b"y" * (100000 if i == 7 else 10))
+        assert all(os.path.join(sampleDir, "07.txt") in scan_plan_object({"Backup-Folder": sampleDir}, sampleFiles=2,
+                    rng=random.Random(seed))["Sample"] for seed in range(10))
+        shutil.rmtree(sampleDir)
+        ratio, mbps, sampleBytes = estimate_compression([os.path.join(testDir, "a.txt"), "/nonexistent"], "gzip", 6)
+        assert ratio > 50 and mbps > 0 and sampleBytes == 100000
+        assert estimate_compression([], "gzip", 6) == (1.0, None, 0)
+        # Runtime from earlier runs, or the sample speed without
+        loggedRuns = [
+                        {"Status": "success", "Tar-MBps": 10.0, "Tar-Compressed-Bytes": 1000000,
+                            "Phases": {"Retention": 0.5, "Archive": 1, "Email": 2.0}},
+                        {"Status": "success", "Tar-MBps": 30.0, "Tar-Compressed-Bytes": 2000000,
+                            "Phases": {"Retention": 1.5, "Archive": 1, "Email": 2.0}},
+                        {"Status": "error", "Tar-MBps": 20.0, "Phases": {"Retention": 100}},
+                        {"Status": "error", "Phases": {"Retention": 100}},
+                    ]
+        phaseSeconds, basedOnRuns = predict_seconds(40000000, 3000000, loggedRuns)
+        assert basedOnRuns == 3 and list(phaseSeconds) == ["Archive", "Retention", "Email"]
+        assert abs(phaseSeconds["Archive"] - 2) < 1e-9 and phaseSeconds["Retention"] == 1.0
+        assert abs(phaseSeconds["Email"] - 4.5) < 1e-9
+        assert predict_seconds(40000000, 3000000, [], 20.0) == ({"Archive": 2.0}, 0)
+        assert predict_seconds(40000000, 3000000, []) == ({}, 0)
+        plan = make_plan([bo, {"Backup-Folder": "/nonexistent"}], "gzip", 6, policy, loggedRuns=loggedRuns)
+        assert len(plan["Objects"]) == 1 and plan["Totals"]["Archive-Bytes"] == 140000
+        assert 40000 < plan["Compressed-Bytes"] < 42000 and plan["Sample-Files"] == 1
+        lines = format_plan(plan)
+        assert lines[0] == "Backup plan: full backup, gzip level 6, from stat data only"
+        assert "    Excluded:   2 files, 0.0 MB, by Exclude-Folders %s" % os.path.join(testDir, "cache") in lines
+        assert lines[-1].startswith("Estimated runtime: ") and lines[-1].endswith("of 3 earlier runs")
+    finally:
+        shutil.rmtree(testDir)
+    print("All plan tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
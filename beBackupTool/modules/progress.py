@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Console output of a backup run, in quiet, progress or verbose mode
+
+The archive loop only counts its members here. In progress mode, a
+background thread reports the counts at most a few times a second on a
+terminal, and rarely otherwise, so cron mail is not flooded
+"""
+
+import sys, time, threading
+
+OUTPUT_MODES = ("quiet", "progress", "verbose")
+
+# Seconds between progress reports, on a terminal and otherwise
+PROGRESS_INTERVAL = 0.25
+PROGRESS_INTERVAL_NOT_TTY = 60
+
+
+class ProgressReporter(object):
+    """
+    Reports archiving to *stream*, in *mode* "quiet", printing errors
+    only, "progress", printing messages and a throttled progress line,
+    or "verbose", printing messages and every member as it is added
+
+    If *scanStats* is a backup.ScanStats object, the progress line shows
+    the number of files scanned and, once the scan is done, the ETA
+
+    In progress mode, start() and stop() must be called around the run,
+    or the reporter used as a context manager
+    """
+
+    def __init__(self, mode="verbose", stream=None, scanStats=None, interval=None):
+        if mode not in OUTPUT_MODES:
+            raise ValueError("Invalid output mode: %s" % mode)
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stdout
+        self.scanStats = scanStats
+        self.isTTY = hasattr(self.stream, "isatty") and self.stream.isatty()
+        if interval is None:
+            interval = PROGRESS_INTERVAL if self.isTTY else PROGRESS_INTERVAL_NOT_TTY
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.startTime = time.perf_counter()
+        self.lineLength = 0
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.startTime = time.perf_counter()
+        if self.mode == "progress" and self.thread is None:
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self._report_loop, name="backup-progress", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the progress thread, ending with a final progress line
+        """
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+            self._write_progress(final=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *excInfo):
+        self.stop()
+
+    def add_member(self, arcName, size):
+        """
+        Counts a member of *size* bytes added to the archive, printing
+        its *arcName* in verbose mode only
+        """
+        self.files += 1
+        self.bytes += size
+        if self.mode == "verbose":
+            self.stream.write("  %s\n" % arcName)
+
+    def add_counts(self, files, size):
+        """
+        Counts *files* of *size* bytes in all, added elsewhere, as by a
+        worker process
+        """
+        self.files += files
+        self.bytes += size
+
+    def detail(self, text):
+        """
+        Prints *text* in verbose mode only
+        """
+        if self.mode == "verbose":
+            self.message(text)
+
+    def message(self, text):
+        """
+        Prints *text*, unless in quiet mode
+        """
+        if self.mode != "quiet":
+            self._write_line(text)
+
+    def error(self, text):
+        """
+        Prints *text* in all modes
+        """
+        self._write_line(text)
+
+    def get_progress_text(self):
+        """
+        Returns the progress line, of files and bytes archived, their
+        rates, and the ETA from the scan totals if the scan is done
+        """
+        seconds = max(time.perf_counter() - self.startTime, 1e-6)
+        files, bytesDone = self.files, self.bytes
+        filesRate = files / seconds
+        bytesRate = bytesDone / seconds
+        text = "%d files, %.1f MB, %.0f files/s, %.1f MB/s" % (files, bytesDone / 1000000,
+                                                                filesRate, bytesRate / 1000000)
+        if self.scanStats is not None:
+            scanCounts = self.scanStats.as_dict()
+            if not scanCounts["done"]:
+                text += ", %d files scanned" % scanCounts["files"]
+            elif bytesRate > 0:
+                text += ", ETA %s" % format_seconds(max(scanCounts["bytes"] - bytesDone, 0) / bytesRate)
+        return text
+
+    def _report_loop(self):
+        while not self.stopEvent.wait(self.interval):
+            self._write_progress()
+
+    def _write_progress(self, final=False):
+        text = self.get_progress_text()
+        with self.lock:
+            if self.isTTY:
+                self.stream.write("\r%s%s" % (text, " " * max(self.lineLength - len(text), 0)))
+                self.lineLength = len(text)
+                if final:
+                    self.stream.write("\n")
+                    self.lineLength = 0
+            else:
+                self.stream.write("%s\n" % text)
+            self.stream.flush()
+
+    def _write_line(self, text):
+        with self.lock:
+            if self.lineLength:
+                # Clear the progress line first
+                self.stream.write("\r%s\r" % (" " * self.lineLength))
+                self.lineLength = 0
+            self.stream.write("%s\n" % text)
+
+
+def format_seconds(seconds):
+    """
+    Returns *seconds* as text like "1:02:03", or "0:45"
+    """
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in progress")
+    import io
+    assert format_seconds(45) == "0:45" and format_seconds(3723) == "1:02:03"
+    #   Verbose prints every member, quiet nothing but errors
+    out = io.StringIO()
+    reporter = ProgressReporter("verbose", out)
+    reporter.message("Adding")
+    reporter.add_member("a/b", 10)
+    reporter.add_counts(2, 30)
+    assert out.getvalue() == "Adding\n  a/b\n" and reporter.files == 3 and reporter.bytes == 40
+    out = io.StringIO()
+    reporter = ProgressReporter("quiet", out)
+    reporter.message("Adding")
+    reporter.detail("Detail")
+    reporter.add_member("a/b", 10)
+    reporter.error("ERROR: x")
+    assert out.getvalue() == "ERROR: x\n"
+    #   Progress prints members only as counts, throttled
+    class ScanStatsStub(object):
+        def as_dict(self):
+            return {"files": 4, "bytes": 4000000, "done": True}
+    out = io.StringIO()
+    with ProgressReporter("progress", out, ScanStatsStub(), interval=0.05) as reporter:
+        reporter.message("Adding")
+        for i in range(1000):
+            reporter.add_member("f%d" % i, 1000)
+        time.sleep(0.2)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == "Adding" and 2 <= len(lines) <= 10
+    assert lines[-1].startswith("1000 files, 1.0 MB, ") and "ETA" in lines[-1] and "f999" not in out.getvalue()
+    try:
+        ProgressReporter("loud")
+        assert False
+    except ValueError:
+        pass
+    print("All progress tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
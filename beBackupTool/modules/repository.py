@@ -0,0 +1,827 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Deduplicating repository, an alternative to writing a tar archive each
+run, which stores each distinct piece of data once
+
+Files are split into chunks at content-defined boundaries, so an edit
+only changes the chunks around it, and each chunk is addressed by the
+SHA-256 of its data. New chunks are compressed and appended to pack
+files of about PACK_SIZE, each with an index of the chunks it holds.
+Each run is recorded as a snapshot, a gzipped JSON list of the files
+with their metadata and chunks, so every snapshot is complete, while
+only the changed data takes space. Files of the same size and mtime as
+in the last snapshot reuse its chunks without being read
+
+The repository is a folder of:
+
+    repo.json                   Version and chunk size, fixed at creation
+    lock                        Locked while written or collected
+    packs/<id>.pack             Concatenated compressed chunks
+    packs/<id>.idx              JSON index of the chunks in the pack
+    snapshots/<name>.json.gz    The snapshots
+
+Snapshots are pruned with the retention policy of the tar archives, and
+the chunks no snapshot needs are then deleted, see collect_garbage()
+"""
+
+import sys, os, io, json, gzip, time, math, zlib, stat, fcntl, hashlib, binascii, itertools, collections, contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from . import progress, retention
+except ImportError: # Run as a script for testing
+    import progress, retention
+
+REPO_VERSION = 1
+
+SNAPSHOT_VERSION = 1
+
+# Default average chunk size, and the least number of bits of its pattern
+CHUNK_SIZE = 1024 * 1024
+PATTERN_MIN_BITS = 6
+
+# Bytes read from a file at once
+READ_SIZE = 4 * 1024 * 1024
+
+# Size at which a pack file is finished and a new one started
+PACK_SIZE = 16 * 1024 * 1024
+
+# Share of unused bytes at which a pack is rewritten by the collection
+REPACK_UNUSED = 0.3
+
+# Marks of chunks stored compressed or as they are
+BLOB_ZLIB = b"z"
+BLOB_STORED = b"s"
+
+
+def _make_chunk_tables():
+    # Fixed for good, as changing either would change all chunk boundaries
+    seedBits = []
+    digest = b"beBackupTool content-defined chunking"
+    while len(seedBits) < 256 + 64:
+        digest = hashlib.sha256(digest).digest()
+        seedBits.extend((byte >> n) & 1 for byte in digest for n in range(8))
+    bitTable = bytes.maketrans(bytes(range(256)), bytes(seedBits[:256]))
+    return bitTable, bytes(seedBits[256:256 + 64])
+
+# Byte translation mapping each byte value to a bit, and the bit pattern
+# found in the translated data at chunk boundaries
+BIT_TABLE, BOUNDARY_PATTERN = _make_chunk_tables()
+
+
+class Chunker(object):
+    """
+    Splits data into chunks of *avgSize* bytes on average, between a
+    quarter and four times that, at content-defined boundaries
+
+    A boundary is where the bits of the last bytes, each mapped to a bit
+    by BIT_TABLE, spell the first bits of BOUNDARY_PATTERN, as many as
+    give the average size. This is a rolling hash of a window of that
+    many bytes, but computed by bytes.translate() and bytes.find(), so
+    at the speed of C
+    """
+
+    def __init__(self, avgSize=CHUNK_SIZE):
+        self.minSize = max(avgSize // 4, 64)
+        self.maxSize = max(avgSize * 4, self.minSize + 1)
+        bits = int(round(math.log2(max(avgSize - self.minSize, 2))))
+        self.pattern = BOUNDARY_PATTERN[:min(max(bits, PATTERN_MIN_BITS), self.minSize, len(BOUNDARY_PATTERN))]
+        self.stepSize = max(avgSize // 2, len(self.pattern) * 2)
+
+    def find_cut(self, data, start):
+        """
+        Returns the end of the chunk of *data* from *start*, which must
+        hold at least the max chunk size or else the end of the data
+        """
+        end = min(len(data), start + self.maxSize)
+        if end - start <= self.minSize:
+            return end
+        # Searched a step at a time, as the boundary is most likely early
+        windowStart = start + self.minSize - len(self.pattern)
+        while True:
+            windowEnd = min(end, windowStart + self.stepSize)
+            found = data[windowStart:windowEnd].translate(BIT_TABLE).find(self.pattern)
+            if found >= 0:
+                return windowStart + found + len(self.pattern)
+            if windowEnd >= end:
+                return end
+            windowStart = windowEnd - len(self.pattern) + 1
+
+    def split(self, fileobj):
+        """
+        Yields the chunks of the data read from *fileobj*, as bytes
+        """
+        data = b""
+        start = 0
+        eof = False
+        while True:
+            if not eof and len(data) - start < self.maxSize:
+                block = fileobj.read(max(READ_SIZE, self.maxSize))
+                if block:
+                    data = data[start:] + block
+                    start = 0
+                else:
+                    eof = True
+                continue
+            if start >= len(data):
+                return
+            cut = self.find_cut(data, start)
+            yield data[start:cut]
+            start = cut
+
+
+def encode_chunk(data, level=6, store=False):
+    """
+    Returns blob of chunk *data*, compressed with zlib at *level*, or as
+    it is if *store* is True or it does not compress
+    """
+    if not store:
+        compressed = zlib.compress(data, level)
+        if len(compressed) < len(data):
+            return BLOB_ZLIB + compressed
+    return BLOB_STORED + data
+
+
+def decode_chunk(blob):
+    """
+    Returns the chunk data of *blob*
+    """
+    if blob[:1] == BLOB_ZLIB:
+        return zlib.decompress(blob[1:])
+    if blob[:1] == BLOB_STORED:
+        return blob[1:]
+    raise ValueError("Unknown chunk encoding %r" % blob[:1])
+
+
+class Repository(object):
+    """
+    Deduplicating repository in folder *repoDir*, created with the
+    average chunk size *chunkSize* if it does not exist. Chunks are
+    compressed at zlib *level*
+
+    The *index* maps the id of each chunk stored to a tuple of its pack
+    id, offset and length in the pack, and size of its data
+    """
+
+    def __init__(self, repoDir, chunkSize=CHUNK_SIZE, level=6):
+        self.repoDir = os.path.abspath(repoDir)
+        self.packDir = os.path.join(self.repoDir, "packs")
+        self.snapshotDir = os.path.join(self.repoDir, "snapshots")
+        self.level = level
+        configPath = os.path.join(self.repoDir, "repo.json")
+        if not os.path.exists(configPath):
+            os.makedirs(self.packDir, exist_ok=True)
+            os.makedirs(self.snapshotDir, exist_ok=True)
+            write_json(configPath, {"version": REPO_VERSION, "chunkSize": chunkSize})
+        with open(configPath, "r", encoding="utf-8") as fp:
+            repoConfig = json.load(fp)
+        if repoConfig.get("version") != REPO_VERSION:
+            raise ValueError("Unsupported repository version %r in '%s'" % (repoConfig.get("version"), self.repoDir))
+        self.chunkSize = repoConfig["chunkSize"]
+        self.chunker = Chunker(self.chunkSize)
+        self.index = {}
+        self.packFiles = collections.OrderedDict()
+        self.load_index()
+
+    def load_index(self):
+        """
+        Reads the indexes of all finished packs
+        """
+        self.index = {}
+        for fileName in sorted(os.listdir(self.packDir)):
+            if not fileName.endswith(".idx"):
+                continue
+            packId = fileName[:-4]
+            for chunkId, (offset, length, size) in read_pack_index(self.get_pack_path(packId, ".idx")).items():
+                self.index[chunkId] = (packId, offset, length, size)
+
+    def get_pack_path(self, packId, extension=".pack"):
+        return os.path.join(self.packDir, packId + extension)
+
+    @contextlib.contextmanager
+    def lock(self, shared=False):
+        """
+        Context manager holding the repository lock, exclusive unless
+        *shared*, waiting for it if need be
+        """
+        with open(os.path.join(self.repoDir, "lock"), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def read_blob(self, chunkId):
+        """
+        Returns the stored blob of chunk *chunkId*, keeping a few packs
+        open for the next reads
+        """
+        packId, offset, length, size = self.index[chunkId]
+        fp = self.packFiles.pop(packId, None)
+        if fp is None:
+            fp = open(self.get_pack_path(packId), "rb")
+            while len(self.packFiles) >= 8:
+                self.packFiles.popitem(last=False)[1].close()
+        self.packFiles[packId] = fp
+        fp.seek(offset)
+        blob = fp.read(length)
+        if len(blob) != length:
+            raise IOError("Pack '%s' truncated" % packId)
+        return blob
+
+    def read_chunk(self, chunkId):
+        """
+        Returns the data of chunk *chunkId*, checked against its id
+        """
+        data = decode_chunk(self.read_blob(chunkId))
+        if hashlib.sha256(data).hexdigest() != chunkId:
+            raise IOError("Chunk %s is corrupt" % chunkId)
+        return data
+
+    def close(self):
+        while self.packFiles:
+            self.packFiles.popitem()[1].close()
+
+    def list_snapshots(self):
+        """
+        Returns list of the names of the snapshots, oldest first
+        """
+        names = [f[:-len(".json.gz")] for f in os.listdir(self.snapshotDir) if f.endswith(".json.gz")]
+        return sorted(names, key=lambda n: (self.get_snapshot_time(n), n))
+
+    def get_snapshot_time(self, snapshotName):
+        try:
+            return os.stat(self.get_snapshot_path(snapshotName)).st_mtime
+        except OSError:
+            return 0
+
+    def get_snapshot_path(self, snapshotName):
+        return os.path.join(self.snapshotDir, snapshotName + ".json.gz")
+
+    def load_snapshot(self, snapshotName):
+        """
+        Returns the snapshot dict named *snapshotName*
+        """
+        with gzip.open(self.get_snapshot_path(snapshotName), "rt", encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def save_snapshot(self, snapshot):
+        """
+        Writes *snapshot* dict, replacing any of the same name only once
+        the new one is complete
+        """
+        snapshotPath = self.get_snapshot_path(snapshot["name"])
+        with gzip.open(snapshotPath + ".tmp", "wt", encoding="utf-8") as fp:
+            json.dump(snapshot, fp, separators=(",", ":"))
+        os.replace(snapshotPath + ".tmp", snapshotPath)
+
+    def delete_snapshot(self, snapshotName):
+        os.remove(self.get_snapshot_path(snapshotName))
+
+
+class PackWriter(object):
+    """
+    Appends the new chunks of *repo* to pack files, compressing them in
+    *workers* threads, and adds them to its index as each pack finishes
+
+    Close it to finish the last pack, or abort() to discard it
+    """
+
+    def __init__(self, repo, workers=1):
+        self.repo = repo
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="repo-compress")
+        self.pending = collections.deque()
+        self.pendingIds = set()
+        self.maxPending = max(workers, 1) * 2
+        self.packId = None
+        self.packFile = None
+        self.packEntries = {}
+        self.packSize = 0
+        self.storedChunks = 0
+        self.storedBytes = 0
+
+    def add_chunk(self, chunkId, data, store=False):
+        """
+        Stores chunk *data*, of id *chunkId*, unless the repository has
+        it, and returns bool whether it was new. It is stored as it is
+        if *store* is True, see encode_chunk()
+        """
+        if chunkId in self.repo.index or chunkId in self.pendingIds:
+            return False
+        self.pendingIds.add(chunkId)
+        self.pending.append((chunkId, len(data), self.executor.submit(encode_chunk, data, self.repo.level, store)))
+        while len(self.pending) > self.maxPending:
+            chunkId, size, future = self.pending.popleft()
+            self.add_blob(chunkId, future.result(), size)
+        return True
+
+    def add_blob(self, chunkId, blob, size):
+        """
+        Appends the encoded *blob* of chunk *chunkId*, of *size* bytes
+        of data, to the current pack
+        """
+        if self.packFile is None:
+            self.packId = binascii.hexlify(os.urandom(16)).decode("ascii")
+            self.packFile = open(self.repo.get_pack_path(self.packId, ".pack.tmp"), "wb")
+            self.packEntries = {}
+            self.packSize = 0
+        self.packFile.write(blob)
+        self.packEntries[chunkId] = [self.packSize, len(blob), size]
+        self.pendingIds.add(chunkId)
+        self.packSize += len(blob)
+        self.storedChunks += 1
+        self.storedBytes += len(blob)
+        if self.packSize >= PACK_SIZE:
+            self.finish_pack()
+
+    def finish_pack(self):
+        """
+        Completes the current pack and its index, and adds its chunks to
+        the index of the repository
+        """
+        if self.packFile is None:
+            return
+        self.packFile.close()
+        self.packFile = None
+        os.replace(self.repo.get_pack_path(self.packId, ".pack.tmp"), self.repo.get_pack_path(self.packId))
+        write_json(self.repo.get_pack_path(self.packId, ".idx"), {"version": REPO_VERSION, "chunks": self.packEntries})
+        for chunkId, (offset, length, size) in self.packEntries.items():
+            self.repo.index[chunkId] = (self.packId, offset, length, size)
+        self.pendingIds.difference_update(self.packEntries)
+
+    def close(self):
+        try:
+            while self.pending:
+                chunkId, size, future = self.pending.popleft()
+                self.add_blob(chunkId, future.result(), size)
+            self.finish_pack()
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        for chunkId, size, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        if self.packFile is not None:
+            self.packFile.close()
+            self.packFile = None
+            try: os.remove(self.repo.get_pack_path(self.packId, ".pack.tmp"))
+            except OSError: pass
+
+
+def write_json(filePath, data):
+    """
+    Writes *data* as JSON to *filePath*, replacing any old file only once
+    the new one is complete
+    """
+    with open(filePath + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(data, fp, separators=(",", ":"))
+    os.replace(filePath + ".tmp", filePath)
+
+
+def read_pack_index(idxPath):
+    """
+    Returns dict of the offset, length and data size of each chunk in a
+    pack, by id, from its index at *idxPath*
+    """
+    with open(idxPath, "r", encoding="utf-8") as fp:
+        return json.load(fp)["chunks"]
+
+
+def get_repository_path(tarDir, tarNameStem):
+    """
+    Returns path of the repository folder in *tarDir*
+    """
+    return os.path.join(tarDir, tarNameStem + ".repo")
+
+
+def write_snapshot(repo, backupObjects, snapshotName, reporter=None, compressPolicy=None, throttle=None,
+                                                                            workers=1, snapshotStats=None):
+    """
+    Stores the files of *backupObjects*, as from
+    backup.iter_backup_objects(), in *repo*, and records them as the
+    snapshot *snapshotName*, replacing any of that name
+
+    Files of the same size, mtime and inode as in the newest snapshot
+    reuse its chunks without being read. The members added are reported
+    to *reporter*, as by backup.write_tar_file(), and files are stored
+    uncompressed if *compressPolicy* finds them incompressible, and read
+    at the pace of *throttle*, if given. New chunks are compressed in
+    *workers* threads
+
+    If *snapshotStats* is a dict, it is given the number of "files",
+    of them the "reusedFiles", the "fileBytes" read, the "chunks" of the
+    files read, of them the "newChunks", and the "storedBytes" they take
+
+    Return value is a tuple of snapshot name and any error message
+    """
+    if reporter is None:
+        reporter = progress.ProgressReporter("verbose")
+    snapshotNames = repo.list_snapshots()
+    lastFiles = repo.load_snapshot(snapshotNames[-1])["files"] if snapshotNames else {}
+    files = {}
+    stats = {"files": 0, "reusedFiles": 0, "fileBytes": 0, "chunks": 0, "newChunks": 0, "storedBytes": 0}
+    returnError = ""
+    try:
+        with repo.lock():
+            packWriter = PackWriter(repo, workers)
+            try:
+                for filesToArchive in backupObjects:
+                    add_snapshot_object(repo, packWriter, files, lastFiles, filesToArchive, reporter, compressPolicy,
+                                                                                                throttle, stats)
+                packWriter.close()
+            except Exception:
+                packWriter.abort()
+                raise
+            stats["newChunks"] = packWriter.storedChunks
+            stats["storedBytes"] = packWriter.storedBytes
+            repo.save_snapshot({"version": SNAPSHOT_VERSION, "name": snapshotName, "timestamp": int(time.time()),
+                                "files": files, "stats": stats})
+    except Exception as e:
+        reporter.error(str(e))
+        returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    if snapshotStats is not None:
+        snapshotStats.update(stats)
+    return snapshotName, returnError
+
+
+def add_snapshot_object(repo, packWriter, files, lastFiles, filesToArchive, reporter, compressPolicy=None,
+                                                                                    throttle=None, stats=None):
+    """
+    Adds the files of one backup object to the *files* of a snapshot,
+    named as members of a tar archive would be, see
+    backup.add_backup_object(), storing their new chunks with
+    *packWriter*, or reusing those of *lastFiles* if unchanged
+    """
+    filesIter = iter(filesToArchive)
+    firstFile = next(filesIter, None)
+    if firstFile is None:
+        return
+    bkpDirContainer = os.path.dirname(os.path.dirname(os.path.join(firstFile, "")))
+    reporter.detail("Adding backup files in '%s':" % bkpDirContainer)
+    repoPrefix = os.path.join(repo.repoDir, "")
+    for fName in itertools.chain([firstFile], filesIter):
+        if fName == repo.repoDir or fName.startswith(repoPrefix):
+            # Don't back up the repository
+            continue
+        arcName = os.path.relpath(fName, bkpDirContainer)
+        if throttle is not None:
+            throttle.pace(files=1)
+        st = getattr(fName, "stat", None)
+        try:
+            if st is None:
+                st = os.lstat(fName)
+            entry = get_snapshot_entry(repo, packWriter, fName, st, lastFiles.get(arcName), compressPolicy,
+                                                                                            throttle, stats)
+        except FileNotFoundError:
+            # Vanished since the scan
+            continue
+        if entry is None:
+            continue
+        files[arcName] = entry
+        reporter.add_member(arcName, st.st_size if stat.S_ISREG(st.st_mode) else 0)
+
+
+def get_snapshot_entry(repo, packWriter, filePath, st, lastEntry=None, compressPolicy=None, throttle=None,
+                                                                                                stats=None):
+    """
+    Returns snapshot entry dict of the file, folder or symlink at
+    *filePath*, of os.lstat() result *st*, storing the new chunks of a
+    file with *packWriter*, unless *lastEntry* of the last snapshot has
+    the same size, mtime and inode. Returns None for other types, like
+    sockets
+    """
+    stats = stats if stats is not None else collections.Counter()
+    entry = {"mode": stat.S_IMODE(st.st_mode), "mtime": st.st_mtime_ns, "uid": st.st_uid, "gid": st.st_gid}
+    if stat.S_ISDIR(st.st_mode):
+        entry["type"] = "d"
+    elif stat.S_ISLNK(st.st_mode):
+        entry["type"] = "l"
+        entry["link"] = os.readlink(filePath)
+    elif stat.S_ISREG(st.st_mode):
+        entry.update(type="f", size=st.st_size, ino=st.st_ino)
+        stats["files"] += 1
+        if lastEntry is not None and lastEntry.get("type") == "f" and lastEntry.get("size") == st.st_size \
+                and lastEntry.get("mtime") == st.st_mtime_ns and lastEntry.get("ino") == st.st_ino \
+                and all(chunkId in repo.index for chunkId in lastEntry["chunks"]):
+            entry["chunks"] = lastEntry["chunks"]
+            stats["reusedFiles"] += 1
+        else:
+            entry["chunks"], entry["size"] = store_file(repo, packWriter, filePath, st.st_size, compressPolicy,
+                                                                                            throttle, stats)
+    else:
+        return None
+    return entry
+
+
+def store_file(repo, packWriter, filePath, size, compressPolicy=None, throttle=None, stats=None):
+    """
+    Splits the file at *filePath* of *size* bytes into chunks, stored
+    with *packWriter* if new, and returns tuple of list of their ids and
+    the number of bytes read
+    """
+    chunkIds = []
+    readBytes = 0
+    with open(filePath, "rb") as fp:
+        store = compressPolicy is not None and compressPolicy.is_incompressible(filePath, fp, size)
+        readFile = throttle.wrap(fp) if throttle is not None else fp
+        for data in repo.chunker.split(readFile):
+            chunkId = hashlib.sha256(data).hexdigest()
+            packWriter.add_chunk(chunkId, data, store)
+            chunkIds.append(chunkId)
+            readBytes += len(data)
+    if stats is not None:
+        stats["chunks"] += len(chunkIds)
+        stats["fileBytes"] += readBytes
+    return chunkIds, readBytes
+
+
+def find_snapshot_files(snapshot, memberName):
+    """
+    Returns sorted list of the names of the files of *snapshot* that are
+    *memberName* or in that folder, or all if it is empty
+    """
+    memberName = memberName.strip("/")
+    if not memberName:
+        return sorted(snapshot["files"])
+    return sorted(n for n in snapshot["files"] if n == memberName or n.startswith(memberName + "/"))
+
+
+def restore_snapshot(repo, snapshot, memberName, destDir):
+    """
+    Restores the file or folder *memberName* of *snapshot*, with all it
+    holds, to *destDir*, under their names in the snapshot, with their
+    modes and mtimes, and owners if run as root
+
+    Returns tuple of list of the names restored and any error message
+    """
+    destDir = os.path.abspath(destDir)
+    restoredNames = []
+    dirEntries = []
+    try:
+        with repo.lock(shared=True):
+            for name in find_snapshot_files(snapshot, memberName):
+                entry = snapshot["files"][name]
+                targetPath = os.path.abspath(os.path.join(destDir, name))
+                if os.path.commonpath([destDir, targetPath]) != destDir:
+                    raise ValueError("Member '%s' is outside the destination folder" % name)
+                os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+                if os.path.islink(targetPath) or (os.path.lexists(targetPath) and entry["type"] != "d"):
+                    os.remove(targetPath)
+                if entry["type"] == "d":
+                    os.makedirs(targetPath, exist_ok=True)
+                    dirEntries.append((targetPath, entry))
+                elif entry["type"] == "l":
+                    os.symlink(entry["link"], targetPath)
+                else:
+                    with open(targetPath, "wb") as fp:
+                        for chunkId in entry["chunks"]:
+                            fp.write(repo.read_chunk(chunkId))
+                    set_file_attributes(targetPath, entry)
+                restoredNames.append(name)
+            # Folders last, so writing in them does not change their mtime
+            for targetPath, entry in reversed(dirEntries):
+                set_file_attributes(targetPath, entry)
+    except Exception:
+        return restoredNames, "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    finally:
+        repo.close()
+    return restoredNames, ""
+
+
+def set_file_attributes(targetPath, entry):
+    """
+    Sets the owner, if run as root, mode and mtime of *entry* on the
+    file or folder at *targetPath*
+    """
+    if os.geteuid() == 0:
+        os.chown(targetPath, entry["uid"], entry["gid"])
+    os.chmod(targetPath, entry["mode"])
+    os.utime(targetPath, ns=(entry["mtime"], entry["mtime"]))
+
+
+def prune_snapshots(repo, policy, timeNow=None):
+    """
+    Deletes the snapshots of *repo* that the retention *policy* dict, of
+    config TAR_FILE settings, would delete were they archives, see
+    retention.select_archives_to_delete(). Each is taken as a full
+    archive the size of the chunks it added
+
+    Returns report of num of deletions or error
+    """
+    snapshots = []
+    try:
+        for snapshotName in repo.list_snapshots():
+            snapshot = {"Name": snapshotName, "Timestamp": retention.get_name_timestamp(snapshotName),
+                        "Type": "full", "Size": 0}
+            if policy.get("Max-Total-MB", 0) > 0:
+                snapshot["Size"] = repo.load_snapshot(snapshotName).get("stats", {}).get("storedBytes", 0)
+            snapshots.append(snapshot)
+        deletedCount = 0
+        with repo.lock():
+            for snapshot in retention.select_archives_to_delete(snapshots, policy, timeNow):
+                repo.delete_snapshot(snapshot["Name"])
+                deletedCount += 1
+    except Exception:
+        return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    return "Number of old snapshots deleted: %d" % deletedCount
+
+
+def collect_garbage(repo, repackUnused=REPACK_UNUSED):
+    """
+    Deletes the chunks of *repo* that no snapshot needs: packs holding
+    none that are needed are deleted, and packs with more than the share
+    *repackUnused* of their bytes unneeded are rewritten with only the
+    needed chunks. Packs and snapshots left unfinished by an interrupted
+    run are deleted too
+
+    Returns report of the chunks and bytes freed, or error
+    """
+    freedChunks = 0
+    freedBytes = 0
+    try:
+        with repo.lock():
+            neededIds = set()
+            for snapshotName in repo.list_snapshots():
+                for entry in repo.load_snapshot(snapshotName)["files"].values():
+                    neededIds.update(entry.get("chunks", ()))
+            repo.load_index()
+            for fileName in sorted(os.listdir(repo.packDir)):
+                filePath = os.path.join(repo.packDir, fileName)
+                if not os.path.exists(filePath):
+                    # Pack deleted with its index
+                    continue
+                if fileName.endswith(".tmp") or (fileName.endswith(".pack")
+                                                    and not os.path.exists(filePath[:-5] + ".idx")):
+                    freedBytes += os.path.getsize(filePath)
+                    os.remove(filePath)
+                    continue
+                if not fileName.endswith(".idx"):
+                    continue
+                packId = fileName[:-4]
+                packChunks = read_pack_index(filePath)
+                unusedIds = [c for c in packChunks if c not in neededIds]
+                if not unusedIds:
+                    continue
+                packBytes = sum(length for offset, length, size in packChunks.values())
+                unusedBytes = sum(packChunks[c][1] for c in unusedIds)
+                if len(unusedIds) < len(packChunks) and unusedBytes <= packBytes * repackUnused:
+                    continue
+                if len(unusedIds) < len(packChunks):
+                    # Copy the needed chunks into new packs, as they are
+                    packWriter = PackWriter(repo)
+                    try:
+                        for chunkId in packChunks:
+                            if chunkId in neededIds:
+                                packWriter.add_blob(chunkId, repo.read_blob(chunkId), packChunks[chunkId][2])
+                        packWriter.close()
+                    except Exception:
+                        packWriter.abort()
+                        raise
+                    repo.close()
+                os.remove(filePath)
+                os.remove(repo.get_pack_path(packId))
+                for chunkId in unusedIds:
+                    del repo.index[chunkId]
+                freedChunks += len(unusedIds)
+                freedBytes += unusedBytes
+            for fileName in os.listdir(repo.snapshotDir):
+                if fileName.endswith(".tmp"):
+                    os.remove(os.path.join(repo.snapshotDir, fileName))
+    except Exception:
+        return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    finally:
+        repo.close()
+    return "Number of unused chunks deleted: %d, %.1f MB freed" % (freedChunks, freedBytes / 1000000)
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in repository")
+    import tempfile, shutil, random
+    # Boundaries depend on the content only, so an insertion changes
+    # only the chunks around it
+    chunker = Chunker(16 * 1024)
+    rand = random.Random(1)
+    data = bytes(rand.getrandbits(8) for n in range(600000))
+    chunks = list(chunker.split(io.BytesIO(data)))
+    assert b"".join(chunks) == data and len(chunks) > 10
+    assert all(chunker.minSize <= len(c) <= chunker.maxSize for c in chunks[:-1])
+    assert 8 * 1024 < len(data) / len(chunks) < 48 * 1024
+    edited = data[:300000] + b"inserted" + data[300000:]
+    editedChunks = list(chunker.split(io.BytesIO(edited)))
+    assert len(set(chunks) - set(editedChunks)) <= 2
+    assert list(chunker.split(io.BytesIO(b""))) == []
+    assert [len(c) for c in chunker.split(io.BytesIO(bytes(100000)))] == [65536, 100000 - 65536]
+    assert decode_chunk(encode_chunk(data[:1000])) == data[:1000]
+    assert encode_chunk(bytes(1000))[:1] == BLOB_ZLIB and encode_chunk(bytes(1000), store=True)[:1] == BLOB_STORED
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_repository_")
+    try:
+        bkpDir = os.path.join(testDir, "data")
+        os.makedirs(os.path.join(bkpDir, "sub"))
+        with open(os.path.join(bkpDir, "big.bin"), "wb") as fp:
+            fp.write(data)
+        with open(os.path.join(bkpDir, "sub", "copy.bin"), "wb") as fp:
+            fp.write(data)
+        with open(os.path.join(bkpDir, "sub", "small.txt"), "wb") as fp:
+            fp.write(b"small")
+        os.symlink("small.txt", os.path.join(bkpDir, "sub", "link"))
+        os.chmod(os.path.join(bkpDir, "sub", "small.txt"), 0o640)
+        repoDir = os.path.join(testDir, "test.repo")
+        reporter = progress.ProgressReporter("quiet")
+        def backup_objects():
+            paths = [bkpDir, os.path.join(bkpDir, "big.bin"), os.path.join(bkpDir, "sub"),
+                        os.path.join(bkpDir, "sub", "copy.bin"), os.path.join(bkpDir, "sub", "link"),
+                        os.path.join(bkpDir, "sub", "small.txt")]
+            return [paths]
+        # Duplicate data stored once
+        repo = Repository(repoDir, chunkSize=16 * 1024)
+        stats = {}
+        assert write_snapshot(repo, backup_objects(), "test_100", reporter, workers=2, snapshotStats=stats) == ("test_100", "")
+        assert stats["files"] == 3 and stats["chunks"] == 2 * len(chunks) + 1
+        assert stats["newChunks"] == len(set(chunks)) + 1 and stats["storedBytes"] < len(data) + 1000
+        # Reopened, unchanged files reuse the chunks, and edits store only the changed chunks
+        repo = Repository(repoDir, chunkSize=64 * 1024)
+        assert repo.chunkSize == 16 * 1024 and len(repo.index) == len(set(chunks)) + 1
+        for fileName in ("big.bin", "sub/copy.bin"):
+            with open(os.path.join(bkpDir, fileName), "wb") as fp:
+                fp.write(edited)
+        stats = {}
+        assert write_snapshot(repo, backup_objects(), "test_200", reporter, snapshotStats=stats)[1] == ""
+        assert stats["reusedFiles"] == 1 and 1 <= stats["newChunks"] <= 2
+        assert repo.list_snapshots() == ["test_100", "test_200"]
+        # Restored
+        restoreDir = os.path.join(testDir, "restore")
+        snapshot = repo.load_snapshot("test_100")
+        restoredNames, restoreError = restore_snapshot(repo, snapshot, "data/sub", restoreDir)
+        assert restoreError == "" and restoredNames == ["data/sub", "data/sub/copy.bin", "data/sub/link",
+                                                        "data/sub/small.txt"]
+        with open(os.path.join(restoreDir, "data", "sub", "copy.bin"), "rb") as fp:
+            assert fp.read() == data
+        assert os.readlink(os.path.join(restoreDir, "data", "sub", "link")) == "small.txt"
+        st = os.stat(os.path.join(restoreDir, "data", "sub", "small.txt"))
+        assert stat.S_IMODE(st.st_mode) == 0o640
+        assert st.st_mtime_ns == os.stat(os.path.join(bkpDir, "sub", "small.txt")).st_mtime_ns
+        assert restore_snapshot(repo, repo.load_snapshot("test_200"), "data/big.bin", restoreDir)[1] == ""
+        with open(os.path.join(restoreDir, "data", "big.bin"), "rb") as fp:
+            assert fp.read() == edited
+        assert restore_snapshot(repo, {"files": {"../x": {"type": "d"}}}, "", restoreDir)[1].startswith("ERROR")
+        # Corruption found
+        chunkId = hashlib.sha256(chunks[0]).hexdigest()
+        packId, offset = repo.index[chunkId][:2]
+        def flip_byte():
+            with open(repo.get_pack_path(packId), "r+b") as fp:
+                fp.seek(offset + 10)
+                byte = fp.read(1)
+                fp.seek(-1, 1)
+                fp.write(bytes([byte[0] ^ 0xff]))
+        flip_byte()
+        repo.close()
+        try:
+            repo.read_chunk(chunkId)
+            assert False, "Corrupt chunk not found"
+        except (IOError, zlib.error):
+            pass
+        flip_byte()
+        repo.close()
+        # Pruned and collected
+        repoSize = sum(os.path.getsize(os.path.join(repo.packDir, f)) for f in os.listdir(repo.packDir))
+        assert prune_snapshots(repo, {"Delete-Delay": 1}, timeNow=250) == "Number of old snapshots deleted: 0"
+        assert prune_snapshots(repo, {"Delete-Delay": 1}, timeNow=150 + 24 * 60 * 60) == "Number of old snapshots deleted: 1"
+        assert repo.list_snapshots() == ["test_200"]
+        open(repo.get_pack_path("stale", ".pack.tmp"), "wb").close()
+        report = collect_garbage(repo, repackUnused=0.0)
+        assert report.startswith("Number of unused chunks deleted: ") and not report.startswith("Number of unused chunks deleted: 0,")
+        assert not os.path.exists(repo.get_pack_path("stale", ".pack.tmp"))
+        newSize = sum(os.path.getsize(os.path.join(repo.packDir, f)) for f in os.listdir(repo.packDir))
+        assert newSize < repoSize
+        repo = Repository(repoDir)
+        restoredNames, restoreError = restore_snapshot(repo, repo.load_snapshot("test_200"), "", restoreDir)
+        assert restoreError == "" and len(restoredNames) == 6
+        with open(os.path.join(restoreDir, "data", "sub", "copy.bin"), "rb") as fp:
+            assert fp.read() == edited
+        assert collect_garbage(repo) == "Number of unused chunks deleted: 0, 0.0 MB freed"
+        # Failed snapshot leaves no pack or snapshot behind
+        with open(os.path.join(bkpDir, "new.bin"), "wb") as fp:
+            fp.write(os.urandom(100000))
+        def failing_objects():
+            yield [bkpDir, os.path.join(bkpDir, "new.bin")]
+            raise OSError("scan failed")
+        indexSize = len(repo.index)
+        assert write_snapshot(repo, failing_objects(), "test_300", reporter)[1].startswith("ERROR")
+        assert len(repo.index) == indexSize
+        assert repo.list_snapshots() == ["test_200"]
+        assert not [f for f in os.listdir(repo.packDir) if f.endswith(".tmp")]
+    finally:
+        shutil.rmtree(testDir)
+    print("All repository tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
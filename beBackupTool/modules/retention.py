@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Retention of archives, using a catalog of the archives produced
+
+The catalog, "<Name-Stem>.catalog.json" in the tar file directory, holds
+the name, files, size, timestamp, type and checksum of each archive, so
+pruning is a lookup in it rather than a crawl of the directory. Each
+archive is recorded as in progress when its run starts, and complete 
+once written, so the output of a failed run stays in the catalog to be
+pruned. The directory is listed only to rebuild the catalog, when it is
+missing or unreadable, or with "BackupApp.py --rebuild-catalog" to add
+archives from before it
+
+Archives are deleted once older than the delete delay, unless kept by
+a grandfather-father-son policy of the newest archive of each of the
+last N days, weeks and months, and the oldest are deleted beyond a
+quota of total bytes. Archives that kept incremental or differential
+archives depend on are never deleted, and with "Require-Verified" set,
+nothing is deleted until the newest archive has been verified
+"""
+
+import sys, os, time, json, hashlib
+
+try:
+    from . import volumes
+except ImportError: # Run as a script for testing
+    import volumes
+
+CATALOG_VERSION = 1
+
+
+def get_catalog_path(tarDir, tarNameStem):
+    """
+    Returns path of the archive catalog
+    """
+    return os.path.join(tarDir, tarNameStem + ".catalog.json")
+
+
+def load_catalog(tarDir, tarNameStem, tarExtensions):
+    """
+    Returns catalog dict, rebuilt from the archives with *tarExtensions*
+    found in *tarDir* if there is no readable catalog
+    """
+    try:
+        with open(get_catalog_path(tarDir, tarNameStem), "r", encoding="utf-8") as fp:
+            catalog = json.load(fp)
+        if isinstance(catalog, dict) and isinstance(catalog.get("Archives"), list):
+            return catalog
+    except (OSError, ValueError):
+        pass
+    return rebuild_catalog(tarDir, tarNameStem, tarExtensions)
+
+
+def save_catalog(tarDir, tarNameStem, catalog):
+    """
+    Writes *catalog*, replacing any old one only once it is complete
+    """
+    catalogPath = get_catalog_path(tarDir, tarNameStem)
+    with open(catalogPath + ".tmp", "w", encoding="utf-8") as fp:
+        json.dump(catalog, fp, indent=1)
+    os.replace(catalogPath + ".tmp", catalogPath)
+
+
+def rebuild_catalog(tarDir, tarNameStem, tarExtensions, catalog=None):
+    """
+    Returns new catalog dict of the archives with *tarExtensions* in
+    *tarDir*, found by listing it. Their type is unknown, so they are
+    taken to be full archives, without checksum, unless recorded in the
+    old *catalog*, whose entries are kept for the archives found
+    """
+    archivesByName = {}
+    with os.scandir(tarDir) as it:
+        for entry in it:
+            if not entry.name.startswith(tarNameStem) or not entry.is_file():
+                continue
+            archiveName = volumes.strip_volume_suffix(entry.name)
+            if os.path.splitext(archiveName)[1] not in tarExtensions:
+                continue
+            archive = archivesByName.setdefault(archiveName, {
+                                    "Name"      :   archiveName,
+                                    "Files"     :   [],
+                                    "Size"      :   0,
+                                    "Timestamp" :   get_name_timestamp(archiveName),
+                                    "Type"      :   "full",
+                                    "Base"      :   None,
+                                    "SHA256"    :   None,
+                                    "Verified"  :   None,
+                                })
+            archive["Files"].append(entry.name)
+            archive["Size"] += entry.stat().st_size
+    for archive in archivesByName.values():
+        archive["Files"].sort()
+    if catalog is not None:
+        archivesByName.update((a["Name"], a) for a in catalog["Archives"] if a["Name"] in archivesByName)
+    archives = sorted(archivesByName.values(), key=lambda a: (a["Timestamp"] or 0, a["Name"]))
+    return {"Version": CATALOG_VERSION, "Archives": archives}
+
+
+def get_name_timestamp(archiveName):
+    """
+    Returns int timestamp from the name of the archive, or None if it
+    has none, in which case it is overwritten on each save
+    """
+    try:
+        return int(os.path.splitext(archiveName)[0].rsplit("_", maxsplit=1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def hash_files(filePaths):
+    """
+    Returns SHA-256 hex digest of the concatenated files
+    """
+    digest = hashlib.sha256()
+    for filePath in filePaths:
+        with open(filePath, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_started(catalog, tarPath, backupType="full", baseTimestamp=None):
+    """
+    Adds the archive about to be written to *tarPath* to *catalog* as in
+    progress, replacing any entry of the same name, until record_archive()
+    records it complete. If the run fails, it is pruned as any other 
+    archive, with whatever files of it were written
+
+    Returns the catalog entry dict
+    """
+    archiveName = os.path.basename(tarPath)
+    archive = {
+                "Name"      :   archiveName,
+                "Files"     :   [archiveName],
+                "Size"      :   0,
+                "Timestamp" :   get_name_timestamp(archiveName),
+                "Created"   :   int(time.time()),
+                "Type"      :   backupType,
+                "Base"      :   baseTimestamp if backupType != "full" else None,
+                "SHA256"    :   None,
+                "Verified"  :   None,
+                "In-Progress":  True,
+            }
+    catalog["Archives"] = [a for a in catalog["Archives"] if a["Name"] != archiveName]
+    catalog["Archives"].append(archive)
+    return archive
+
+
+def record_archive(catalog, tarPath, backupType="full", baseTimestamp=None, sha256=None, verified=None):
+    """
+    Adds the archive at *tarPath*, possibly split into volumes, to
+    *catalog*, replacing any entry of the same name. The checksum is
+    computed from the files if *sha256* is None. The *verified* value is
+    as set by mark_verified(), None if the archive was not verified
+
+    Returns the catalog entry dict
+    """
+    hashedPaths = volumes.list_archive_files(tarPath)
+    filePaths = hashedPaths + volumes.list_sidecar_files(tarPath)
+    archiveName = os.path.basename(tarPath)
+    timestamp = get_name_timestamp(archiveName)
+    archive = {
+                "Name"      :   archiveName,
+                "Files"     :   [os.path.basename(x) for x in filePaths],
+                "Size"      :   sum(os.path.getsize(x) for x in filePaths),
+                "Timestamp" :   timestamp,
+                "Created"   :   int(time.time()),
+                "Type"      :   backupType,
+                "Base"      :   baseTimestamp if backupType != "full" else None,
+                "SHA256"    :   sha256 if sha256 is not None else hash_files(hashedPaths),
+                "Verified"  :   verified,
+            }
+    catalog["Archives"] = [a for a in catalog["Archives"] if a["Name"] != archiveName]
+    catalog["Archives"].append(archive)
+    return archive
+
+
+def mark_verified(catalog, archiveName, verified):
+    """
+    Sets whether the archive *archiveName* of *catalog* *verified*, 
+    recording the time it did, or False if it failed
+
+    Returns the catalog entry dict, or None if not in the catalog
+    """
+    for archive in catalog["Archives"]:
+        if archive["Name"] == archiveName:
+            archive["Verified"] = int(time.time()) if verified else False
+            return archive
+    return None
+
+
+def get_newest_archive(archives):
+    """
+    Returns the catalog entry of the newest of *archives* complete, or None
+    """
+    archives = [a for a in archives if not a.get("In-Progress")]
+    if not archives:
+        return None
+    return max(archives, key=lambda a: (a["Timestamp"] or 0, a.get("Created", 0)))
+
+
+def select_archives_to_delete(archives, policy, timeNow=None):
+    """
+    Returns list of the *archives*, catalog entry dicts, to delete under
+    the *policy* dict, of config TAR_FILE settings
+
+    Archives older than "Delete-Delay" days are deleted, unless kept by
+    "Keep-Daily", "Keep-Weekly" or "Keep-Monthly", each keeping the
+    newest archive of that many of the most recent days, weeks or
+    months. Then, while the total size is over "Max-Total-MB", the
+    oldest archives are deleted. Archives without timestamp, the newest
+    archive once any keep setting is used, and archives needed by a
+    kept incremental or differential archive are never deleted. Archives
+    still in progress, left by failed runs, are deleted once older than
+    "Delete-Delay" days, and never kept
+    """
+    timeNow = int(time.time()) if timeNow is None else timeNow
+    dated = sorted([a for a in archives if a.get("Timestamp") is not None], key=lambda a: a["Timestamp"])
+    failed = [a for a in dated if a.get("In-Progress")]
+    dated = [a for a in dated if not a.get("In-Progress")]
+    deleteDelay = policy.get("Delete-Delay", 0)
+    keepSettings = (("Keep-Daily", "%Y-%m-%d"), ("Keep-Weekly", "%G-%V"), ("Keep-Monthly", "%Y-%m"))
+    # Grandfather-father-son: newest archive of each of the last N periods
+    keptNames = set()
+    usesKeep = False
+    for setting, periodFormat in keepSettings:
+        keepCount = policy.get(setting, 0)
+        if keepCount <= 0:
+            continue
+        usesKeep = True
+        periods = set()
+        for archive in reversed(dated):
+            period = time.strftime(periodFormat, time.localtime(archive["Timestamp"]))
+            if period in periods:
+                continue
+            if len(periods) >= keepCount:
+                break
+            periods.add(period)
+            keptNames.add(archive["Name"])
+    if usesKeep and dated:
+        keptNames.add(dated[-1]["Name"])
+    deletableTime = timeNow - deleteDelay * 24 * 60 * 60
+    toDelete = [a for a in dated if a["Timestamp"] <= deletableTime and a["Name"] not in keptNames]
+    # Quota, taking the oldest of the rest
+    maxBytes = int(policy.get("Max-Total-MB", 0) * 1000000)
+    if maxBytes > 0:
+        deleteNames = set(a["Name"] for a in toDelete)
+        totalBytes = sum(a.get("Size", 0) for a in archives if a["Name"] not in deleteNames)
+        for archive in dated[:-1]:
+            if totalBytes <= maxBytes:
+                break
+            if archive["Name"] in deleteNames:
+                continue
+            toDelete.append(archive)
+            deleteNames.add(archive["Name"])
+            totalBytes -= archive.get("Size", 0)
+    return [a for a in failed if a["Timestamp"] <= deletableTime] + _protect_dependencies(dated, toDelete)
+
+
+def _protect_dependencies(dated, toDelete):
+    """
+    Returns *toDelete* without the archives that the kept incremental
+    and differential archives depend on: their full archive, and for an
+    incremental archive, the earlier incremental ones on the same full
+    """
+    deleteNames = set(a["Name"] for a in toDelete)
+    protectedNames = set()
+    for archive in dated:
+        if archive["Name"] in deleteNames or archive.get("Type", "full") == "full":
+            continue
+        for other in dated:
+            if other["Timestamp"] >= archive["Timestamp"]:
+                break
+            if other.get("Type", "full") == "full" and other["Timestamp"] == archive.get("Base"):
+                protectedNames.add(other["Name"])
+            elif archive["Type"] == "incremental" and other.get("Type") == "incremental" \
+                    and other.get("Base") == archive.get("Base"):
+                protectedNames.add(other["Name"])
+    return [a for a in toDelete if a["Name"] not in protectedNames]
+
+
+def iter_archive_paths(tarDir, archive):
+    """
+    Yields the paths of the files of the catalog entry *archive* in
+    *tarDir*. For an archive in progress, whose files are not recorded,
+    these are the files it may have, its volumes last, without checking
+    which exist: the caller stops at the first volume not found
+    """
+    if not archive.get("In-Progress"):
+        for fileName in archive["Files"]:
+            yield os.path.join(tarDir, fileName)
+        return
+    tarPath = os.path.join(tarDir, archive["Name"])
+    yield tarPath
+    for suffix in (volumes.INDEX_SUFFIX,) + volumes.SIDECAR_SUFFIXES:
+        yield tarPath + suffix
+    volumeNumber = 1
+    while True:
+        yield volumes.get_volume_path(tarPath, volumeNumber)
+        volumeNumber += 1
+
+
+def prune_archives(tarDir, tarNameStem, policy, tarExtensions):
+    """
+    Deletes old archives in *tarDir* according to *policy*, as found in
+    the catalog, returns report of num of deletions or error
+    """
+    if not os.path.exists(tarDir):
+        return "ERROR: Directory for tar files does not exist"
+    catalog = load_catalog(tarDir, tarNameStem, tarExtensions)
+    if policy.get("Require-Verified", False):
+        newestArchive = get_newest_archive(catalog["Archives"])
+        if newestArchive is not None and not newestArchive.get("Verified"):
+            return "Number of old tar files deleted: 0, as newest archive '%s' is not verified" % newestArchive["Name"]
+    deletedCount = 0
+    try:
+        for archive in select_archives_to_delete(catalog["Archives"], policy):
+            for filePath in iter_archive_paths(tarDir, archive):
+                try:
+                    os.remove(filePath)
+                except FileNotFoundError:
+                    # Already gone, or past the last volume of a failed run
+                    if archive.get("In-Progress") and os.path.splitext(filePath)[1][1:].isdigit():
+                        break
+                except Exception:
+                    # If we can't delete a file, we might as well bail
+                    return "ERROR: file '%s' could not be deleted" % filePath
+            catalog["Archives"].remove(archive)
+            deletedCount += 1
+    finally:
+        save_catalog(tarDir, tarNameStem, catalog)
+    return "Number of old tar files deleted: %d" % deletedCount
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in retention")
+    import tempfile, shutil
+    day = 24 * 60 * 60
+    timeNow = int(time.mktime((2026, 10, 17, 12, 0, 0, 0, 0, -1)))
+
+    def make_archive(daysAgo, backupType="full", baseDaysAgo=None, size=100):
+        timestamp = timeNow - daysAgo * day
+        return {"Name": "test_%d.tgz" % timestamp, "Files": ["test_%d.tgz" % timestamp], "Size": size,
+                "Timestamp": timestamp, "Type": backupType, "SHA256": None,
+                "Base": timeNow - baseDaysAgo * day if baseDaysAgo is not None else None}
+
+    def names_deleted(archives, policy):
+        return sorted(archives.index(a) for a in select_archives_to_delete(archives, policy, timeNow))
+
+    # Delete delay alone
+    archives = [make_archive(d) for d in (10, 8, 6, 1)]
+    assert names_deleted(archives, {"Delete-Delay": 7}) == [0, 1]
+    assert names_deleted(archives, {"Delete-Delay": 0}) == [0, 1, 2, 3]
+    # Grandfather-father-son, with daily archives for 100 days
+    archives = [make_archive(d) for d in range(100, -1, -1)]
+    deleted = select_archives_to_delete(archives, {"Delete-Delay": 1, "Keep-Daily": 7, "Keep-Weekly": 4, "Keep-Monthly": 3}, timeNow)
+    kept = [a for a in archives if a not in deleted]
+    assert 7 <= len(kept) <= 7 + 4 + 3
+    assert archives[-1] in kept and archives[-7] in kept and archives[-8] not in kept[-7:]
+    keptMonths = set(time.strftime("%Y-%m", time.localtime(a["Timestamp"])) for a in kept)
+    assert len(keptMonths) == 3
+    # Quota deletes the oldest, never the newest
+    archives = [make_archive(d, size=400000) for d in (5, 4, 3, 2)]
+    assert names_deleted(archives, {"Delete-Delay": 30, "Max-Total-MB": 1}) == [0, 1]
+    assert names_deleted(archives, {"Delete-Delay": 30, "Max-Total-MB": 0.1}) == [0, 1, 2]
+    # Full and earlier incremental archives kept while a later incremental is
+    archives = [make_archive(10), make_archive(9, "incremental", 10), make_archive(8, "incremental", 10),
+                make_archive(2), make_archive(1, "differential", 2)]
+    assert names_deleted(archives, {"Delete-Delay": 9}) == []
+    assert names_deleted(archives, {"Delete-Delay": 8}) == [0, 1, 2]
+    assert names_deleted(archives, {"Delete-Delay": 8.5}) == []
+    assert names_deleted(archives, {"Delete-Delay": 0, "Keep-Daily": 1}) == [0, 1, 2]
+    # Archives of failed runs never kept, nor the newest
+    archives = [make_archive(3), make_archive(2), make_archive(1)]
+    archives[2]["In-Progress"] = True
+    assert names_deleted(archives, {"Delete-Delay": 1, "Keep-Daily": 7}) == [2]
+    assert names_deleted(archives, {"Delete-Delay": 2, "Keep-Daily": 1}) == [0]
+    # Deleted once older than the delay, by the second
+    archives = [{"Name": "test_%d.tgz" % x, "Timestamp": x} for x in (timeNow - 2 * day - 1, timeNow - 2 * day + 1)]
+    assert names_deleted(archives, {"Delete-Delay": 2}) == [0]
+
+    # Catalog rebuilt from the directory, then pruned as a lookup
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_retention_")
+    try:
+        oldStamp = int(time.time()) - 3 * day
+        newStamp = int(time.time())
+        for name in ("test_%d.tgz" % oldStamp, "test_%d.txz.001" % oldStamp, "test_%d.txz.index.json" % oldStamp,
+                        "test_%d.tgz" % newStamp, "test.tgz", "test_%d.zip" % oldStamp, "other_%d.tgz" % oldStamp):
+            with open(os.path.join(testDir, name), "w") as fp:
+                fp.write("data")
+        catalog = load_catalog(testDir, "test", (".tgz", ".txz"))
+        assert [a["Name"] for a in catalog["Archives"]] == ["test.tgz", "test_%d.tgz" % oldStamp,
+                                                            "test_%d.txz" % oldStamp, "test_%d.tgz" % newStamp]
+        assert catalog["Archives"][2]["Files"] == ["test_%d.txz.001" % oldStamp, "test_%d.txz.index.json" % oldStamp]
+        assert catalog["Archives"][2]["Size"] == 8
+        assert prune_archives(testDir, "test", {"Delete-Delay": 2}, (".tgz", ".txz")) == "Number of old tar files deleted: 2"
+        assert sorted(os.listdir(testDir)) == sorted(["test_%d.tgz" % newStamp, "test.tgz", "test_%d.zip" % oldStamp,
+                                                        "other_%d.tgz" % oldStamp, "test.catalog.json"])
+        # The output of a failed run, recorded in progress, pruned from
+        # the catalog without listing the directory
+        catalog = load_catalog(testDir, "test", (".tgz",))
+        failedPath = os.path.join(testDir, "test_%d.tgz" % oldStamp)
+        archive = record_started(catalog, failedPath, "incremental", oldStamp - day)
+        assert archive["In-Progress"] and archive["Files"] == ["test_%d.tgz" % oldStamp]
+        assert get_newest_archive(catalog["Archives"])["Name"] == "test_%d.tgz" % newStamp
+        save_catalog(testDir, "test", catalog)
+        for name in ("test_%d.tgz.001" % oldStamp, "test_%d.tgz.002" % oldStamp, "test_%d.tgz.index.json" % oldStamp,
+                        "test_%d.tgz" % (oldStamp - 1)):
+            with open(os.path.join(testDir, name), "w") as fp:
+                fp.write("data")
+        def no_listing(*args, **kwargs):
+            raise AssertionError("Directory listed")
+        listingFunctions = os.scandir, os.listdir, os.walk
+        os.scandir = os.listdir = os.walk = no_listing
+        try:
+            assert prune_archives(testDir, "test", {"Delete-Delay": 2}, (".tgz",)) == "Number of old tar files deleted: 1"
+        finally:
+            os.scandir, os.listdir, os.walk = listingFunctions
+        assert sorted(os.listdir(testDir)) == sorted(["test_%d.tgz" % newStamp, "test.tgz", "test_%d.zip" % oldStamp,
+                                                        "other_%d.tgz" % oldStamp, "test.catalog.json",
+                                                        "test_%d.tgz" % (oldStamp - 1)])
+        # Archives from before the catalog added only by rebuilding it,
+        # keeping the entries of the archives recorded
+        catalog = load_catalog(testDir, "test", (".tgz",))
+        catalog["Archives"][-1]["Type"] = "differential"
+        catalog = rebuild_catalog(testDir, "test", (".tgz",), catalog)
+        assert [a["Name"] for a in catalog["Archives"]] == ["test.tgz", "test_%d.tgz" % (oldStamp - 1),
+                                                            "test_%d.tgz" % newStamp]
+        assert catalog["Archives"][-1]["Type"] == "differential"
+        save_catalog(testDir, "test", catalog)
+        assert prune_archives(testDir, "test", {"Delete-Delay": 2}, (".tgz",)) == "Number of old tar files deleted: 1"
+        catalog = load_catalog(testDir, "test", (".tgz",))
+        # Recording a new archive, with its member index
+        with open(os.path.join(testDir, "test_%d.tgz.members.json.gz" % newStamp), "w") as fp:
+            fp.write("index")
+        archive = record_archive(catalog, os.path.join(testDir, "test_%d.tgz" % newStamp), "incremental", oldStamp)
+        assert archive["SHA256"] == hashlib.sha256(b"data").hexdigest()
+        assert archive["Files"] == ["test_%d.tgz" % newStamp, "test_%d.tgz.members.json.gz" % newStamp]
+        assert archive["Type"] == "incremental" and archive["Base"] == oldStamp and archive["Timestamp"] == newStamp
+        assert len(catalog["Archives"]) == 2
+        # Nothing pruned until the newest archive is verified
+        save_catalog(testDir, "test", catalog)
+        policy = {"Delete-Delay": 0, "Require-Verified": True}
+        assert prune_archives(testDir, "test", policy, (".tgz",)).endswith("'test_%d.tgz' is not verified" % newStamp)
+        assert len(os.listdir(testDir)) == 6
+        catalog = load_catalog(testDir, "test", (".tgz",))
+        assert mark_verified(catalog, "test_%d.tgz" % newStamp, False)["Verified"] is False
+        assert mark_verified(catalog, "test_%d.tgz" % newStamp, True)["Verified"] > 0
+        assert mark_verified(catalog, "nothing.tgz", True) is None
+        save_catalog(testDir, "test", catalog)
+        assert prune_archives(testDir, "test", policy, (".tgz",)) == "Number of old tar files deleted: 1"
+        assert prune_archives("/d09bjdjk988dnx98sjkjbxbv?dAKqiA@d", "a", {}, (".tgz",)) == "ERROR: Directory for tar files does not exist"
+    finally:
+        shutil.rmtree(testDir)
+    print("All retention tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Minimal in-process S3-compatible server that keeps objects in memory, as
+a stand-in for object storage in tests
+
+Only the path-style requests the s3 module sends are handled. Signatures
+are not checked, but the payload checksum is. Server errors can be made
+to happen, to test retries and resuming
+"""
+
+import sys, os, hashlib, itertools, threading, socketserver, urllib.parse
+import http.server
+import xml.etree.ElementTree as ElementTree
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class S3Server(object):
+    """
+    S3 server on *host*, on a free port unless *port* is given, with the
+    *buckets*, run in a background thread between start() and stop(), or
+    as a context manager. Its *endpoint* is the URL to connect to
+
+    Setting *failRequests* makes that many next requests fail with a
+    server error, and *failPartsAfter* makes part uploads fail once that
+    many have been received, until set to None
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, buckets=()):
+        self.buckets = dict((b, {}) for b in buckets)
+        self.uploads = {}
+        self.uploadIds = itertools.count(1)
+        self.partRequests = 0
+        self.failRequests = 0
+        self.failPartsAfter = None
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, "GET")
+
+            def do_HEAD(self):
+                server._handle(self, "HEAD")
+
+            def do_PUT(self):
+                server._handle(self, "PUT")
+
+            def do_POST(self):
+                server._handle(self, "POST")
+
+            def do_DELETE(self):
+                server._handle(self, "DELETE")
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        self.host, self.port = self.server.server_address[:2]
+        self.endpoint = "http://%s:%d" % (self.host, self.port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="s3-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *excInfo):
+        self.stop()
+
+    def _handle(self, handler, method):
+        parsedPath = urllib.parse.urlsplit(handler.path)
+        query = dict(urllib.parse.parse_qsl(parsedPath.query, keep_blank_values=True))
+        bucketName, _, key = urllib.parse.unquote(parsedPath.path).lstrip("/").partition("/")
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        with self.lock:
+            status, responseBody, headers = self._respond(handler, method, bucketName, key, query, body)
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(responseBody)))
+        handler.end_headers()
+        if method != "HEAD":
+            handler.wfile.write(responseBody)
+
+    def _respond(self, handler, method, bucketName, key, query, body):
+        if not handler.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 "):
+            return error_response(403, "AccessDenied")
+        if handler.headers.get("x-amz-content-sha256") != hashlib.sha256(body).hexdigest():
+            return error_response(400, "XAmzContentSHA256Mismatch")
+        if self.failRequests > 0:
+            self.failRequests -= 1
+            return error_response(500, "InternalError")
+        bucket = self.buckets.get(bucketName)
+        if bucket is None:
+            return error_response(404, "NoSuchBucket")
+        uploadId = query.get("uploadId")
+        if uploadId is not None and uploadId not in self.uploads:
+            return error_response(404, "NoSuchUpload")
+        if method == "POST" and "uploads" in query:
+            uploadId = "upload-%d" % next(self.uploadIds)
+            self.uploads[uploadId] = {"Key": key, "Parts": {}}
+            return xml_response("InitiateMultipartUploadResult", [("Bucket", bucketName), ("Key", key),
+                                                                    ("UploadId", uploadId)])
+        elif method == "PUT" and uploadId is not None:
+            self.partRequests += 1
+            if self.failPartsAfter is not None and self.partRequests > self.failPartsAfter:
+                return error_response(500, "InternalError")
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            self.uploads[uploadId]["Parts"][int(query["partNumber"])] = (etag, body)
+            return 200, b"", {"ETag": etag}
+        elif method == "GET" and uploadId is not None:
+            parts = self.uploads[uploadId]["Parts"]
+            partElements = [("Part", [("PartNumber", n), ("ETag", parts[n][0]), ("Size", len(parts[n][1]))])
+                            for n in sorted(parts)]
+            return xml_response("ListPartsResult", [("UploadId", uploadId), ("IsTruncated", "false")] + partElements)
+        elif method == "POST" and uploadId is not None:
+            parts = self.uploads[uploadId]["Parts"]
+            data = []
+            for partElement in ElementTree.fromstring(body):
+                fields = dict((e.tag, e.text) for e in partElement)
+                part = parts.get(int(fields["PartNumber"]))
+                if part is None or part[0] != fields["ETag"]:
+                    return error_response(400, "InvalidPart")
+                data.append(part[1])
+            bucket[key] = b"".join(data)
+            del self.uploads[uploadId]
+            return xml_response("CompleteMultipartUploadResult", [("Bucket", bucketName), ("Key", key)])
+        elif method == "DELETE" and uploadId is not None:
+            del self.uploads[uploadId]
+            return 204, b"", {}
+        elif method == "PUT":
+            bucket[key] = body
+            return 200, b"", {"ETag": '"%s"' % hashlib.md5(body).hexdigest()}
+        elif method in ("GET", "HEAD"):
+            if key not in bucket:
+                return error_response(404, "NoSuchKey")
+            return 200, bucket[key], {}
+        elif method == "DELETE":
+            bucket.pop(key, None)
+            return 204, b"", {}
+        return error_response(400, "InvalidRequest")
+
+
+def xml_response(rootName, children, status=200):
+    """
+    Returns response tuple of an XML document of *rootName* element with
+    the *children* list of (name, text or list of children) tuples
+    """
+    def add_children(element, children):
+        for name, value in children:
+            child = ElementTree.SubElement(element, name)
+            if isinstance(value, list):
+                add_children(child, value)
+            else:
+                child.text = str(value)
+    root = ElementTree.Element(rootName, xmlns="http://s3.amazonaws.com/doc/2006-03-01/")
+    add_children(root, children)
+    return status, ElementTree.tostring(root, encoding="utf-8"), {"Content-Type": "application/xml"}
+
+
+def error_response(status, code):
+    return xml_response("Error", [("Code", code), ("Message", code)], status)
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in s3Server")
+    import http.client
+    with S3Server(buckets=["b"]) as server:
+        connection = http.client.HTTPConnection(server.host, server.port)
+        connection.request("PUT", "/b/k", body=b"data", headers={"Authorization": "AWS4-HMAC-SHA256 x",
+                                                "x-amz-content-sha256": hashlib.sha256(b"data").hexdigest()})
+        assert connection.getresponse().read() == b""
+        connection.request("PUT", "/b/k", body=b"data", headers={"Authorization": "AWS4-HMAC-SHA256 x",
+                                                "x-amz-content-sha256": "0"})
+        response = connection.getresponse()
+        assert response.status == 400 and b"XAmzContentSHA256Mismatch" in response.read()
+    assert server.buckets["b"]["k"] == b"data"
+    print("All s3Server tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Seekable archives, with an index of the compressed offset of each member
+for restoring single files without decompressing the whole archive
+
+The archive is written as usual, but a new gzip member or bz2 or xz
+stream is started before a tar member once *blockSize* bytes have been
+written since the last one, so decompression can begin there. Stock
+tools read the archive as before. The index "name.tgz.members.json.gz"
+next to it lists, for each member, the compressed offset to start at,
+the uncompressed bytes to skip from there to its header, and its size
+"""
+
+import sys, os, io, json, gzip, bz2, lzma, bisect, tarfile, collections
+
+try:
+    from . import volumes
+except ImportError: # Run as a script for testing
+    import volumes
+
+INDEX_VERSION = 1
+MEMBER_INDEX_SUFFIX = ".members.json.gz"
+
+# Uncompressed bytes between the points decompression can start at, which
+# bounds the bytes decompressed and skipped to reach any member
+SEEK_BLOCK_SIZE = 1024 * 1024
+
+
+def get_member_index_path(tarFilePath):
+    """
+    Returns path of the member index of the archive
+    """
+    return tarFilePath + MEMBER_INDEX_SUFFIX
+
+
+class MemberIndex(object):
+    """
+    Collects the uncompressed offsets of the members written to a tar
+    file, restarting its compress.CompressWriter every *blockSize* bytes
+    """
+
+    def __init__(self, blockSize=SEEK_BLOCK_SIZE):
+        self.blockSize = blockSize
+        self.members = []
+
+    def add_member(self, tar, tarInfo):
+        """
+        Records *tarInfo*, about to be added to *tar*, restarting the
+        compression first if the block size has been reached
+        """
+        compressor = tar.fileobj
+        if tar.offset - compressor.streamStart >= self.blockSize:
+            compressor.restart()
+        self.members.append((tarInfo.name, tar.offset, tarInfo.size))
+
+    def get_entries(self, flushPoints, compressedBase=0):
+        """
+        Returns list of [name, compressed offset, bytes to skip, size]
+        of the members, from the *flushPoints* of the compressor, with
+        *compressedBase* added to the offsets
+        """
+        positions = [p[0] for p in flushPoints]
+        entries = []
+        for name, offset, size in self.members:
+            position, compressedPosition = flushPoints[bisect.bisect_right(positions, offset) - 1]
+            entries.append([name, compressedBase + compressedPosition, offset - position, size])
+        return entries
+
+
+def save_member_index(tarFilePath, codec, entries):
+    """
+    Writes the member index of the archive, from *entries* as returned
+    by MemberIndex.get_entries()
+    """
+    memberIndex = {
+                    "Version"   :   INDEX_VERSION,
+                    "Archive"   :   os.path.basename(tarFilePath),
+                    "Codec"     :   codec,
+                    "Members"   :   entries,
+                }
+    indexPath = get_member_index_path(tarFilePath)
+    with gzip.open(indexPath + ".tmp", "wt", encoding="utf-8") as fp:
+        json.dump(memberIndex, fp, separators=(",", ":"))
+    os.replace(indexPath + ".tmp", indexPath)
+
+
+def load_member_index(tarFilePath):
+    """
+    Returns member index dict of the archive, or None if it has none
+    """
+    try:
+        with gzip.open(get_member_index_path(tarFilePath), "rt", encoding="utf-8") as fp:
+            memberIndex = json.load(fp)
+        if memberIndex.get("Version") != INDEX_VERSION:
+            return None
+        return memberIndex
+    except (OSError, ValueError):
+        return None
+
+
+def find_members(memberIndex, memberName):
+    """
+    Returns list of the index entries of *memberName*, and of all
+    members under it if it is a folder, in archive order
+    """
+    memberName = memberName.strip("/")
+    prefix = memberName + "/"
+    return [e for e in memberIndex["Members"] if e[0] == memberName or e[0].startswith(prefix)]
+
+
+def open_decompressed(fp, codec):
+    """
+    Returns file object decompressing *fp* with *codec*, from its
+    current position, across concatenated members or streams
+    """
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fp, mode="rb")
+    elif codec == "bz2":
+        return bz2.BZ2File(fp, "rb")
+    elif codec == "xz":
+        return lzma.LZMAFile(fp, "rb")
+    return fp
+
+
+def restore_members(tarFilePath, memberName, destDir):
+    """
+    Extracts *memberName*, and all members under it if it is a folder,
+    from the archive at *tarFilePath*, possibly split into volumes, to
+    *destDir*, seeking to the first of them by the member index and
+    reading on only as far as the last
+
+    Returns tuple of list of the names extracted, and any error message
+    """
+    returnError = ""
+    restoredNames = []
+    memberIndex = load_member_index(tarFilePath)
+    if memberIndex is None:
+        return restoredNames, "ERROR: Archive '%s' has no member index" % tarFilePath
+    entries = find_members(memberIndex, memberName)
+    if not entries:
+        return restoredNames, "ERROR: '%s' not found in archive '%s'" % (memberName, tarFilePath)
+    # A member added more than once, like a file changed since a 
+    # checkpoint, is restored from its last copy, so reading starts at 
+    # the first last copy, and goes on until all copies since are read
+    lastEntries = dict((e[0], e) for e in entries)
+    entries = entries[min(i for i, e in enumerate(entries) if lastEntries[e[0]] is e):]
+    wantedCounts = collections.Counter(e[0] for e in entries)
+    try:
+        with volumes.open_archive(tarFilePath) as fp:
+            fp.seek(entries[0][1])
+            stream = open_decompressed(fp, memberIndex["Codec"])
+            skipBytes = entries[0][2]
+            while skipBytes > 0:
+                skipped = len(stream.read(min(skipBytes, 1024 * 1024)))
+                if not skipped:
+                    raise EOFError("Archive ends before member '%s'" % entries[0][0])
+                skipBytes -= skipped
+            tar = tarfile.open(fileobj=stream, mode="r|")
+            if hasattr(tarfile, "tar_filter"):
+                tar.extraction_filter = tarfile.tar_filter
+            for tarInfo in tar:
+                if wantedCounts[tarInfo.name] > 0:
+                    tar.extract(tarInfo, destDir)
+                    wantedCounts[tarInfo.name] -= 1
+                    if not wantedCounts[tarInfo.name]:
+                        restoredNames.append(tarInfo.name)
+                        del wantedCounts[tarInfo.name]
+                        if not wantedCounts:
+                            break
+    except Exception as e:
+        returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    return restoredNames, returnError
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in seekable")
+    import tempfile, shutil
+    try:
+        from . import compress
+    except ImportError:
+        import compress
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_seekable_")
+    try:
+        data = dict(("d/f%03d.txt" % i, (b"file %d " % i) * (i * 100)) for i in range(200))
+        for codecName in ("gzip", "xz", "none"):
+            for workers in (1, 2):
+                tarPath = os.path.join(testDir, "test_1" + compress.get_extension(codecName))
+                memberIndex = MemberIndex(blockSize=64 * 1024)
+                with open(tarPath, "wb") as outFile:
+                    compressor = compress.CompressWriter(outFile, codec=codecName, workers=workers, blockSize=256 * 1024)
+                    with tarfile.open(fileobj=compressor, mode="w") as tar:
+                        for name in sorted(data):
+                            tarInfo = tarfile.TarInfo(name)
+                            tarInfo.size = len(data[name])
+                            memberIndex.add_member(tar, tarInfo)
+                            tar.addfile(tarInfo, io.BytesIO(data[name]))
+                    compressor.close()
+                assert len(compressor.flushPoints) > 10
+                save_member_index(tarPath, codecName, memberIndex.get_entries(compressor.flushPoints))
+                # Archive still readable by tarfile
+                with tarfile.open(tarPath, "r:*") as tar:
+                    assert len(tar.getnames()) == len(data)
+                destDir = os.path.join(testDir, "restore")
+                restoredNames, returnError = restore_members(tarPath, "d/f150.txt", destDir)
+                assert returnError == "" and restoredNames == ["d/f150.txt"]
+                with open(os.path.join(destDir, "d/f150.txt"), "rb") as fp:
+                    assert fp.read() == data["d/f150.txt"]
+                restoredNames, returnError = restore_members(tarPath, "/d/", destDir)
+                assert returnError == "" and len(restoredNames) == len(data)
+                assert restore_members(tarPath, "d/nothing", destDir)[1].startswith("ERROR: 'd/nothing' not found")
+                shutil.rmtree(destDir)
+                os.remove(tarPath)
+        assert restore_members(tarPath, "d/f001.txt", testDir)[1].startswith("ERROR: <class 'FileNotFoundError'>")
+        os.remove(get_member_index_path(tarPath))
+        assert restore_members(tarPath, "d/f001.txt", testDir)[1].startswith("ERROR: Archive")
+        assert volumes.strip_volume_suffix(os.path.basename(get_member_index_path(tarPath))) == os.path.basename(tarPath)
+    finally:
+        shutil.rmtree(testDir)
+    print("All seekable tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
@@ -6,61 +6,314 @@ Emailing component, using settings from config to construct the email
 and send it with the local SMTP server
 """
 
-import sys, os
+import sys, os, io, re, base64
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
 import smtplib
 
+try:
+    from . import compress, volumes
+except ImportError: # Run as a script for testing
+    import compress, volumes
 
-def create_and_send_email_message(tarFilePath, configEmail, testMode=False):
+# Bytes of the file base64 encoded at a time, a multiple of the 57 bytes
+# that make a 76 char line
+ATTACHMENT_CHUNK_SIZE = 57 * 16384
+
+ATTACHMENT_PLACEHOLDER = "@@beBackupTool-attachment@@"
+
+
+def create_and_send_email_message(tarFilePath, configEmail, testMode=False, emailStats=None):
     """
     Create multipart email message with tar file and send it
     
+    The message is streamed into the SMTP DATA command, with the file 
+    base64 encoded in chunks, so memory use does not grow with its size.
+    If the archive was split into volumes, each is sent as a message of
+    its own, see send_email_messages()
+    
     Returns tuple of *refusedDict* that may be empty, and *returnError*
     """
+    return send_email_messages(volumes.list_archive_files(tarFilePath), configEmail, testMode, emailStats)
+
+
+def send_email_messages(filePaths, configEmail, testMode=False, emailStats=None):
+    """
+    Create a multipart email message for each file in *filePaths* and 
+    send them all over one SMTP connection, numbering the parts in the
+    subject if there is more than one
+    
+    If *emailStats* is a dict, it is given the number of "messages" sent
+    and the "bytes" of their SMTP data
+    
+    Returns tuple of *refusedDict* of recipients refused for any message,
+    that may be empty, and *returnError*
+    """
     returnError = ""
     refusedDict = dict()
+    if emailStats is None:
+        emailStats = dict()
+    emailStats.setdefault("messages", 0)
+    emailStats.setdefault("bytes", 0)
     try:
-        msg = MIMEMultipart()
-        msg["Subject"] = configEmail["Subject"]
-        msg["From"] = configEmail["Address-From"]
-        msg["To"] = configEmail["Address-To"]
-        # File part
-        if testMode:
-            maintype = "text"
-            subtype = "plain"
-            with open(tarFilePath, "rb") as fp:
-                filePart = MIMEBase(maintype, subtype)
-                filePart.set_payload(fp.read())
-            encoders.encode_base64(filePart)
-        else:
-            maintype = "application"
-            subtype = "octet-stream"
-            with open(tarFilePath, "rb") as fp:
-                filePart = MIMEBase(maintype, subtype)
-                filePart.set_payload(fp.read())
-            encoders.encode_base64(filePart)
-        filePart.add_header("Content-Disposition", "attachment", filename=os.path.basename(tarFilePath))
-        msg.attach(filePart)
-        # Message text body part
-        if testMode:
-            textPart = MIMEText("Test message sent from sendEmail.py main_test()")
-        else:
-            textPart = MIMEText(configEmail["Body"])
-        msg.attach(textPart)
-        # Send
-        msgString = msg.as_string(unixfrom=True) # Required?
-        #msgString = msg.as_string()
-        with smtplib.SMTP("localhost") as s:
-            refusedDict = s.sendmail(configEmail["Address-From"], configEmail["Address-To"], msgString)
+        with open_smtp_connection(configEmail) as s:
+            for partNum, filePath in enumerate(filePaths, 1):
+                msgHead, msgTail = create_part_envelope(filePaths, partNum, configEmail, testMode)
+                # Send
+                chunks = iter_counted_chunks(iter_message_chunks(filePath, msgHead, msgTail), emailStats)
+                refusedDict.update(send_streamed_message(s, configEmail["Address-From"], get_recipients(configEmail), chunks))
+                emailStats["messages"] += 1
     except Exception as e:
         returnError = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
     return refusedDict, returnError
 
 
+def get_recipients(configEmail):
+    """
+    Returns list of the To addresses of *configEmail*, whose Address-To 
+    may be one address, several separated by commas, or a list
+    """
+    addressTo = configEmail["Address-To"]
+    if isinstance(addressTo, str):
+        addressTo = addressTo.split(",")
+    return [x.strip() for x in addressTo if x.strip()]
+
+
+def create_part_envelope(filePaths, partNum, configEmail, testMode=False, messageId=None):
+    """
+    Returns tuple of the message text before and after the attachment, 
+    as by create_message_envelope(), for file number *partNum*, from 1,
+    of *filePaths*, the volumes of an archive or the archive alone
+    """
+    filePath = filePaths[partNum - 1]
+    if testMode:
+        maintype, subtype = "text", "plain"
+        bodyText = "Test message sent from sendEmail.py main_test()"
+    else:
+        # MIME type follows the compression codec of the archive
+        maintype, subtype = compress.get_mime_type(filePath)
+        bodyText = configEmail["Body"]
+    subject = configEmail["Subject"]
+    if len(filePaths) > 1:
+        subject = "%s (part %d of %d)" % (subject, partNum, len(filePaths))
+        bodyText += "\n\nPart %d of %d. Reassemble the parts with:\n\n    cat %s > %s\n" \
+                    % (partNum, len(filePaths), " ".join(os.path.basename(x) for x in filePaths),
+                        volumes.strip_volume_suffix(os.path.basename(filePath)))
+    return create_message_envelope(filePath, configEmail, maintype, subtype, bodyText, subject, messageId)
+
+
+def open_smtp_connection(configEmail):
+    """
+    Returns SMTP connection to the server set in *configEmail*, by
+    default the local one
+    """
+    return smtplib.SMTP(configEmail.get("SMTP-Host", "localhost"), configEmail.get("SMTP-Port", 0))
+
+
+def create_message_envelope(tarFilePath, configEmail, maintype, subtype, bodyText, subject=None, messageId=None):
+    """
+    Returns tuple of the message text before and after the base64 
+    encoded file attachment, in SMTP form with CRLF line endings and 
+    dot-stuffing
+    
+    The *messageId*, if given, is set as the Message-ID header, so a 
+    message sent again can be recognised as the same
+    """
+    msg = MIMEMultipart()
+    msg["Subject"] = subject if subject is not None else configEmail["Subject"]
+    msg["From"] = configEmail["Address-From"]
+    msg["To"] = ", ".join(get_recipients(configEmail))
+    if messageId is not None:
+        msg["Message-ID"] = messageId
+    # File part, holding a placeholder where the encoded file is streamed
+    filePart = MIMEBase(maintype, subtype)
+    filePart["Content-Transfer-Encoding"] = "base64"
+    filePart.add_header("Content-Disposition", "attachment", filename=os.path.basename(tarFilePath))
+    filePart.set_payload(ATTACHMENT_PLACEHOLDER)
+    msg.attach(filePart)
+    # Message text body part
+    msg.attach(MIMEText(bodyText))
+    msgHead, msgTail = msg.as_string().split(ATTACHMENT_PLACEHOLDER)
+    # The encoded file ends with a line break of its own
+    if msgTail.startswith("\n"):
+        msgTail = msgTail[1:]
+    return to_smtp_data(msgHead), to_smtp_data(msgTail)
+
+
+def to_smtp_data(text):
+    """
+    Returns *text* as ASCII bytes with CRLF line endings, and lines 
+    starting with a dot escaped, as required in the SMTP DATA command
+    """
+    data = text.replace("\r\n", "\n").replace("\n", "\r\n").encode("ascii")
+    data = re.sub(rb"(?m)^\.", b"..", data)
+    return data
+
+
+def iter_message_chunks(tarFilePath, msgHead, msgTail):
+    """
+    Yields the SMTP data of the message in chunks, reading and base64
+    encoding the file at *tarFilePath* piece by piece
+    """
+    yield msgHead
+    with open(tarFilePath, "rb") as fp:
+        while True:
+            data = fp.read(ATTACHMENT_CHUNK_SIZE)
+            if not data:
+                break
+            # Base64 lines never start with a dot, so need no escaping
+            yield base64.encodebytes(data).replace(b"\n", b"\r\n")
+    yield msgTail
+
+
+def iter_counted_chunks(chunks, emailStats):
+    """
+    Yields the *chunks*, adding their length to the "bytes" of the 
+    *emailStats* dict
+    """
+    for chunk in chunks:
+        emailStats["bytes"] += len(chunk)
+        yield chunk
+
+
+def send_streamed_message(smtp, fromAddress, toAddresses, chunks):
+    """
+    Sends the message data from the *chunks* iterable over the open 
+    *smtp* connection, as smtplib.SMTP.sendmail() does for a whole 
+    message, raising the same exceptions
+    
+    Returns dict of refused recipients, that may be empty
+    """
+    refusedDict = start_message(smtp, fromAddress, toAddresses)
+    lastChunk = b"\r\n"
+    for chunk in chunks:
+        if chunk:
+            smtp.send(chunk)
+            lastChunk = chunk
+    end_message(smtp, lastChunk)
+    return refusedDict
+
+
+def start_message(smtp, fromAddress, toAddresses):
+    """
+    Starts a message over the open *smtp* connection, up to the DATA
+    command, after which its data is sent
+    
+    Returns dict of refused recipients, that may be empty
+    """
+    smtp.ehlo_or_helo_if_needed()
+    code, resp = smtp.mail(fromAddress)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, fromAddress)
+    refusedDict = dict()
+    for toAddress in toAddresses:
+        code, resp = smtp.rcpt(toAddress)
+        if code not in (250, 251):
+            refusedDict[toAddress] = (code, resp)
+    if len(refusedDict) == len(toAddresses):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refusedDict)
+    code, resp = smtp.docmd("data")
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refusedDict
+
+
+def end_message(smtp, lastChunk):
+    """
+    Ends the data of the message sent over *smtp*, the last of which 
+    was *lastChunk*, and checks that it was accepted
+    """
+    smtp.send(b".\r\n" if lastChunk.endswith(b"\r\n") else b"\r\n.\r\n")
+    code, resp = smtp.getreply()
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+
+class EmailStreamWriter(io.RawIOBase):
+    """
+    Write-only file object emailing the data written to it as the file
+    *tarFilePath* attached, base64 encoded as it comes, so the archive
+    is sent as it is written, without being read back. The connection
+    is opened on the first write, and the message sent when closed, or
+    dropped with abort(), by closing the connection before its end
+    
+    The *refusedDict* of recipients refused is known once it is closed,
+    and *emailStats*, if a dict, is added to as by send_email_messages()
+    """
+
+    def __init__(self, tarFilePath, configEmail, emailStats=None, testMode=False):
+        self.msgHead, self.msgTail = create_part_envelope([tarFilePath], 1, configEmail, testMode)
+        self.configEmail = configEmail
+        self.emailStats = emailStats if emailStats is not None else dict()
+        self.emailStats.setdefault("messages", 0)
+        self.emailStats.setdefault("bytes", 0)
+        self.refusedDict = dict()
+        self.smtp = None
+        # Data not yet encoded, less than the 57 bytes of a base64 line
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.smtp is None:
+            self._start()
+        self.buffer += data
+        self.position += len(data)
+        size = len(self.buffer) - len(self.buffer) % 57
+        if size:
+            self._send(base64.encodebytes(bytes(self.buffer[:size])).replace(b"\n", b"\r\n"))
+            del self.buffer[:size]
+        return len(data)
+
+    def _start(self):
+        self.smtp = open_smtp_connection(self.configEmail)
+        self.refusedDict = start_message(self.smtp, self.configEmail["Address-From"], get_recipients(self.configEmail))
+        self._send(self.msgHead)
+
+    def _send(self, data):
+        self.smtp.send(data)
+        self.emailStats["bytes"] += len(data)
+
+    def close(self):
+        """
+        Sends the rest of the message
+        """
+        if self.closed:
+            return
+        try:
+            if self.smtp is None:
+                self._start()
+            if self.buffer:
+                self._send(base64.encodebytes(bytes(self.buffer)).replace(b"\n", b"\r\n"))
+            self._send(self.msgTail)
+            end_message(self.smtp, self.msgTail)
+            self.emailStats["messages"] += 1
+            self.smtp.quit()
+        except Exception:
+            self.abort()
+            raise
+        io.RawIOBase.close(self)
+
+    def abort(self):
+        """
+        Drops the message, closing the connection before its end
+        """
+        if self.smtp is not None:
+            self.smtp.close()
+        io.RawIOBase.close(self)
+
+
 def main_test():
     """
     Test emailing by sending the package LICENSE file, using config email preferences
@@ -71,11 +324,77 @@ def main_test():
     thisFile = os.path.abspath(__file__)
     fp = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(thisFile))), "LICENSE")
     assert os.path.exists(fp)
-    refusedDict, returnError = create_and_send_email_message(fp, config.EMAIL_PREFS, testMode=True)
-    assert len(refusedDict) == 0
-    if returnError != "":
-        print(returnError)
-    assert returnError == ""
+    # Test message streaming, decoding the chunks as a whole message
+    import email
+    msgHead, msgTail = create_message_envelope(fp, config.EMAIL_PREFS, "text", "plain", ".Body text")
+    smtpData = b"".join(iter_message_chunks(fp, msgHead, msgTail))
+    assert b"\n" not in smtpData.replace(b"\r\n", b"")
+    assert b"\r\n..Body text" in smtpData
+    msg = email.message_from_bytes(smtpData.replace(b"\r\n..", b"\r\n."))
+    filePart, textPart = msg.get_payload()
+    with open(fp, "rb") as f:
+        assert filePart.get_payload(decode=True) == f.read()
+    assert filePart.get_filename() == "LICENSE"
+    assert textPart.get_payload() == ".Body text"
+    assert get_recipients({"Address-To": "a@b.com, c@d.com"}) == get_recipients({"Address-To": ["a@b.com", "c@d.com"]}) \
+                == ["a@b.com", "c@d.com"]
+    msgHead, msgTail = create_part_envelope([fp, fp], 2, config.EMAIL_PREFS, messageId="<x@y>")
+    assert b"\r\nMessage-ID: <x@y>\r\n" in msgHead and b"(part 2 of 2)" in msgHead
+    # Test sending, to a local SMTP sink on a free port in place of the
+    # mail server
+    try:
+        from . import smtpSink
+    except ImportError:
+        import smtpSink
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_sendEmail_")
+    try:
+        with smtpSink.SMTPSink(keepMessages=True) as sink:
+            configEmail = dict(config.EMAIL_PREFS)
+            configEmail.update({"SMTP-Host": sink.host, "SMTP-Port": sink.port})
+            refusedDict, returnError = create_and_send_email_message(fp, configEmail, testMode=True)
+            if returnError != "":
+                print(returnError)
+            assert returnError == "" and len(refusedDict) == 0
+            assert sink.messageCount == 1
+            filePart = email.message_from_bytes(sink.messages[0]).get_payload()[0]
+            with open(fp, "rb") as f:
+                assert filePart.get_payload(decode=True) == f.read()
+            # Test sending an archive split into volumes, over one connection
+            tarPath = os.path.join(testDir, "LICENSE.tgz")
+            writer = volumes.VolumeWriter(tarPath, 8000)
+            with open(fp, "rb") as f:
+                writer.write(f.read())
+            writer.close()
+            assert len(volumes.list_archive_files(tarPath)) > 1
+            emailStats = {}
+            refusedDict, returnError = create_and_send_email_message(tarPath, configEmail, testMode=True,
+                                                                    emailStats=emailStats)
+            if returnError != "":
+                print(returnError)
+            assert returnError == "" and len(refusedDict) == 0
+            assert emailStats["messages"] == len(volumes.list_archive_files(tarPath))
+            assert sink.messageCount == 1 + emailStats["messages"]
+            assert emailStats["bytes"] > os.path.getsize(fp) * 4 // 3
+            # Test sending a file streamed as it is written
+            emailStats = {}
+            writer = EmailStreamWriter(fp, configEmail, emailStats, testMode=True)
+            with open(fp, "rb") as f:
+                for chunk in iter(lambda: f.read(1000), b""):
+                    writer.write(chunk)
+            writer.close()
+            assert len(writer.refusedDict) == 0 and emailStats["messages"] == 1
+            msgHead, msgTail = create_part_envelope([fp], 1, configEmail, testMode=True)
+            assert emailStats["bytes"] == len(b"".join(iter_message_chunks(fp, msgHead, msgTail)))
+            writer = EmailStreamWriter(fp, configEmail, testMode=True)
+            writer.write(b"data")
+            writer.abort()
+            assert writer.closed
+        # Mail server down
+        refusedDict, returnError = create_and_send_email_message(fp, configEmail, testMode=True)
+        assert returnError.startswith("ERROR")
+    finally:
+        shutil.rmtree(testDir)
     print("All sendEmail tests passed OK")
     return 0
 
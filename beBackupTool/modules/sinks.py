@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Storage sinks, destinations the archives are sent to besides email
+
+A sink uploads the files of a written archive, resuming any upload an
+earlier run left unfinished, or takes the compressed archive as it is
+written, through the file object from open_stream(), so no local file
+is needed. The sinks to use are set in config.STORAGE
+"""
+
+import sys, os
+
+try:
+    from . import s3, volumes
+except ImportError: # Run as a script for testing
+    import s3, volumes
+
+
+class S3Sink(object):
+    """
+    Uploads archives to the S3-compatible bucket set in *configStorage*,
+    recording the uploads of files in progress in *journalPath*
+    """
+
+    name = "S3"
+
+    def __init__(self, configStorage, journalPath):
+        self.client = s3.S3Client(configStorage["S3-Endpoint"], configStorage["S3-Bucket"],
+                                    configStorage.get("S3-Access-Key") or os.environ.get("AWS_ACCESS_KEY_ID", ""),
+                                    configStorage.get("S3-Secret-Key") or os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+                                    configStorage.get("S3-Region", "us-east-1"))
+        self.prefix = configStorage.get("S3-Prefix", "")
+        self.partSize = int(configStorage.get("Part-Size-MB", 16) * 1024 * 1024)
+        self.workers = configStorage.get("Upload-Workers", 4)
+        self.stream = configStorage.get("Stream", False)
+        self.journal = s3.UploadJournal(journalPath)
+
+    def get_key(self, filePath):
+        return self.prefix + os.path.basename(filePath)
+
+    def get_url(self, filePath):
+        return self.client.get_url(self.get_key(filePath))
+
+    def upload_archive(self, tarFilePath):
+        """
+        Uploads the files of the archive at *tarFilePath*, possibly split
+        into volumes, with its sidecar files, after resuming any uploads
+        left unfinished
+
+        Returns tuple of the number of files uploaded and any error
+        message
+        """
+        returnError = self.resume_uploads()
+        if returnError:
+            return 0, returnError
+        filePaths = volumes.list_archive_files(tarFilePath) + volumes.list_sidecar_files(tarFilePath)
+        return self.upload_files(filePaths)
+
+    def upload_sidecars(self, tarFilePath):
+        """
+        Uploads the sidecar files of the archive at *tarFilePath*, whose
+        archive itself was streamed with open_stream(), after resuming 
+        any uploads left unfinished
+
+        Returns tuple of the number of files uploaded and any error
+        message
+        """
+        returnError = self.resume_uploads()
+        if returnError:
+            return 0, returnError
+        return self.upload_files(volumes.list_sidecar_files(tarFilePath))
+
+    def upload_files(self, filePaths):
+        """
+        Returns tuple of the number of *filePaths* uploaded and any error
+        message
+        """
+        try:
+            for filePath in filePaths:
+                s3.upload_file(self.client, filePath, self.get_key(filePath), self.partSize, self.workers, self.journal)
+        except Exception as e:
+            return filePaths.index(filePath), "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        return len(filePaths), ""
+
+    def resume_uploads(self):
+        """
+        Resumes the uploads of files left unfinished, dropping those of
+        files deleted since, and returns any error message
+        """
+        for filePath, upload in sorted(self.journal.uploads.items()):
+            if os.path.exists(filePath):
+                uploadCount, returnError = self.upload_files([filePath])
+                if returnError:
+                    return returnError
+            else:
+                try: self.client.abort_multipart_upload(upload["Key"], upload["Upload-Id"])
+                except Exception: pass
+                self.journal.remove(filePath)
+        return ""
+
+    def open_stream(self, tarFilePath):
+        """
+        Returns file object uploading the archive as it is written, which
+        completes the upload when closed, or cancels it with abort()
+        """
+        return s3.S3MultipartWriter(self.client, self.get_key(tarFilePath), self.partSize, self.workers)
+
+
+def get_sinks(configStorage, tarDir, tarNameStem):
+    """
+    Returns list of the sinks set in *configStorage*, which keep their
+    state in *tarDir*, in files named after *tarNameStem*
+    """
+    sinks = []
+    if configStorage.get("S3-Endpoint"):
+        sinks.append(S3Sink(configStorage, os.path.join(tarDir, tarNameStem + ".uploads.json")))
+    return sinks
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in sinks")
+    import tempfile, shutil
+    try:
+        from . import s3Server
+    except ImportError:
+        import s3Server
+    assert get_sinks({}, "/tmp", "test") == []
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_sinks_")
+    try:
+        with s3Server.S3Server(buckets=["backups"]) as server:
+            configStorage = {"S3-Endpoint": server.endpoint, "S3-Bucket": "backups", "S3-Prefix": "host/",
+                                "S3-Access-Key": "key", "S3-Secret-Key": "secret", "Part-Size-MB": 5}
+            sink = get_sinks(configStorage, testDir, "test")[0]
+            sink.client.retryDelay = 0.01
+            # Archive in volumes, with its index and checksums
+            tarPath = os.path.join(testDir, "test_1.tgz")
+            data = os.urandom(12 * 1024 * 1024)
+            writer = volumes.VolumeWriter(tarPath, 8 * 1024 * 1024)
+            writer.write(data)
+            writer.close()
+            with open(tarPath + ".sums.json.gz", "wb") as fp:
+                fp.write(b"sums")
+            # Upload interrupted, and resumed by the next upload
+            server.failPartsAfter = 1
+            assert sink.upload_archive(tarPath)[1].startswith("ERROR")
+            assert list(sink.journal.uploads) == [tarPath + ".001"]
+            server.failPartsAfter = None
+            otherPath = os.path.join(testDir, "test_2.tgz")
+            with open(otherPath, "wb") as fp:
+                fp.write(b"other")
+            assert sink.upload_archive(otherPath) == (1, "")
+            assert sink.journal.uploads == {}
+            assert server.buckets["backups"]["host/test_1.tgz.001"] == data[:8 * 1024 * 1024]
+            assert sink.upload_archive(tarPath) == (4, "")
+            assert sorted(server.buckets["backups"]) == ["host/test_1.tgz.001", "host/test_1.tgz.002",
+                            "host/test_1.tgz.index.json", "host/test_1.tgz.sums.json.gz", "host/test_2.tgz"]
+            # Streamed
+            stream = sink.open_stream(os.path.join(testDir, "test_3.tgz"))
+            stream.write(data)
+            stream.close()
+            with open(os.path.join(testDir, "test_3.tgz.sums.json.gz"), "wb") as fp:
+                fp.write(b"sums")
+            assert sink.upload_sidecars(os.path.join(testDir, "test_3.tgz")) == (1, "")
+            assert server.buckets["backups"]["host/test_3.tgz"] == data
+            assert server.buckets["backups"]["host/test_3.tgz.sums.json.gz"] == b"sums"
+            assert sink.get_url(tarPath) == server.endpoint + "/backups/host/test_1.tgz"
+    finally:
+        shutil.rmtree(testDir)
+    print("All sinks tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
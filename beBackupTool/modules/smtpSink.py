@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Minimal in-process SMTP server that accepts and discards messages, as a
+stand-in for a real mail server in benchmarks and tests
+
+Only the commands smtplib uses to send are handled. Messages are counted
+and, if asked for, kept
+"""
+
+import sys, os, socketserver, threading
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink(object):
+    """
+    SMTP server on *host*, on a free port unless *port* is given, run in
+    a background thread between start() and stop(), or as a context
+    manager. If *keepMessages* is True, the data of each message is kept
+    in the *messages* list
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, keepMessages=False):
+        self.keepMessages = keepMessages
+        self.messages = []
+        self.messageCount = 0
+        self.bytesReceived = 0
+        self.lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                sink._handle_session(self.rfile, self.wfile)
+
+        self.server = _ThreadingTCPServer((host, port), Handler)
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="smtp-sink", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *excInfo):
+        self.stop()
+
+    def _handle_session(self, rfile, wfile):
+        def reply(line):
+            wfile.write(line.encode("ascii") + b"\r\n")
+            wfile.flush()
+        reply("220 beBackupTool SMTP sink ready")
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b" ", 1)[0].upper()
+            if command == b"EHLO":
+                reply("250-beBackupTool SMTP sink")
+                reply("250 8BITMIME")
+            elif command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                reply("250 OK")
+            elif command == b"DATA":
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                if not self._receive_data(rfile):
+                    return
+                reply("250 OK: message accepted")
+            elif command == b"QUIT":
+                reply("221 Bye")
+                return
+            else:
+                reply("502 Command not implemented")
+
+    def _receive_data(self, rfile):
+        # Message cut off by the connection closing is discarded
+        chunks = [] if self.keepMessages else None
+        size = 0
+        while True:
+            line = rfile.readline()
+            if not line:
+                return False
+            if line == b".\r\n":
+                break
+            if line.startswith(b"."):
+                line = line[1:]
+            size += len(line)
+            if chunks is not None:
+                chunks.append(line)
+        with self.lock:
+            self.messageCount += 1
+            self.bytesReceived += size
+            if chunks is not None:
+                self.messages.append(b"".join(chunks))
+        return True
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in smtpSink")
+    import smtplib
+    with SMTPSink(keepMessages=True) as sink:
+        with smtplib.SMTP(sink.host, sink.port) as s:
+            refused = s.sendmail("from@address.com", ["to@address.com"], "Subject: test\r\n\r\n.dot line\r\nbody\r\n")
+            assert refused == {}
+            s.sendmail("from@address.com", ["to@address.com"], "Subject: second\r\n\r\nbody\r\n")
+    assert sink.messageCount == 2
+    assert sink.messages[0] == b"Subject: test\r\n\r\n.dot line\r\nbody\r\n"
+    assert sink.bytesReceived == sum(len(m) for m in sink.messages)
+    # Other servers left as the standard library has them
+    assert not socketserver.ThreadingTCPServer.allow_reuse_address
+    print("All smtpSink tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fan-out of the compressed archive stream to several outputs at once, so
+it is produced once and never read back from disk
+
+Each output, the local file, a checksum, an upload or an email message,
+is written in a thread of its own from a bounded queue, so the outputs
+run concurrently, and the slowest of them holds the archiver back rather
+than memory growing
+"""
+
+import sys, io, queue, threading
+
+# Bytes gathered from small writes before they are passed to the outputs
+TEE_CHUNK_SIZE = 1024 * 1024
+
+# Max number of chunks waiting for each output
+TEE_QUEUE_SIZE = 8
+
+# Marker passed through the queues after the last chunk
+_TEE_END = object()
+
+
+class _TeeBranch(object):
+    """
+    Thread writing the chunks of its queue to *output*, closing it after
+    the last one, or aborting it if *aborting* is set. Once it fails, the
+    rest of the queue is discarded, so the writer is never blocked
+    """
+
+    def __init__(self, output, required, queueSize, name):
+        self.output = output
+        self.required = required
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.error = ""
+        self.exception = None
+        self.aborting = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is _TEE_END:
+                    break
+                if not self.aborting:
+                    self.output.write(chunk)
+            if self.aborting:
+                abort_output(self.output)
+            else:
+                self.output.close()
+        except Exception as e:
+            self.exception = e
+            self.error = "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+            abort_outputs([self.output])
+            while chunk is not _TEE_END:
+                chunk = self.queue.get()
+
+    def put(self, chunk):
+        self.queue.put(chunk)
+
+    def finish(self, abort=False):
+        if abort:
+            self.aborting = True
+        self.queue.put(_TEE_END)
+        self.thread.join()
+
+
+class TeeWriter(io.RawIOBase):
+    """
+    Write-only file object passing the data written to it to each of the
+    file objects *outputs*, each written in a thread of its own through
+    a queue of at most *queueSize* chunks of *chunkSize* bytes
+
+    The first *requiredCount* outputs are required: once one fails, the
+    next write raises its exception. Any other output that fails is
+    aborted and dropped, while the rest go on. The outputs are closed
+    with the writer, or aborted with abort(), if they have that method,
+    and the *errors* of each, empty if it did not fail, are then known.
+    The tell() method returns the number of bytes written
+    """
+
+    def __init__(self, outputs, requiredCount=1, queueSize=TEE_QUEUE_SIZE, chunkSize=TEE_CHUNK_SIZE):
+        self.branches = [_TeeBranch(output, n < requiredCount, queueSize, "tee-output-%d" % n)
+                            for n, output in enumerate(outputs)]
+        self.chunkSize = chunkSize
+        self.buffer = bytearray()
+        self.position = 0
+
+    @property
+    def errors(self):
+        return [branch.error for branch in self.branches]
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed TeeWriter")
+        self.buffer += data
+        self.position += len(data)
+        if len(self.buffer) >= self.chunkSize:
+            self._flush_chunk()
+        return len(data)
+
+    def _flush_chunk(self):
+        self._raise_required_error()
+        chunk = bytes(self.buffer)
+        self.buffer = bytearray()
+        for branch in self.branches:
+            branch.put(chunk)
+
+    def _raise_required_error(self):
+        for branch in self.branches:
+            if branch.required and branch.exception is not None:
+                raise branch.exception
+
+    def close(self):
+        """
+        Writes out the remaining data and closes the outputs, raising the
+        exception of any required output that failed
+        """
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._flush_chunk()
+        except Exception:
+            self.abort()
+            raise
+        for branch in self.branches:
+            branch.finish()
+        io.RawIOBase.close(self)
+        self._raise_required_error()
+
+    def abort(self):
+        """
+        Aborts all outputs, discarding the data not yet written
+        """
+        if self.closed:
+            return
+        for branch in self.branches:
+            branch.finish(abort=True)
+        io.RawIOBase.close(self)
+
+
+def abort_output(output):
+    """
+    Aborts file object *output*, if it has an abort() method, or else
+    closes it
+    """
+    if hasattr(output, "abort"):
+        output.abort()
+    else:
+        output.close()
+
+
+def abort_outputs(outputs):
+    """
+    Aborts each file object of *outputs*, ignoring errors
+    """
+    for output in outputs:
+        try: abort_output(output)
+        except Exception: pass
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in tee")
+    import os, time
+
+    class SlowOutput(io.BytesIO):
+        # Records the data written, slowly, failing after *failAfter* bytes
+        def __init__(self, delay=0.0, failAfter=None):
+            io.BytesIO.__init__(self)
+            self.delay = delay
+            self.failAfter = failAfter
+            self.data = None
+            self.aborted = False
+        def write(self, data):
+            time.sleep(self.delay)
+            if self.failAfter is not None and self.tell() + len(data) > self.failAfter:
+                raise OSError("output failed")
+            return io.BytesIO.write(self, data)
+        def close(self):
+            self.data = self.getvalue()
+            io.BytesIO.close(self)
+        def abort(self):
+            self.aborted = True
+            io.BytesIO.close(self)
+
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    # All outputs get all the data, written in small pieces
+    outputs = [SlowOutput(), SlowOutput(delay=0.001), SlowOutput()]
+    writer = TeeWriter(outputs, queueSize=2, chunkSize=64 * 1024)
+    for n in range(0, len(data), 10000):
+        writer.write(data[n:n + 10000])
+    assert writer.tell() == len(data)
+    writer.close()
+    assert [o.data for o in outputs] == [data, data, data]
+    assert writer.errors == ["", "", ""]
+    # Queues bounded, so the writer waits for the slow output
+    outputs = [SlowOutput(), SlowOutput(delay=0.05)]
+    writer = TeeWriter(outputs, queueSize=1, chunkSize=1000)
+    for n in range(4):
+        writer.write(b"x" * 1000)
+    assert outputs[1].tell() >= 1000
+    writer.close()
+    # Optional output failing is dropped, while the others go on
+    outputs = [SlowOutput(), SlowOutput(failAfter=1024 * 1024)]
+    writer = TeeWriter(outputs, chunkSize=64 * 1024)
+    writer.write(data)
+    writer.close()
+    assert outputs[0].data == data and outputs[1].aborted
+    assert writer.errors[0] == "" and writer.errors[1].startswith("ERROR") and "output failed" in writer.errors[1]
+    # Required output failing fails the writer
+    outputs = [SlowOutput(failAfter=1024 * 1024), SlowOutput()]
+    writer = TeeWriter(outputs, queueSize=1, chunkSize=64 * 1024)
+    try:
+        for n in range(0, len(data), 64 * 1024):
+            writer.write(data[n:n + 64 * 1024])
+        writer.close()
+        assert False, "required output error not raised"
+    except OSError as e:
+        assert str(e) == "output failed"
+        writer.abort()
+    assert writer.closed and outputs[0].aborted and outputs[1].aborted
+    # Aborted, all outputs are
+    outputs = [SlowOutput(), SlowOutput()]
+    writer = TeeWriter(outputs)
+    writer.write(b"data")
+    writer.abort()
+    assert outputs[0].aborted and outputs[1].aborted
+    assert outputs[0].data is None
+    print("All tee tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
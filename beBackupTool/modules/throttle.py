@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Throttling of the backup, so it does not starve the other work of the
+server it runs on
+
+A Throttle paces the reading of the files archived to a bandwidth and a
+file rate, and backs off further while the system load or the use of
+the disks, read from /proc, is above a threshold. The CPU and I/O
+priorities of the process are set with apply_priority()
+"""
+
+import sys, os, copy, time, errno, platform, ctypes, ctypes.util
+
+# Seconds of reading at the full rate that may be caught up on at once
+BURST_SECONDS = 1.0
+
+# Seconds between checks of the system load and disk use
+CHECK_SECONDS = 1.0
+
+# Least share of the time spent reading, when backing off
+MIN_DUTY = 0.05
+
+# I/O scheduling classes of ioprio_set(), from <linux/ioprio.h>
+IO_CLASSES = {"best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# System call number of ioprio_set() by machine
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "armv6l": 314,
+                        "ppc64le": 273, "ppc64": 273, "s390x": 282, "riscv64": 30}
+
+# Disks left out when the disks of the backup folders are not known
+VIRTUAL_DISK_PREFIXES = ("loop", "ram", "zram", "fd", "sr")
+
+
+class Throttle(object):
+    """
+    Paces the reading of the files archived to at most *maxMBps* MB and
+    *maxFilesPerSecond* files a second, if greater than 0, see pace()
+
+    If *maxLoad*, the 1-minute load average per CPU, or *maxDiskUtil*,
+    the percent of time the disks of *folderPaths* are busy, is greater
+    than 0, the reading also backs off while the system is above it, as
+    checked every *checkSeconds*: its share of the time is halved at
+    each check above, down to MIN_DUTY, and grows by a tenth at each one
+    below. The load and disk use include those of the backup itself
+
+    The *sleptSeconds* are the total time paused. A Throttle may be
+    pickled, to pace a worker process, see get_share()
+    """
+
+    def __init__(self, maxMBps=0, maxFilesPerSecond=0, maxLoad=0, maxDiskUtil=0, folderPaths=(),
+                                                                                checkSeconds=CHECK_SECONDS):
+        self.maxBytesPerSecond = maxMBps * 1000000
+        self.maxFilesPerSecond = maxFilesPerSecond
+        self.maxLoad = maxLoad
+        self.maxDiskUtil = maxDiskUtil
+        self.diskNames = get_disk_names(folderPaths) if maxDiskUtil > 0 else []
+        self.checkSeconds = checkSeconds
+        self.sleptSeconds = 0.0
+        self.reset()
+
+    def reset(self):
+        self.duty = 1.0
+        self.bytesDue = None
+        self.filesDue = None
+        self.lastPace = None
+        self.nextCheck = 0.0
+        self.diskTicks = {}
+
+    def get_share(self, parts):
+        """
+        Returns copy of the throttle allowing each of *parts* workers
+        reading at once its share of the rates
+        """
+        share = copy.copy(self)
+        share.maxBytesPerSecond = self.maxBytesPerSecond / parts
+        share.maxFilesPerSecond = self.maxFilesPerSecond / parts
+        share.sleptSeconds = 0.0
+        share.reset()
+        return share
+
+    def wrap(self, fileobj):
+        """
+        Returns file object reading *fileobj* at the pace of the throttle
+        """
+        return ThrottledReader(fileobj, self)
+
+    def pace(self, nbytes=0, files=0):
+        """
+        Pauses as long as needed after *nbytes* were read or *files*
+        were opened, to keep to the rates and back off
+        """
+        now = time.monotonic()
+        if self.lastPace is None:
+            self.lastPace = self.bytesDue = self.filesDue = now
+        delay = 0.0
+        if self.maxBytesPerSecond > 0 and nbytes:
+            self.bytesDue = max(self.bytesDue, now - BURST_SECONDS) + nbytes / self.maxBytesPerSecond
+            delay = max(delay, self.bytesDue - now)
+        if self.maxFilesPerSecond > 0 and files:
+            self.filesDue = max(self.filesDue, now - BURST_SECONDS) + files / self.maxFilesPerSecond
+            delay = max(delay, self.filesDue - now)
+        if self.maxLoad > 0 or self.maxDiskUtil > 0:
+            if now >= self.nextCheck:
+                self.check_system(now)
+            if self.duty < 1.0:
+                # Work only the duty's share of the time
+                delay = max(delay, (now - self.lastPace) * (1.0 / self.duty - 1.0))
+        if delay > 0:
+            time.sleep(delay)
+            self.sleptSeconds += delay
+        self.lastPace = now + max(delay, 0.0)
+
+    def check_system(self, now):
+        """
+        Halves the duty if the system is above the thresholds, and grows
+        it otherwise
+        """
+        overloaded = False
+        if self.maxLoad > 0:
+            loadPerCPU = get_load_per_cpu()
+            overloaded = loadPerCPU is not None and loadPerCPU > self.maxLoad
+        if self.maxDiskUtil > 0 and not overloaded:
+            overloaded = self.get_disk_util(now) > self.maxDiskUtil
+        if overloaded:
+            self.duty = max(self.duty / 2, MIN_DUTY)
+        else:
+            self.duty = min(self.duty + 0.1, 1.0)
+        self.nextCheck = now + self.checkSeconds
+
+    def get_disk_util(self, now):
+        """
+        Returns the highest percent of time any of the disks was busy
+        since the last call, or 0 on the first
+        """
+        diskUtil = 0.0
+        for diskName, ioTicks in read_disk_ticks(self.diskNames).items():
+            lastTicks = self.diskTicks.get(diskName)
+            if lastTicks is not None and now > lastTicks[0]:
+                diskUtil = max(diskUtil, (ioTicks - lastTicks[1]) / ((now - lastTicks[0]) * 1000.0) * 100)
+            self.diskTicks[diskName] = (now, ioTicks)
+        return diskUtil
+
+
+class ThrottledReader(object):
+    """
+    Read-only file object passing reads of *fileobj* through, paced by
+    *throttle*
+    """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.pace(len(data))
+        return data
+
+
+def get_throttle(configThrottle, folderPaths=()):
+    """
+    Returns Throttle set by the *configThrottle* dict for reading the
+    files of *folderPaths*, or None if it sets no limits
+    """
+    throttle = Throttle(configThrottle.get("Max-MBps", 0), configThrottle.get("Max-Files-Per-Second", 0),
+                        configThrottle.get("Max-Load", 0), configThrottle.get("Max-Disk-Util", 0), folderPaths)
+    if not (throttle.maxBytesPerSecond > 0 or throttle.maxFilesPerSecond > 0 or throttle.maxLoad > 0
+            or throttle.maxDiskUtil > 0):
+        return None
+    return throttle
+
+
+def get_load_per_cpu():
+    """
+    Returns the 1-minute load average divided by the number of CPUs, or
+    None if it cannot be read
+    """
+    try:
+        with open("/proc/loadavg", "r") as fp:
+            return float(fp.read().split()[0]) / (os.cpu_count() or 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_disk_ticks(diskNames=()):
+    """
+    Returns dict of the milliseconds spent doing I/O by each disk of
+    *diskNames*, or of all disks if empty, from /proc/diskstats
+    """
+    diskTicks = {}
+    try:
+        with open("/proc/diskstats", "r") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 13 and (not diskNames or fields[2] in diskNames):
+                    diskTicks[fields[2]] = int(fields[12])
+    except (OSError, ValueError):
+        pass
+    return diskTicks
+
+
+def get_disk_names(folderPaths):
+    """
+    Returns list of the names of the disks holding *folderPaths*, as in
+    /proc/diskstats, or of all real disks if they are not found there,
+    as on virtual file systems
+    """
+    deviceNumbers = set()
+    for folderPath in folderPaths:
+        try:
+            st = os.stat(folderPath)
+            deviceNumbers.add((os.major(st.st_dev), os.minor(st.st_dev)))
+        except OSError:
+            continue
+    diskNames = []
+    allDisks = []
+    try:
+        with open("/proc/diskstats", "r") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) < 13:
+                    continue
+                if (int(fields[0]), int(fields[1])) in deviceNumbers:
+                    diskNames.append(fields[2])
+                if not fields[2].startswith(VIRTUAL_DISK_PREFIXES) and os.path.exists("/sys/block/" + fields[2]):
+                    allDisks.append(fields[2])
+    except (OSError, ValueError):
+        pass
+    return diskNames or allDisks
+
+
+def apply_priority(niceness=0, ioClass="", ioLevel=4):
+    """
+    Lowers the CPU priority of the process to *niceness*, if greater
+    than its own, and sets its I/O scheduling class to *ioClass*,
+    "best-effort" at *ioLevel* from 0 to 7, or "idle", if not empty.
+    Threads and processes started after inherit them
+
+    Returns error message, empty if both were set
+    """
+    try:
+        if niceness > os.getpriority(os.PRIO_PROCESS, 0):
+            os.setpriority(os.PRIO_PROCESS, 0, niceness)
+        if ioClass:
+            syscallNumber = IOPRIO_SET_SYSCALLS.get(platform.machine())
+            if syscallNumber is None or not sys.platform.startswith("linux"):
+                return "ERROR: I/O priority not supported on %s %s" % (sys.platform, platform.machine())
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            ioPriority = (IO_CLASSES[ioClass] << IOPRIO_CLASS_SHIFT) | (ioLevel if ioClass == "best-effort" else 0)
+            if libc.syscall(syscallNumber, IOPRIO_WHO_PROCESS, 0, ioPriority) < 0:
+                code = ctypes.get_errno()
+                raise OSError(code, os.strerror(code))
+    except Exception:
+        return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+    return ""
+
+
+def get_io_priority():
+    """
+    Returns tuple of the I/O scheduling class number and level of the
+    process, or None if they cannot be read
+    """
+    syscallNumber = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscallNumber is None or not sys.platform.startswith("linux"):
+        return None
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    # ioprio_get() is numbered right after ioprio_set()
+    ioPriority = libc.syscall(syscallNumber + 1, IOPRIO_WHO_PROCESS, 0)
+    if ioPriority < 0:
+        return None
+    return ioPriority >> IOPRIO_CLASS_SHIFT, ioPriority & ((1 << IOPRIO_CLASS_SHIFT) - 1)
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in throttle")
+    import io, pickle
+    # Bandwidth and file rate caps
+    throttle = Throttle(maxMBps=10)
+    reader = throttle.wrap(io.BytesIO(b"x" * 3000000))
+    startTime = time.monotonic()
+    while reader.read(100000):
+        pass
+    assert 0.15 < time.monotonic() - startTime < 0.5 and throttle.sleptSeconds > 0.1
+    throttle = Throttle(maxFilesPerSecond=100)
+    startTime = time.monotonic()
+    for n in range(30):
+        throttle.pace(files=1)
+    assert 0.25 < time.monotonic() - startTime < 0.6
+    # Shares for worker processes
+    share = pickle.loads(pickle.dumps(throttle.get_share(4)))
+    assert share.maxFilesPerSecond == 25 and share.sleptSeconds == 0 and share.lastPace is None
+    assert get_throttle({}) is None and get_throttle({"Max-MBps": 5}).maxBytesPerSecond == 5000000
+    # Backing off while the system is above the thresholds
+    throttle = Throttle(maxLoad=0.5, checkSeconds=0.0)
+    loads = [1.0, 1.0, 0.1]
+    global get_load_per_cpu
+    origGetLoad = get_load_per_cpu
+    get_load_per_cpu = lambda: loads.pop(0)
+    try:
+        throttle.pace()
+        assert throttle.duty == 0.5
+        time.sleep(0.02)
+        startTime = time.monotonic()
+        throttle.pace()
+        assert throttle.duty == 0.25 and throttle.sleptSeconds >= 0.05
+        throttle.pace()
+        assert abs(throttle.duty - 0.35) < 1e-9
+    finally:
+        get_load_per_cpu = origGetLoad
+    assert get_load_per_cpu() is None or get_load_per_cpu() >= 0
+    throttle = Throttle(maxDiskUtil=50, folderPaths=["/"])
+    assert throttle.get_disk_util(time.monotonic()) == 0.0
+    assert 0 <= throttle.get_disk_util(time.monotonic() + 1) <= 100 * len(throttle.diskNames or [1])
+    # Priorities
+    assert apply_priority() == ""
+    if get_io_priority() is not None:
+        assert apply_priority(0, "best-effort", 6) == "" and get_io_priority() == (2, 6)
+    print("All throttle tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
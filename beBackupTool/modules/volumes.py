@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Splitting of the compressed archive into numbered volumes of a maximum
+size, so each fits within the attachment limit of mail servers
+
+The volumes of "name.tgz" are "name.tgz.001", "name.tgz.002" and so on,
+described by the index "name.tgz.index.json". Concatenating the volumes
+in order gives back the archive:
+
+    cat name.tgz.[0-9][0-9][0-9] > name.tgz
+"""
+
+import sys, os, io, json, bisect
+
+INDEX_SUFFIX = ".index.json"
+
+# Suffixes of other files kept next to the archive and named after it
+SIDECAR_SUFFIXES = (".members.json.gz", ".sums.json.gz")
+
+
+def get_volume_path(tarFilePath, volumeNumber):
+    """
+    Returns path of volume *volumeNumber*, counted from 1, of the archive
+    """
+    return "%s.%03d" % (tarFilePath, volumeNumber)
+
+
+def get_index_path(tarFilePath):
+    """
+    Returns path of the volume index of the archive
+    """
+    return tarFilePath + INDEX_SUFFIX
+
+
+def strip_volume_suffix(fileName):
+    """
+    Returns archive name of a volume, volume index or sidecar *fileName*,
+    or the name unchanged if it is none of them
+    """
+    for suffix in (INDEX_SUFFIX,) + SIDECAR_SUFFIXES:
+        if fileName.endswith(suffix):
+            return fileName[:-len(suffix)]
+    fb, fx = os.path.splitext(fileName)
+    if len(fx) == 4 and fx[1:].isdigit():
+        return fb
+    return fileName
+
+
+def read_volume_index(tarFilePath):
+    """
+    Returns volume index dict of the archive, or None if it has none
+    """
+    try:
+        with open(get_index_path(tarFilePath), "r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def list_archive_files(tarFilePath):
+    """
+    Returns list of the file paths making up the archive, which is
+    either the archive itself or its volumes in order
+    """
+    if os.path.exists(tarFilePath):
+        return [tarFilePath]
+    volumeIndex = read_volume_index(tarFilePath)
+    if volumeIndex is None:
+        return [tarFilePath]
+    tarDir = os.path.dirname(tarFilePath)
+    return [os.path.join(tarDir, v["Name"]) for v in volumeIndex["Volumes"]]
+
+
+def list_sidecar_files(tarFilePath):
+    """
+    Returns list of the paths of the files kept next to the archive, 
+    its volume index if split and the sidecar files it has
+    """
+    filePaths = [tarFilePath + x for x in SIDECAR_SUFFIXES]
+    if not os.path.exists(tarFilePath):
+        filePaths.insert(0, get_index_path(tarFilePath))
+    return [x for x in filePaths if os.path.exists(x)]
+
+
+def open_archive(tarFilePath):
+    """
+    Returns seekable binary file object reading the archive, joining its
+    volumes if it is split
+    """
+    filePaths = list_archive_files(tarFilePath)
+    if filePaths == [tarFilePath]:
+        return open(tarFilePath, "rb")
+    return io.BufferedReader(VolumeReader(filePaths))
+
+
+class VolumeReader(io.RawIOBase):
+    """
+    Read-only seekable file object reading the files of *filePaths* as
+    one, as from list_archive_files()
+    """
+
+    def __init__(self, filePaths):
+        self.filePaths = filePaths
+        self.starts = []
+        size = 0
+        for filePath in filePaths:
+            self.starts.append(size)
+            size += os.path.getsize(filePath)
+        self.size = size
+        self.position = 0
+        self.fileIndex = None
+        self.volumeFile = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        fileIndex = bisect.bisect_right(self.starts, self.position) - 1
+        if fileIndex != self.fileIndex:
+            if self.volumeFile is not None:
+                self.volumeFile.close()
+            self.volumeFile = open(self.filePaths[fileIndex], "rb")
+            self.fileIndex = fileIndex
+        self.volumeFile.seek(self.position - self.starts[fileIndex])
+        size = self.volumeFile.readinto(buffer)
+        self.position += size
+        return size
+
+    def close(self):
+        if self.volumeFile is not None:
+            self.volumeFile.close()
+            self.volumeFile = None
+        super().close()
+
+
+class VolumeWriter(io.RawIOBase):
+    """
+    Write-only file object writing to numbered volumes of the archive at
+    *tarFilePath*, each of at most *maxBytes*, and writing the volume
+    index when closed
+    """
+
+    def __init__(self, tarFilePath, maxBytes):
+        if maxBytes <= 0:
+            raise ValueError("Volume size must be greater than 0")
+        self.tarFilePath = tarFilePath
+        self.maxBytes = maxBytes
+        self.volumes = []
+        self.volumeFile = None
+        self.volumeSize = 0
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def _next_volume(self):
+        self._close_volume()
+        volumePath = get_volume_path(self.tarFilePath, len(self.volumes) + 1)
+        self.volumeFile = open(volumePath, "wb")
+        self.volumeSize = 0
+        self.volumes.append({"Name": os.path.basename(volumePath), "Size": 0})
+
+    def _close_volume(self):
+        if self.volumeFile is not None:
+            self.volumeFile.close()
+            self.volumes[-1]["Size"] = self.volumeSize
+            self.volumeFile = None
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed VolumeWriter")
+        view = memoryview(data)
+        while len(view):
+            if self.volumeFile is None or self.volumeSize >= self.maxBytes:
+                self._next_volume()
+            chunk = view[:self.maxBytes - self.volumeSize]
+            self.volumeFile.write(chunk)
+            self.volumeSize += len(chunk)
+            view = view[len(chunk):]
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        """
+        Closes the last volume and writes the volume index
+        """
+        if self.closed:
+            return
+        try:
+            if not self.volumes:
+                self._next_volume()
+            self._close_volume()
+            volumeIndex = {
+                            "Archive"       :   os.path.basename(self.tarFilePath),
+                            "Size"          :   self.position,
+                            "Volume-Size"   :   self.maxBytes,
+                            "Volumes"       :   self.volumes,
+                            "Reassemble"    :   "cat %s > %s" % (" ".join(v["Name"] for v in self.volumes),
+                                                                    os.path.basename(self.tarFilePath)),
+                        }
+            with open(get_index_path(self.tarFilePath), "w", encoding="utf-8") as fp:
+                json.dump(volumeIndex, fp, indent=4)
+        finally:
+            super().close()
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in volumes")
+    import tempfile, shutil
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_volumes_")
+    try:
+        tarPath = os.path.join(testDir, "test_1.tgz")
+        data = os.urandom(25000)
+        writer = VolumeWriter(tarPath, 10000)
+        for i in range(0, len(data), 3000):
+            writer.write(data[i:i+3000])
+        writer.close()
+        assert sorted(os.listdir(testDir)) == ["test_1.tgz.001", "test_1.tgz.002", "test_1.tgz.003", "test_1.tgz.index.json"]
+        parts = list_archive_files(tarPath)
+        assert parts == [get_volume_path(tarPath, n) for n in (1, 2, 3)]
+        assert list_sidecar_files(tarPath) == [get_index_path(tarPath)]
+        joined = b""
+        for part in parts:
+            with open(part, "rb") as fp:
+                joined += fp.read()
+        assert joined == data
+        volumeIndex = read_volume_index(tarPath)
+        assert volumeIndex["Size"] == 25000 and [v["Size"] for v in volumeIndex["Volumes"]] == [10000, 10000, 5000]
+        assert volumeIndex["Reassemble"] == "cat test_1.tgz.001 test_1.tgz.002 test_1.tgz.003 > test_1.tgz"
+        # Volumes read back as one seekable file
+        with open_archive(tarPath) as fp:
+            assert fp.read() == data
+            fp.seek(9990)
+            assert fp.read(20) == data[9990:10010]
+            fp.seek(-5, io.SEEK_END)
+            assert fp.read() == data[-5:]
+        # Unsplit archive lists itself
+        assert list_archive_files(os.path.join(testDir, "other.tgz")) == [os.path.join(testDir, "other.tgz")]
+        assert strip_volume_suffix("test_1.tgz.002") == "test_1.tgz"
+        assert strip_volume_suffix("test_1.tgz.index.json") == "test_1.tgz"
+        assert strip_volume_suffix("test_1.tgz") == "test_1.tgz"
+        assert strip_volume_suffix("test_1.tgz.members.json.gz") == "test_1.tgz"
+        assert strip_volume_suffix("test_1.tgz.sums.json.gz") == "test_1.tgz"
+    finally:
+        shutil.rmtree(testDir)
+    print("All volumes tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tracking of the changes to the backup folders between the runs of the
+daemon mode, through Linux inotify, and the daemon's schedule
+
+A ChangeTracker watches every folder of the backup objects that is not
+excluded, and records the paths changed in them, so a run can archive
+only those, see iter_changed_objects(), instead of scanning the whole
+folders again. Should events be lost, as when the kernel's event queue
+overflows, the changes are no longer known and a full scan is called for
+
+Only the C library is needed, through ctypes, so no extra packages
+"""
+
+import sys, os, stat, time, errno, struct, select, threading, ctypes, ctypes.util
+
+try:
+    from . import backup
+except ImportError: # Run as a script for testing
+    import backup
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF \
+                | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+
+# Size of the struct inotify_event header, before the name
+EVENT_HEADER = struct.Struct("iIII")
+
+EVENT_BUFFER_SIZE = 64 * 1024
+
+# Max number of changed paths recorded, beyond which a full scan is cheaper
+MAX_CHANGES = 100000
+
+_libc = None
+
+
+def get_libc():
+    """
+    Returns the C library, loaded once, raising OSError if it has no
+    inotify functions
+    """
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+class Inotify(object):
+    """
+    Linux inotify instance, whose events are read with read_events()
+    """
+
+    def __init__(self):
+        self.libc = get_libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise_errno()
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Returns watch descriptor of folder *path*, the same one if it is
+        watched already
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Returns list of (watch descriptor, mask, cookie, name) tuples of
+        the events read, waiting up to *timeout* seconds for any
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, nameSize = EVENT_HEADER.unpack_from(data, position)
+            position += EVENT_HEADER.size
+            name = data[position:position + nameSize].rstrip(b"\0")
+            position += nameSize
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def raise_errno(path=None):
+    code = ctypes.get_errno()
+    if path is None:
+        raise OSError(code, os.strerror(code))
+    raise OSError(code, os.strerror(code), path)
+
+
+class ChangeTracker(object):
+    """
+    Watches the folders of the backup objects of *configBackupPrefs*,
+    honouring their exclusions, and records the paths changed in them,
+    files and folders, in a background thread between start() and stop()
+
+    Once more than *maxChanges* paths changed, events were lost, or not
+    all folders could be watched, a full scan is called for instead, see
+    take_changes()
+    """
+
+    def __init__(self, configBackupPrefs, maxChanges=MAX_CHANGES):
+        self.roots = [(backup.strip_trailing_slash(bo["Backup-Folder"]), backup.ExclusionMatcher(bo))
+                        for bo in backup.get_valid_backup_objects(configBackupPrefs)]
+        self.maxChanges = maxChanges
+        self.inotify = None
+        # Watched folder path and the exclusions of its backup object, by watch descriptor
+        self.watchPaths = {}
+        self.changedPaths = set()
+        # Changes made before the folders were watched are not known
+        self.rescanNeeded = True
+        self.watchError = ""
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Watches the folders and starts recording their changes
+
+        Returns error message if inotify is not available, or if the
+        folders are not all watched, as the watch limit was reached
+        """
+        try:
+            self.inotify = Inotify()
+        except OSError:
+            return "ERROR: %s %s" % (sys.exc_info()[0], sys.exc_info()[1])
+        for rootPath, matcher in self.roots:
+            if not matcher.excludes_folder(rootPath):
+                self._watch_tree(rootPath, matcher, recordContents=False)
+        self.thread = threading.Thread(target=self.run, name="watch-changes", daemon=True)
+        self.thread.start()
+        return self.watchError
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def take_changes(self):
+        """
+        Returns tuple of the set of paths changed since the last call,
+        and bool whether they are not all known, so a full scan is
+        needed, and starts recording afresh
+        """
+        with self.lock:
+            changedPaths, rescanNeeded = self.changedPaths, self.rescanNeeded or bool(self.watchError)
+            self.changedPaths = set()
+            self.rescanNeeded = False
+        return changedPaths, rescanNeeded
+
+    def request_rescan(self):
+        """
+        Calls for a full scan on the next take_changes(), as when the
+        changes taken could not be archived
+        """
+        with self.lock:
+            self.rescanNeeded = True
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            try:
+                events = self.inotify.read_events(timeout=0.5)
+            except OSError:
+                self.request_rescan()
+                self.stopEvent.wait(0.5)
+                continue
+            for wd, mask, cookie, name in events:
+                self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        """
+        Records the path of an event on watch *wd*, and watches folders
+        created in or moved into a watched one
+        """
+        if mask & IN_Q_OVERFLOW:
+            self.request_rescan()
+            return
+        watched = self.watchPaths.get(wd)
+        if watched is None:
+            return
+        dirPath, matcher = watched
+        if mask & IN_IGNORED:
+            del self.watchPaths[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Recorded by the event in the parent folder, unless a backup folder
+            if dirPath in (r[0] for r in self.roots):
+                self.request_rescan()
+            return
+        path = os.path.join(dirPath, name)
+        isDir = bool(mask & IN_ISDIR)
+        if (isDir and matcher.excludes_folder(path)) or (not isDir and matcher.excludes_file(path, name)):
+            return
+        self._record(dirPath, path)
+        if isDir and mask & IN_MOVED_FROM:
+            self._unwatch_tree(path)
+        elif isDir and mask & (IN_CREATE | IN_MOVED_TO):
+            # Its contents may have been made before it was watched
+            self._watch_tree(path, matcher, recordContents=True)
+
+    def _record(self, *paths):
+        with self.lock:
+            if self.rescanNeeded:
+                return
+            self.changedPaths.update(paths)
+            if len(self.changedPaths) > self.maxChanges:
+                self.changedPaths = set()
+                self.rescanNeeded = True
+
+    def _watch_tree(self, dirPath, matcher, recordContents):
+        pendingPaths = [dirPath]
+        while pendingPaths:
+            folderPath = pendingPaths.pop()
+            try:
+                self.watchPaths[self.inotify.add_watch(folderPath)] = (folderPath, matcher)
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.ENOMEM):
+                    self.watchError = "ERROR: Watch limit reached at '%s', raise fs.inotify.max_user_watches" \
+                                        % folderPath
+                    return
+                # Vanished or unreadable, skipped like the scan does
+                continue
+            try:
+                with os.scandir(folderPath) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                fp = os.path.join(folderPath, entry.name)
+                try:
+                    isDir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                if isDir and not matcher.excludes_folder(fp):
+                    pendingPaths.append(fp)
+                elif isDir or matcher.excludes_file(fp, entry.name):
+                    continue
+                if recordContents:
+                    self._record(fp)
+
+    def _unwatch_tree(self, dirPath):
+        prefix = os.path.join(dirPath, "")
+        for wd, (folderPath, matcher) in list(self.watchPaths.items()):
+            if folderPath == dirPath or folderPath.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watchPaths[wd]
+
+
+def iter_changed_objects(configBackupPrefs, changedPaths, lastEntries, baseEntries, newEntries, scanStats=None):
+    """
+    Yields, like backup.iter_backup_objects(), a generator for each valid
+    backup object, of its backup folder and then of the *changedPaths*
+    in it that still exist, which filtered by manifest.filter_changed_files()
+    against *baseEntries* gives the paths to archive, without scanning
+    the folders
+
+    The *changedPaths* are those changed since the run that recorded the
+    manifest *lastEntries*. If *baseEntries* is another manifest, as in
+    a differential run, the paths whose *lastEntries* differ from it are
+    yielded too
+
+    The *newEntries* dict is given the *lastEntries*, less the changed
+    paths that vanished and the contents of vanished folders, and the
+    filter then updates it with the rest. The paths yielded are counted
+    in *scanStats*, if a backup.ScanStats object
+    """
+    newEntries.update(lastEntries)
+    candidates = {}
+    vanishedFolders = []
+    for fp in changedPaths:
+        try:
+            candidates[fp] = backup.ScannedPath(fp, os.lstat(fp))
+        except OSError:
+            entry = newEntries.pop(fp, None)
+            if entry is not None and stat.S_ISDIR(entry[3]):
+                vanishedFolders.append(os.path.join(fp, ""))
+    if vanishedFolders:
+        vanishedFolders = tuple(vanishedFolders)
+        for fp in [x for x in newEntries if x.startswith(vanishedFolders)]:
+            del newEntries[fp]
+    if baseEntries is not lastEntries:
+        for fp, entry in newEntries.items():
+            if fp not in candidates and baseEntries.get(fp) != entry:
+                candidates[fp] = backup.ScannedPath(fp)
+    if scanStats is not None:
+        scannedFiles = [x for x in candidates.values() if x.stat is not None and not stat.S_ISDIR(x.stat.st_mode)]
+        scanStats.add(folders=len(candidates) - len(scannedFiles), files=len(scannedFiles),
+                        bytes=sum(x.stat.st_size for x in scannedFiles))
+        scanStats.finish()
+    for bo in backup.get_valid_backup_objects(configBackupPrefs):
+        rootPath = backup.strip_trailing_slash(bo["Backup-Folder"])
+        if backup.ExclusionMatcher(bo).excludes_folder(rootPath):
+            yield iter([])
+            continue
+        prefix = os.path.join(rootPath, "")
+        objectPaths = sorted(fp for fp in candidates if fp.startswith(prefix))
+        yield iter([candidates.get(rootPath) or backup.ScannedPath(rootPath)] + [candidates[fp] for fp in objectPaths])
+
+
+def get_next_run_time(now, intervalMinutes=60, runAt=()):
+    """
+    Returns the time of the first run after *now*, at the next of the
+    daily local "HH:MM" times of *runAt*, or else at the next multiple
+    of *intervalMinutes* counted from local midnight
+    """
+    localNow = time.localtime(now)
+    def get_local_time(dayOffset, hours, minutes):
+        return time.mktime((localNow.tm_year, localNow.tm_mon, localNow.tm_mday + dayOffset,
+                            hours, minutes, 0, 0, 0, -1))
+    if runAt:
+        runTimes = [get_local_time(d, *[int(x) for x in hhmm.split(":")]) for d in (0, 1) for hhmm in runAt]
+        return min(t for t in runTimes if t > now)
+    midnight = get_local_time(0, 0, 0)
+    intervalSeconds = max(intervalMinutes, 1) * 60
+    return midnight + (int((now - midnight) // intervalSeconds) + 1) * intervalSeconds
+
+
+def main_test():
+    """
+    Run tests on objects in this module
+    """
+    print("Main test in watch")
+    import tempfile, shutil
+    try:
+        from . import manifest
+    except ImportError:
+        import manifest
+    # Schedule
+    now = time.mktime((2024, 5, 1, 10, 20, 30, 0, 0, -1))
+    assert get_next_run_time(now, 60) == time.mktime((2024, 5, 1, 11, 0, 0, 0, 0, -1))
+    assert get_next_run_time(now, 15) == time.mktime((2024, 5, 1, 10, 30, 0, 0, 0, -1))
+    assert get_next_run_time(now, 60, ["02:30", "10:20"]) == time.mktime((2024, 5, 2, 2, 30, 0, 0, 0, -1))
+    assert get_next_run_time(now, 60, ["23:00", "02:30"]) == time.mktime((2024, 5, 1, 23, 0, 0, 0, 0, -1))
+    testDir = tempfile.mkdtemp(prefix="beBackupTool_watch_")
+    tracker = None
+    try:
+        bkpDir = os.path.join(testDir, "data")
+        for folderPath in ("sub/deep", "excluded", "moved"):
+            os.makedirs(os.path.join(bkpDir, folderPath))
+        for filePath in ("a.txt", "b.log", "sub/c.txt", "sub/deep/d.txt", "excluded/e.txt", "moved/f.txt"):
+            with open(os.path.join(bkpDir, filePath), "w") as fp:
+                fp.write(filePath)
+        configBackupPrefs = [{"Backup-Folder": bkpDir, "Exclude-Folders": [os.path.join(bkpDir, "excluded")],
+                                "Exclude-Files": [], "Exclude-Extensions": ["log"]}]
+        lastEntries = {}
+        for filesToArchive in manifest.filter_changed_files(backup.iter_backup_objects(configBackupPrefs), {},
+                                                            lastEntries):
+            list(filesToArchive)
+        tracker = ChangeTracker(configBackupPrefs)
+        watchError = tracker.start()
+        if watchError.startswith("ERROR: <class 'OSError'>"):
+            print("Skipped change tracking tests: %s" % watchError)
+            return 0
+        assert watchError == "" and len(tracker.watchPaths) == 4
+        assert tracker.take_changes() == (set(), True)
+        assert tracker.take_changes() == (set(), False)
+        def wait_for_changes(expectedPaths):
+            changedPaths = set()
+            for n in range(50):
+                time.sleep(0.02)
+                changedPaths |= tracker.take_changes()[0]
+                if expectedPaths <= changedPaths:
+                    break
+            return changedPaths
+        # Files changed, made and deleted, and folders made and moved
+        with open(os.path.join(bkpDir, "sub/c.txt"), "a") as fp:
+            fp.write("more")
+        for filePath in ("b.log", "excluded/e.txt"):
+            with open(os.path.join(bkpDir, filePath), "a") as fp:
+                fp.write("more")
+        os.makedirs(os.path.join(bkpDir, "new/inner"))
+        with open(os.path.join(bkpDir, "new/inner/g.txt"), "w") as fp:
+            fp.write("g")
+        os.remove(os.path.join(bkpDir, "sub/deep/d.txt"))
+        os.rename(os.path.join(bkpDir, "moved"), os.path.join(testDir, "moved"))
+        expectedPaths = set(os.path.join(bkpDir, x) for x in ("", "sub", "sub/c.txt", "sub/deep", "sub/deep/d.txt",
+                                                                "new", "new/inner", "new/inner/g.txt", "moved"))
+        expectedPaths = set(backup.strip_trailing_slash(x) for x in expectedPaths)
+        changedPaths = wait_for_changes(expectedPaths)
+        assert changedPaths == expectedPaths, changedPaths ^ expectedPaths
+        assert not [x for x in tracker.watchPaths.values() if x[0].endswith("moved")]
+        # Only the changes archived, found without scanning
+        newEntries = {}
+        archivePaths = [list(x) for x in manifest.filter_changed_files(
+                            iter_changed_objects(configBackupPrefs, changedPaths, lastEntries, lastEntries, newEntries),
+                            lastEntries, newEntries)]
+        assert archivePaths[0][0] == bkpDir
+        assert set(archivePaths[0]) == expectedPaths - set(os.path.join(bkpDir, x) for x in ("moved", "sub", "sub/deep/d.txt"))
+        scannedEntries = {}
+        for filesToArchive in manifest.filter_changed_files(backup.iter_backup_objects(configBackupPrefs), {},
+                                                            scannedEntries):
+            list(filesToArchive)
+        assert newEntries == scannedEntries
+        assert manifest.find_deleted_paths(lastEntries, newEntries) == sorted(os.path.join(bkpDir, x)
+                                                                for x in ("moved", "moved/f.txt", "sub/deep/d.txt"))
+        # Differential, against an older manifest
+        baseEntries = dict(lastEntries)
+        del baseEntries[os.path.join(bkpDir, "a.txt")]
+        newEntries = {}
+        archivePaths = [list(x) for x in manifest.filter_changed_files(
+                            iter_changed_objects(configBackupPrefs, set(), scannedEntries, baseEntries, newEntries),
+                            baseEntries, newEntries)]
+        assert newEntries == scannedEntries
+        assert os.path.join(bkpDir, "a.txt") in archivePaths[0] and os.path.join(bkpDir, "sub/c.txt") in archivePaths[0]
+        # Too many changes, or events lost, call for a scan
+        tracker.maxChanges = 2
+        for n in range(3):
+            with open(os.path.join(bkpDir, "many%d.txt" % n), "w") as fp:
+                fp.write("x")
+        time.sleep(0.2)
+        assert tracker.take_changes() == (set(), True)
+        tracker.handle_event(-1, IN_Q_OVERFLOW, "")
+        assert tracker.take_changes()[1]
+    finally:
+        if tracker is not None:
+            tracker.stop()
+        shutil.rmtree(testDir)
+    print("All watch tests passed OK")
+    return 0
+
+
+if __name__ == "__main__":
+    main_test()